@@ -1,42 +1,253 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from pandas.api.types import CategoricalDtype
 import plotly.express as px
 import plotly.graph_objects as go
 import datetime as dt
-from dash import Dash, dcc, html, Input, Output
+from dash import Dash, dcc, html, Input, Output, State, no_update
+from dash.exceptions import PreventUpdate
+from flask import jsonify, request, send_file
 from datetime import date
-from urllib.request import urlopen
-import json
-with urlopen('https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json') as response:
-    counties = json.load(response)
-import networkx as nx
+import data_sources
+import instrumentation
+import serving_artifacts
+import shared_data
+from callback_cache import CallbackCache
+from job_runner import DEFAULT_WORKERS, JobRunner, Superseded
+from case_matrix import load_case_matrix
+from geometry import GEOMETRY_FILE, build_county_geometry
+from routing import RoutingEngine
+from distance_index import load_distance_index, read_edges
+from symptom_scores import MODELS, load_symptom_scores
+from covid_data import COUNTY_DTYPES
+
+# seconds spent in each startup phase and each lazy dataset load
+startup_timings = {}
+_startup_start = time.perf_counter()
+
+
+@contextmanager
+def timed_phase(name):
+    """Records (and prints) how long a startup phase or dataset load takes"""
+
+    with instrumentation.span('dashboard.load.' + name.replace(' ', '_')) as record:
+        yield
+    startup_timings[name] = record['seconds']
+    print('[startup] {}: {:.3f}s'.format(name, startup_timings[name]), flush=True)
+
+
+# ------------------------------------------------------------------------------
+# Datasets (loaded on first use, so the server can answer before they are needed)
+
+@lru_cache(maxsize=None)
+def get_geometry_file():
+    """Returns the path of the pre-simplified county geometry (built once if missing)"""
+
+    if not os.path.exists(GEOMETRY_FILE):
+        with timed_phase('county geometry'):
+            build_county_geometry()
+    return GEOMETRY_FILE
+
+
+@lru_cache(maxsize=None)
+def get_shared_data():
+    """Returns the datasets published to MDA_SHARED_DIR, memory-mapped read-only
+    (None if there is no such directory, in which case every process loads its own)"""
+
+    if shared_data.SHARED_DIR is None:
+        return None
+    if not shared_data.is_published(shared_data.SHARED_DIR):
+        # nothing published yet, or an older version's arrays: publish them now
+        with timed_phase('shared data publication'):
+            shared_data.build_shared_data(shared_data.SHARED_DIR)
+    with timed_phase('shared data'):
+        return shared_data.SharedData(shared_data.SHARED_DIR)
+
+
+@lru_cache(maxsize=None)
+def get_case_matrix():
+    """Returns the active cases as a fips x day matrix (days and county series are direct lookups)"""
+
+    shared = get_shared_data()
+    if shared is not None:
+        return shared.case_matrix()
+
+    with timed_phase('active cases'):
+        # only the months the date picker offers and the county columns the callbacks use
+        return load_case_matrix()
+
+
+@lru_cache(maxsize=None)
+def get_df_edges():
+    """Returns the county adjacency list (uint32 FIPS codes)"""
+
+    with timed_phase('adjacency list'):
+        return read_edges()
+
 
+@lru_cache(maxsize=None)
+def get_routing_engine():
+    """Returns the county adjacency as a CSR routing engine (built once)"""
 
-app = Dash(__name__)
-server = app.server
+    shared = get_shared_data()
+    if shared is not None:
+        return shared.routing_engine()
 
-# data cleaning
-url = "https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/Data/Mid-Points/county_info_with_key.csv"
-df = pd.read_csv(url, dtype={"fips": str}).to_dict(orient='records')
-df_counties = pd.read_csv(url)
+    df_edges = get_df_edges()
+    with timed_phase('routing engine'):
+        return RoutingEngine(df_edges)
 
-url2 = "https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/active_cases.csv"
-df_active = pd.read_csv(url2, dtype={"fips": str})
-df_long = pd.melt(df_active, id_vars=['fips', 'county'], value_vars=df_active.columns[6:], var_name='date',
-                  value_name='cases')
-df_long['Date'] = df_long['date'].str[5:9] + '-' + df_long['date'].str[1:3] + '-' + df_long['date'].str[3:5]
 
-url3 = "https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/Data/adj_dist_all_final.csv"
-df_edges = pd.read_csv(url3)
-df_edges['county_fips'] = df_edges['county_fips'].apply('{:0>5}'.format)
-df_edges['bcounty_fips'] = df_edges['bcounty_fips'].apply('{:0>5}'.format)
-H = nx.Graph()
-H = nx.from_pandas_edgelist(df_edges, source = 'county_fips', target = 'bcounty_fips', edge_attr = 'gc_dist_km')
+@lru_cache(maxsize=None)
+def get_distance_index():
+    """Returns the precomputed landmark index of the distance graph (built once if missing)"""
+
+    engine = get_routing_engine()
+    with timed_phase('distance index'):
+        return load_distance_index(engine=engine)
+
+
+@lru_cache(maxsize=None)
+def get_serving_artifacts():
+    """Returns the per-date artifacts precomputed after the daily update (colors,
+    color ranges, arc weights and hot-origin trees), memory-mapped read-only
+    (None if none were written; days they don't match are computed as before)"""
+
+    if not serving_artifacts.is_published(serving_artifacts.ARTIFACT_DIR):
+        return None
+    matrix, engine = get_case_matrix(), get_routing_engine()
+    with timed_phase('serving artifacts'):
+        return serving_artifacts.ServingArtifacts(serving_artifacts.ARTIFACT_DIR, matrix, engine)
+
+
+@lru_cache(maxsize=None)
+def get_df_clusters():
+    """Returns the county cluster labels for every number of clusters"""
+
+    with timed_phase('clusters'):
+        df_clusters = data_sources.read_csv('counties_clustered', dtype=COUNTY_DTYPES)
+
+        # 5-digit FIPS codes are what the map geometry is keyed by
+        df_clusters['fips'] = df_clusters['fips'].map('{:0>5}'.format)
+    return df_clusters
+
+
+@lru_cache(maxsize=None)
+def get_symptom_scores():
+    """Returns the symptom model scores of every combination of inputs (indexed by packed combination)"""
+
+    with timed_phase('symptom scores'):
+        return load_symptom_scores()
+
+
+# ------------------------------------------------------------------------------
+# Callback results (LRU in memory, optionally shared on disk through MDA_CALLBACK_CACHE_DIR)
+
+callback_cache = CallbackCache()
+
+
+def attach_shared_data():
+    """Maps the shared datasets in a process of the job pool as soon as it starts"""
+
+    get_case_matrix()
+    get_routing_engine()
+
+
+# heavy callbacks run in a local process pool whose processes map the shared datasets
+# (without MDA_SHARED_DIR every process would load its own copy, so they run in the
+# request thread instead); identical requests share one job (see job_runner.py)
+job_runner = JobRunner(callback_cache, max_workers=DEFAULT_WORKERS if shared_data.SHARED_DIR is not None else 0,
+                       initializer=attach_shared_data)
+
+
+def active_version():
+    """Returns the latest date of the active case table (cached results depend on it)"""
+
+    return get_case_matrix().last_date
+
+
+def clusters_version():
+    """Returns the modification time of the local copy of the cluster labels"""
+
+    return os.path.getmtime(data_sources.fetch('counties_clustered'))
+
+
+def score_routes(pairs, date_value):
+    """Returns the safest and shortest path metrics of many county pairs on one day
+
+    Pairs are grouped by origin, so one search per distinct origin (and path
+    metric) serves all pairs starting there.
+
+    Parameters
+    ----------
+    pairs: list
+        (origin FIPS, destination FIPS) pairs
+    date_value: str
+        Day of the active cases (YYYY-MM-DD)
+
+    Returns
+    -------
+    routes: dataframe
+        One row per pair with the same distance (km), total cases and number
+        of counties per path as the dashboard reports
+    """
+
+    matrix = get_case_matrix()
+    engine = get_routing_engine()
+
+    if not matrix.has_day(date_value):
+        raise ValueError('no active cases for {}'.format(date_value))
+
+    pairs = [(int(origin), int(target)) for origin, target in pairs]
+    node_cases = engine.node_values(matrix.fips, matrix.day(date_value))
+    routes = engine.batch_routes(pairs, node_cases)
+
+    # same rounding as the dashboard (cases and counties are whole numbers)
+    counts = ['safest_cases', 'safest_counties', 'shortest_cases', 'shortest_counties']
+    routes[counts] = routes[counts].astype('Int64')
+    routes[['safest_km', 'shortest_km']] = routes[['safest_km', 'shortest_km']].round(2)
+    return routes
+
+
+# one structured (JSON) record per callback and dataset load goes to MDA_LOG_FILE if it is set
+if instrumentation.LOG_FILE is not None:
+    instrumentation.configure_logging(instrumentation.LOG_FILE)
+
+with timed_phase('app'):
+    app = Dash(__name__)
+    server = app.server
+
+# the browser downloads the county geometry once from here (figures only reference the url)
+COUNTIES_URL = app.get_relative_path('/data/counties.geojson')
+
+
+@server.route('/data/counties.geojson')
+def counties_geojson():
+    """Serves the simplified county geometry (revalidated by the browser with its ETag)"""
+
+    return send_file(get_geometry_file(), mimetype='application/json', max_age=86400)
+
+
+# data cleaning (only the small county list is needed to build the layout)
+with timed_phase('county list'):
+    df_counties = data_sources.read_csv('county_info_with_key', dtype=COUNTY_DTYPES)
+    df = df_counties.astype({"fips": str}).to_dict(orient='records')
+
+# the date the page opens on (the latest one the date picker offers), filled by warm_up_cache
+DEFAULT_DATE = dt.date.today() - dt.timedelta(days=2)
 
 # ------------------------------------------------------------------------------
 # App layout
 app.layout = html.Div([
     html.H1("Covid19 in the USA", style={'text-align': 'center'}),
+    # identifies the browser tab, so a newer request supersedes its older ones
+    dcc.Store(id='client_id', storage_type='session'),
     html.Div(children=[
             html.Div(children=[
                 html.H4("From:"),
@@ -59,9 +270,14 @@ app.layout = html.Div([
                 dcc.DatePickerSingle(
                     id='date_selected',
                     min_date_allowed=date(2021, 1, 1),
-                    max_date_allowed=(dt.date.today() - dt.timedelta(days=2)),
+                    max_date_allowed=DEFAULT_DATE,
                     initial_visible_month=date(2021, 1, 31),
-                    date=(dt.date.today() - dt.timedelta(days=2))
+                    date=DEFAULT_DATE
+                    ),
+                dcc.RadioItems(id='safest_mode',
+                    options=[{'label': 'Safest path on the cases of this date', 'value': 'day'},
+                             {'label': 'Leave on this date, cases of the day each county is reached', 'value': 'arrival'}],
+                    value='day'
                     )],style=dict(width='45%', display='inline-block')),
             html.Div(children=[
                 html.H4("Number of clusters"),
@@ -79,7 +295,11 @@ app.layout = html.Div([
     html.Div(children=[
             dcc.Loading(id="loading",type="graph",children=[
             html.Div(children=[
-                html.Div(children=[dcc.Graph(id='map', figure={})], style=dict(align='left', width='90%', display='inline-block')),
+                html.Div(children=[dcc.Graph(id='map', figure={}),
+                                   # map layers, sent separately and combined in the browser
+                                   dcc.Store(id='map_base'),
+                                   dcc.Store(id='day_layer'),
+                                   dcc.Store(id='path_layer')], style=dict(align='left', width='90%', display='inline-block')),
                 html.Div(children=[html.H3("Safest Path"),
                                    html.Div(id='km_sapa', children=[]),
                                    html.Div(id='cases_sapa', children=[]),
@@ -102,155 +322,260 @@ app.layout = html.Div([
 # ------------------------------------------------------------------------------
 # Connect the Plotly graphs with Dash Components
 
+def day_cases(date_value):
+    """Returns the active cases and cases per thousand residents of one day (YYYY-MM-DD)"""
+
+    matrix = get_case_matrix()
+    data_covid_request = matrix.counties.loc[:, ['fips', 'county', 'population']]
+    data_covid_request['fips'] = matrix.fips_labels
+    data_covid_request['active_cases'] = matrix.day(date_value)
+    data_covid_request['prop'] = 1000 * (data_covid_request['active_cases'] / data_covid_request['population'])
+    return data_covid_request
+
+
+@callback_cache.memoize('day_map', version=active_version)
+def day_map(date_value):
+    """Returns the choropleth of one day as a plain figure dict (the geometry is only referenced by url)"""
+
+    data_covid_request = day_cases(date_value)
+    covidmap = px.choropleth_mapbox(data_covid_request, geojson=COUNTIES_URL, locations='fips', color='prop', hover_name='county',
+                                    hover_data=['fips', 'active_cases', 'population'], color_continuous_scale="sunsetdark",
+                                    range_color=(data_covid_request['prop'].min(), data_covid_request['prop'].max()),
+                                    mapbox_style="carto-positron", zoom=3.25, center={"lat": 37.0902, "lon": -95.7129},
+                                    opacity=0.9, labels={'prop': 'Active cases <br> per thousand <br> residents'})
+    covidmap.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                           legend=dict( orientation="h",
+                                        yanchor="bottom",#y=1.02,
+                                        xanchor="right", x=1))
+    return covidmap.to_dict()
+
+
+@callback_cache.memoize('day_layer', version=active_version)
+def day_layer(date_value):
+    """Returns what changes from day to day on the map: the color (cases per
+    thousand residents) and active cases of every county, and the color range"""
+
+    # precomputed days are array lookups
+    artifacts = get_serving_artifacts()
+    colors = artifacts.colors(date_value) if artifacts is not None else None
+    if colors is not None:
+        return {'z': np.array(colors[0]), 'cases': get_case_matrix().day(date_value), 'range': colors[1]}
+
+    data_covid_request = day_cases(date_value)
+    return {'z': data_covid_request['prop'].to_numpy(), 'cases': data_covid_request['active_cases'].to_numpy(),
+            'range': [data_covid_request['prop'].min(), data_covid_request['prop'].max()]}
+
+
 @app.callback(
-    [Output(component_id='km_sapa', component_property='children'),
-     Output(component_id='cases_sapa', component_property='children'),
-     Output(component_id='counties_sapa', component_property='children'),
-     Output(component_id='km_shopa', component_property='children'),
-     Output(component_id='cases_shopa', component_property='children'),
-     Output(component_id='counties_shopa', component_property='children'),
-     Output(component_id='map', component_property='figure'),
-     Output(component_id='ts', component_property='figure')],
-    [Input(component_id='county_from', component_property='value'),
-     Input(component_id='county_to', component_property='value'),
-     Input(component_id='date_selected', component_property='date')]
+    [Output(component_id='day_layer', component_property='data'),
+     Output(component_id='map_base', component_property='data')],
+    Input(component_id='date_selected', component_property='date'),
+    State(component_id='map_base', component_property='data'))
+@instrumentation.timed('dashboard.update_day_layer')
+def update_day_layer(option_3, map_base):
+    """Sends the day's colors when the date changes (and the rest of the choropleth only once)"""
+
+    return day_layer(option_3), day_map(active_version()) if map_base is None else no_update
+
+
+# the map is assembled in the browser from the choropleth sent once, the
+# day's colors and the path traces, so each interaction only sends what changed
+# (county rows are in the same order in the choropleth and every day's colors)
+app.clientside_callback(
+    """
+    function(dayLayer, pathLayer, mapBase) {
+        if (!dayLayer || !mapBase) {
+            return window.dash_clientside.no_update;
+        }
+        var base = mapBase.data[0];
+        var choropleth = Object.assign({}, base, {
+            z: dayLayer.z,
+            customdata: base.customdata.map(function(row, i) { return [row[0], dayLayer.cases[i], row[2]]; })
+        });
+        var coloraxis = Object.assign({}, mapBase.layout.coloraxis, {cmin: dayLayer.range[0], cmax: dayLayer.range[1]});
+        return {'data': [choropleth].concat(pathLayer || []),
+                'layout': Object.assign({}, mapBase.layout, {coloraxis: coloraxis})};
+    }
+    """,
+    Output(component_id='map', component_property='figure'),
+    [Input(component_id='day_layer', component_property='data'),
+     Input(component_id='path_layer', component_property='data')],
+    State(component_id='map_base', component_property='data')
 )
 
-def update_graph(option_1, option_2, option_3):
 
-    option1_str='{:0>5}'.format(str(option_1))
-    option2_str='{:0>5}'.format(str(option_2))
+app.clientside_callback(
+    """
+    function(timestamp, clientId) {
+        return clientId ? window.dash_clientside.no_update : Math.random().toString(36).slice(2);
+    }
+    """,
+    Output(component_id='client_id', component_property='data'),
+    Input(component_id='client_id', component_property='modified_timestamp'),
+    State(component_id='client_id', component_property='data')
+)
 
-    date_split = option_3.split('-')
-    if (len(date_split[2]) < 2):
-        day_str = str(0) + str(date_split[2])
-    else:
-        day_str = str(date_split[2])
-    if (len(date_split[1]) < 2):
-        month_str = str(0) + str(date_split[1])
-    else:
-        month_str = str(date_split[1])
-    year_str = date_split[0]
-    date_str = 'd' +  month_str + day_str + year_str
 
-    # subset data set for selected day
-    data_covid_request = df_active.loc[:, ['fips', 'county', 'population', date_str]]
-    data_covid_request.columns = ['fips', 'county', 'population', 'active_cases']
-    data_covid_request['prop'] = 1000 * (data_covid_request['active_cases'] / data_covid_request['population'])
+def graph_outputs(option_1, option_2, option_3, option_5='day'):
+    """Returns the path metrics, path traces and time series figure of a county pair on a day
+    (run by the job processes, so it only depends on its arguments and the datasets)
+
+    With option_5 'arrival' the trip leaves on the day and every county counts
+    the active cases of the day it is reached on.
+    """
+
+    option1 = int(option_1)
+    option2 = int(option_2)
+
+    engine = get_routing_engine()
+    matrix = get_case_matrix()
+    artifacts = get_serving_artifacts()
+    time_dependent = option_5 == 'arrival'
+
+    # map the day's cases onto the prebuilt graph (arc weight = cases of the county entered),
+    # unless the nightly precompute already did for this day
+    case_weights = artifacts.weights(option_3) if artifacts is not None else None
+    if case_weights is None:
+        case_weights = engine.case_weights(engine.node_values(matrix.fips, matrix.day(option_3)))
+    tree = artifacts.tree(option_3, option1) if artifacts is not None and not time_dependent else None
 
-    url3 = "https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/Data/adj_dist_all_final.csv"
-    df_edges = pd.read_csv(url3)
-    df_edges['county_fips'] = df_edges['county_fips'].apply('{:0>5}'.format)
-    df_edges['bcounty_fips'] = df_edges['bcounty_fips'].apply('{:0>5}'.format)
-
-    # add active cases to df_adj
-    df_edges = df_edges.merge(data_covid_request, left_on='county_fips', right_on='fips')
-    df_edges = df_edges.merge(data_covid_request, left_on='bcounty_fips', right_on='fips')
-
-    # prep
-    source_nodes = df_edges.loc[:, 'county_fips'].astype(str)
-    dest_nodes = df_edges.loc[:, 'bcounty_fips'].astype(str)
-    data_nodes = df_edges.loc[:, 'active_cases_x'].astype(int)
-    data2_nodes = df_edges.loc[:, 'active_cases_y'].astype(int)
-    # create graph
-    G = nx.MultiDiGraph()
-    for u, v, d in zip(source_nodes, dest_nodes, data2_nodes):
-        G.add_edge(u, v, cases=d, key='a')
-    for u, v, d in zip(dest_nodes, source_nodes, data_nodes):
-        G.add_edge(u, v, cases=d, key='a')
     # calculate safest path
-    pathC = nx.single_source_dijkstra(G, option1_str, option2_str, weight='cases')
-    pathC_counties = list(map(int, pathC[1]))
-    safest_path = df_counties[df_counties['fips'].isin(pathC_counties)]
-    pathC_order = CategoricalDtype(pathC_counties, ordered=True)
-    safest_path['fips'] = safest_path['fips'].astype(pathC_order)
-    safest_path.sort_values('fips', inplace=True)
-
-    # calculate shortest path
-    pathD = nx.single_source_dijkstra(H, option1_str, option2_str, weight='gc_dist_km')
-    pathD_counties = list(map(int, pathD[1]))
-    shortest_path = df_counties[df_counties['fips'].isin(pathD_counties)]
-    pathD_order = CategoricalDtype(pathD_counties, ordered=True)
-    shortest_path['fips'] = shortest_path['fips'].astype(pathD_order)
-    shortest_path.sort_values('fips', inplace=True)
+    with instrumentation.span('dashboard.update_graph.safest_path', time_dependent=time_dependent,
+                              precomputed=tree is not None):
+        if tree is not None:
+            pathC_cases, pathC_counties = engine.route_in_tree(*tree, option1, option2)
+        elif time_dependent:
+            # the cases of the trip's days, read from the fips x day matrix
+            trip_cases = engine.trip_cases(matrix.fips, matrix.values, matrix.day_index(option_3))
+            pathC_cases, pathC_counties, pathC_days = engine.time_dependent_route(option1, option2, trip_cases)
+        else:
+            pathC_cases, pathC_counties = engine.route(option1, option2, case_weights)
+        safest_path = df_counties[df_counties['fips'].isin(pathC_counties)]
+        pathC_order = CategoricalDtype(pathC_counties, ordered=True)
+        safest_path['fips'] = safest_path['fips'].astype(pathC_order)
+        safest_path.sort_values('fips', inplace=True)
+
+    # calculate shortest path (the distance graph is static, so the precomputed index is used)
+    with instrumentation.span('dashboard.update_graph.shortest_path'):
+        pathD_km, pathD_counties = get_distance_index().route(option1, option2)
+        shortest_path = df_counties[df_counties['fips'].isin(pathD_counties)]
+        pathD_order = CategoricalDtype(pathD_counties, ordered=True)
+        shortest_path['fips'] = shortest_path['fips'].astype(pathD_order)
+        shortest_path.sort_values('fips', inplace=True)
 
     # calculate total km/cases/counties for each path
     pathC_nNodes = len(pathC_counties)
     pathD_nNodes = len(pathD_counties)
-    pathC_str = ["{:0>5}".format(item) for item in pathC_counties]
-    pathD_str = ["{:0>5}".format(item) for item in pathD_counties]
-    pathC_cases = nx.path_weight(G, pathC_str, weight='cases')
-    pathC_km = round(nx.path_weight(H, pathC_str, weight='gc_dist_km'), 2)
-    pathD_cases = nx.path_weight(G, pathD_str, weight='cases')
-    pathD_km = round(nx.path_weight(H, pathD_str, weight='gc_dist_km'), 2)
+    pathC_cases = int(pathC_cases)
+    pathC_km = round(engine.path_weight(pathC_counties), 2)
+    if time_dependent:
+        pathD_cases = int(engine.trip_path_weight(pathD_counties, trip_cases))
+    else:
+        pathD_cases = int(engine.path_weight(pathD_counties, case_weights))
+    pathD_km = round(pathD_km, 2)
 
     km_sapa = "Total distance: {}km".format(pathC_km)
     cases_sapa = "Total cases: {}".format(pathC_cases)
     counties_sapa = "Total counties: {}".format(pathC_nNodes)
+    if time_dependent:
+        counties_sapa += " ({} days of travel)".format(pathC_days[-1] + 1 if pathC_days else 0)
     km_shopa = "Total distance: {}km".format(pathD_km)
     cases_shopa = "Total cases: {}".format(pathD_cases)
     counties_shopa = "Total counties: {}".format(pathD_nNodes)
 
-    covidmap = px.choropleth_mapbox(data_covid_request, geojson=counties, locations='fips', color='prop', hover_name='county',
-                                    hover_data=['fips', 'active_cases', 'population'], color_continuous_scale="sunsetdark",
-                                    range_color=(data_covid_request['prop'].min(), data_covid_request['prop'].max()),
-                                    mapbox_style="carto-positron", zoom=3.25, center={"lat": 37.0902, "lon": -95.7129},
-                                    opacity=0.9, labels={'prop': 'Active cases <br> per thousand <br> residents'})
+    # path traces and time series figure (plotly validation and serialization)
+    with instrumentation.span('dashboard.update_graph.figures'):
+        col1 = "darkslategrey"
+        col2 = "lightslategrey"
+
+        path_traces = [go.Scattermapbox(
+            name="Safest Path",
+            mode="markers+lines",
+            lon=safest_path['long'],
+            lat=safest_path['lat'],
+            marker=dict(size=7, color=col1),
+            line=dict(width=4, color=col1)
+            ), go.Scattermapbox(
+            name="Shortest Path",
+            mode="markers+lines",
+            lon=shortest_path['long'],
+            lat=shortest_path['lat'],
+            marker=dict(size=7, color=col2),
+            line=dict(width=4, color=col2)
+            )]
+        path_layer = [trace.to_plotly_json() for trace in path_traces]
+
+        # the two counties' rows of the case matrix (in table order, like the plot always had them)
+        rows = sorted({matrix.row(option1), matrix.row(option2)})
+        dff = pd.DataFrame({'Date': np.tile(matrix.date_labels, len(rows)),
+                            'cases': matrix.values[rows].ravel(),
+                            'county': np.repeat(matrix.counties['county'].to_numpy()[rows], len(matrix.dates))})
+
+        ts = px.line(dff, x='Date', y="cases", color='county',
+                     hover_data={"Date": "|%B %d, %Y"}, color_discrete_sequence=['#E69F00', '#0072B2'] )
+        ts.add_vline(x=option_3)
+        ts.update_xaxes(
+            dtick="M1",
+            tickformat="%b\n%Y")
+        ts.update_xaxes(rangeslider_visible=True)
+        ts.update_layout(  # margin={"r": 0, "t": 0, "l": 0, "b": 0}
+                            legend=dict(orientation="h",
+                            yanchor="bottom",  # y=1.02,
+                            xanchor="right", x=1))
+
+        # plain figure dicts are cheap to store and restore from the callback cache
+        ts_figure = ts.to_dict()
+
+    return km_sapa, cases_sapa, counties_sapa, km_shopa, cases_shopa, counties_shopa, path_layer, ts_figure
+
+
+@instrumentation.timed('dashboard.update_graph')
+@callback_cache.memoize('update_graph', version=active_version)
+def update_graph(option_1, option_2, option_3, option_5='day'):
+    """Returns the outputs of the path callback, computed in this process"""
+
+    return graph_outputs(option_1, option_2, option_3, option_5)
 
-    col1 = "darkslategrey"
-    col2 = "lightslategrey"
-
-    covidmap.add_trace(go.Scattermapbox(
-        name="Safest Path",
-        mode="markers+lines",
-        lon=safest_path['long'],
-        lat=safest_path['lat'],
-        marker=dict(size=7, color=col1),
-        line=dict(width=4, color=col1)
-        ))
-    covidmap.add_trace(go.Scattermapbox(
-        name="Shortest Path",
-        mode="markers+lines",
-        lon=shortest_path['long'],
-        lat=shortest_path['lat'],
-        marker=dict(size=7, color=col2),
-        line=dict(width=4, color=col2)
-        ))
-    covidmap.update_traces(selector=dict(type='scattermapbox'))
-    covidmap.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
-                           legend=dict( orientation="h",
-                                        yanchor="bottom",#y=1.02,
-                                        xanchor="right", x=1))
-
-    dff = df_long[(df_long["fips"] == option1_str) | (df_long["fips"] == option2_str)]
 
-    ts = px.line(dff, x='Date', y="cases", color='county',
-                 hover_data={"Date": "|%B %d, %Y"}, color_discrete_sequence=['#E69F00', '#0072B2'] )
-    ts.add_vline(x=option_3)
-    ts.update_xaxes(
-        dtick="M1",
-        tickformat="%b\n%Y")
-    ts.update_xaxes(rangeslider_visible=True)
-    ts.update_layout(  # margin={"r": 0, "t": 0, "l": 0, "b": 0}
-                        legend=dict(orientation="h",
-                        yanchor="bottom",  # y=1.02,
-                        xanchor="right", x=1))
+@app.callback(
+    [Output(component_id='km_sapa', component_property='children'),
+     Output(component_id='cases_sapa', component_property='children'),
+     Output(component_id='counties_sapa', component_property='children'),
+     Output(component_id='km_shopa', component_property='children'),
+     Output(component_id='cases_shopa', component_property='children'),
+     Output(component_id='counties_shopa', component_property='children'),
+     Output(component_id='path_layer', component_property='data'),
+     Output(component_id='ts', component_property='figure')],
+    [Input(component_id='county_from', component_property='value'),
+     Input(component_id='county_to', component_property='value'),
+     Input(component_id='date_selected', component_property='date'),
+     Input(component_id='safest_mode', component_property='value')],
+    State(component_id='client_id', component_property='data')
+)
+@instrumentation.timed('dashboard.update_graph_job')
+def update_graph_job(option_1, option_2, option_3, option_5, client_id):
+    """Runs the path callback as a background job, shared by identical requests;
+    a request superseded by a newer one from the same tab sends nothing"""
 
-    return km_sapa, cases_sapa, counties_sapa, km_shopa, cases_shopa, counties_shopa, covidmap, ts
+    try:
+        return job_runner.run(update_graph.key(option_1, option_2, option_3, option_5), graph_outputs,
+                              (option_1, option_2, option_3, option_5), client=client_id)
+    except Superseded:
+        raise PreventUpdate
 
 @app.callback(
          Output(component_id='map2', component_property='figure'),
          Input(component_id='n_clust', component_property='value'))
+@instrumentation.timed('dashboard.apply_clustering')
+@callback_cache.memoize('apply_clustering', version=clusters_version)
 def apply_clustering(option_4):
 
-    url4 = "https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/Data/Counties_clustered.csv"
-    df_clusters = pd.read_csv(url4)
-    df_clusters['fips'] = df_clusters['fips'].apply('{:0>5}'.format)
+    df_clusters = get_df_clusters().copy()
     cluster_count = "clusters_{}".format(option_4)
     df_clusters[cluster_count] = df_clusters[cluster_count].astype(str)
     df_clusters = df_clusters.loc[:,['fips', 'county', 'state', 'lat', 'long', 'population', cluster_count]]
 
-    covidmap2 = px.choropleth_mapbox(df_clusters, geojson=counties, locations='fips', color=cluster_count, hover_name='county',
+    covidmap2 = px.choropleth_mapbox(df_clusters, geojson=COUNTIES_URL, locations='fips', color=cluster_count, hover_name='county',
                                  hover_data=['fips', 'state', 'population'],
                                  color_discrete_sequence=px.colors.qualitative.Dark24,
                                  mapbox_style="carto-positron", zoom=2.25, center={"lat": 37.0902, "lon": -95.7129},
@@ -258,7 +583,82 @@ def apply_clustering(option_4):
 
     covidmap2.update_layout(legend=dict(orientation="h",yanchor="bottom", xanchor="right", x=1))
 
-    return covidmap2
+    return covidmap2.to_dict()
+
+@server.route('/api/routes', methods=['POST'])
+@instrumentation.timed('dashboard.api_routes')
+def routes_endpoint():
+    """Batch version of the path metrics: expects {"date": "YYYY-MM-DD", "pairs": [[from, to], ...]}"""
+
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body.get('pairs'), list) or 'date' not in body:
+        return jsonify(error='expected a JSON body with "date" and "pairs"'), 400
+
+    try:
+        routes = score_routes(body['pairs'], body['date'])
+    except (TypeError, ValueError) as error:
+        return jsonify(error=str(error)), 400
+
+    # unreachable pairs have missing metrics, which JSON writes as null
+    routes['from'] = routes['from'].map('{:0>5}'.format)
+    routes['to'] = routes['to'].map('{:0>5}'.format)
+    return server.response_class(
+        '{{"date": {}, "routes": {}}}'.format(json.dumps(body['date']), routes.to_json(orient='records')),
+        mimetype='application/json')
+
+
+@server.route('/api/symptom_scores', methods=['POST'])
+@instrumentation.timed('dashboard.api_symptom_scores')
+def symptom_scores_endpoint():
+    """Batch scoring of the symptom models: expects {"records": [{"cough": 1, ..., "test_indication": "abroad"}, ...]}"""
+
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body.get('records'), list):
+        return jsonify(error='expected a JSON body with "records"'), 400
+
+    try:
+        scores = get_symptom_scores().batch_scores(body['records'])
+    except (TypeError, ValueError) as error:
+        return jsonify(error=str(error)), 400
+
+    # one list of scores per model, in record order
+    return server.response_class(json.dumps(dict(zip(MODELS, scores.T.astype(np.float64).round(4).tolist()))),
+                                 mimetype='application/json')
+
+
+@server.route('/metrics')
+def metrics_endpoint():
+    """Latency histograms of every instrumented span, data source fetch counts,
+    callback cache hit rates and background jobs of this process, in the Prometheus text format"""
+
+    stats = callback_cache.stats()
+    lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+    gauges = [('callback_cache_lookups', {'result': 'memory_hit'}, stats['hits']),
+              ('callback_cache_lookups', {'result': 'disk_hit'}, stats['disk_hits']),
+              ('callback_cache_lookups', {'result': 'miss'}, stats['misses']),
+              ('callback_cache_hit_ratio', {}, (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0),
+              ('callback_cache_entries', {}, stats['entries'])]
+    gauges += [('job_runner_' + name, {}, value) for name, value in job_runner.stats().items()]
+    return server.response_class(instrumentation.render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+
+def warm_up_cache(county_from='49003', county_to='47185', n_clust=3):
+    """Fills the callback cache for what the page opens on: the default date
+    (as the date picker sends it), counties and clusters"""
+
+    with timed_phase('cache warm-up'):
+        date_value = DEFAULT_DATE.isoformat()
+        get_serving_artifacts()
+        update_graph(county_from, county_to, date_value, 'day')
+        day_map(active_version())
+        day_layer(date_value)
+        apply_clustering(n_clust)
+
+
+startup_timings['total'] = time.perf_counter() - _startup_start
+print('[startup] total: {:.3f}s'.format(startup_timings['total']), flush=True)
+
 # ------------------------------------------------------------------------------
 if __name__ == '__main__':
+    threading.Thread(target=warm_up_cache, daemon=True).start()
     app.run_server(debug=True)
@@ -0,0 +1,422 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import case_store
+import covid_data
+import data_sources
+import distance_index
+import partitions
+import shared_data
+import data_quality
+from covid_data import active_window, daily_diff
+
+
+# stored results that later runs are checked against (see --save-baseline)
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# the Johns Hopkins series start on this day; the benchmarked range always starts on 1/1/21, like main.py
+JHU_FIRST_DAY = date(2020, 1, 22)
+FIRST_DAY = date(2021, 1, 1)
+
+# differences smaller than these are timer/allocator noise, never regressions
+MIN_SECONDS = 0.005
+MIN_MB = 1.0
+
+# chained-assignment warnings the pipeline code raises while timed (pandas 1.4
+# only has it in pandas.core.common and pandas 3 removed it, so there is nothing to ignore)
+SETTING_WITH_COPY = getattr(pd.errors, 'SettingWithCopyWarning',
+                            getattr(pd.core.common, 'SettingWithCopyWarning', None))
+
+# counties the Johns Hopkins fixture reports as 0 throughout (like the Utah counties
+# it only reports as health districts), so the repair from the NY Times is exercised
+MISSING_FIPS = np.array([49001, 49003, 49005, 49007, 49009, 49013, 49015,
+                         49017, 49019, 49021, 49023, 49025, 49027, 49029,
+                         49031, 49033, 49039, 49041, 49047, 49053, 49055,
+                         49057], dtype=np.uint32)
+
+
+# ------------------------------------------------------------------------------
+# Synthetic fixtures (same file names and columns as the real sources)
+
+def synthetic_counties(n_counties, rng):
+    """Returns a county table (fips, county, state, lat, long, population) of
+    n_counties counties laid out on a grid, always including MISSING_FIPS"""
+
+    codes = (np.arange(1, 57)[:, np.newaxis] * 1000 + np.arange(1, 140, 2)).ravel()
+    others = rng.choice(np.setdiff1d(codes, MISSING_FIPS), n_counties - len(MISSING_FIPS), replace=False)
+    fips = np.union1d(MISSING_FIPS, others).astype(np.uint32)
+
+    # counties fill a grid row by row in FIPS order, so the first and last are far apart
+    width = int(np.ceil(np.sqrt(n_counties * 1.6)))
+    row, col = np.divmod(np.arange(n_counties), width)
+
+    return pd.DataFrame({'fips': fips,
+                         'county': ['County {}'.format(code) for code in fips.tolist()],
+                         'state': ['State {}'.format(code // 1000) for code in fips.tolist()],
+                         'lat': 25 + row * 0.45,
+                         'long': -124 + col * 0.75,
+                         'population': np.maximum(rng.lognormal(10.3, 1.3, n_counties), 100).astype(np.int64)})
+
+
+def synthetic_cumulative(counties, n_days, rng):
+    """Returns (n_counties, n_days) cumulative cases and deaths: daily Poisson
+    counts following two waves, with occasional downward corrections"""
+
+    t = np.arange(n_days)
+    wave = 1 + 0.8 * np.sin(t / 60) + 0.6 * np.exp(-((t - 0.7 * n_days) / 40) ** 2)
+    rate = counties['population'].to_numpy()[:, np.newaxis] * 2e-4 * wave
+    new_cases = rng.poisson(rate)
+    new_deaths = rng.poisson(new_cases * 0.01)
+
+    # reporting corrections make some daily changes negative (the pipeline clips them)
+    corrections = rng.random(new_cases.shape) < 0.001
+    new_cases[corrections] -= rng.integers(1, 20, corrections.sum())
+
+    return np.maximum(np.cumsum(new_cases, axis=1), 0), np.cumsum(new_deaths, axis=1)
+
+
+def write_jhu(path, counties, days, values, with_population=False):
+    """Writes a Johns Hopkins time series (one row per county, one 'm/d/yy' column per day)"""
+
+    info = pd.DataFrame({'UID': 84000000 + counties['fips'].astype(np.int64), 'iso2': 'US', 'iso3': 'USA', 'code3': 840,
+                         'FIPS': counties['fips'].astype(np.float64), 'Admin2': counties['county'],
+                         'Province_State': counties['state'], 'Country_Region': 'US',
+                         'Lat': counties['lat'], 'Long_': counties['long'],
+                         'Combined_Key': counties['county'] + ', ' + counties['state'] + ', US'})
+    if with_population:
+        info['Population'] = counties['population']
+    table = pd.concat([info, pd.DataFrame(values, columns=[case_store.format_date(day) for day in days])], axis=1)
+
+    # rows without a FIPS code (e.g. 'Unassigned') are in the real file too
+    unassigned = table.iloc[:1].copy()
+    unassigned['FIPS'] = np.nan
+    unassigned['Admin2'] = 'Unassigned'
+    pd.concat([table, unassigned]).to_csv(path, index=False)
+
+
+def write_nytimes(directory, counties, days, cases, deaths):
+    """Writes one NY Times style long file (date, county, state, fips, cases, deaths) per year"""
+
+    years = np.array([day.year for day in days])
+    for year in np.unique(years):
+        columns = np.flatnonzero(years == year)
+        n = len(counties)
+        table = pd.DataFrame({'date': np.repeat([days[i].isoformat() for i in columns], n),
+                              'county': np.tile(counties['county'].to_numpy(), len(columns)),
+                              'state': np.tile(counties['state'].to_numpy(), len(columns)),
+                              'fips': np.tile(counties['fips'].to_numpy(), len(columns)),
+                              'cases': cases[:, columns].T.ravel(),
+                              'deaths': deaths[:, columns].T.ravel()})
+        table.to_csv(os.path.join(directory, 'us-counties-{}.csv'.format(year)), index=False)
+
+
+def write_adjacency(path, counties):
+    """Writes the county adjacency list of the grid (right, lower and diagonal neighbours)"""
+
+    width = int(np.ceil(np.sqrt(len(counties) * 1.6)))
+    node = np.arange(len(counties))
+    row, col = np.divmod(node, width)
+    pairs = []
+    for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        neighbour = node + d_row * width + d_col
+        keep = (neighbour < len(counties)) & (col + d_col >= 0) & (col + d_col < width)
+        pairs.append(np.column_stack([node[keep], neighbour[keep]]))
+    pairs = np.vstack(pairs)
+
+    a, b = counties.iloc[pairs[:, 0]].reset_index(drop=True), counties.iloc[pairs[:, 1]].reset_index(drop=True)
+    lat1, lon1, lat2, lon2 = (np.radians(column.to_numpy()) for column in (a['lat'], a['long'], b['lat'], b['long']))
+    km = 2 * 6371 * np.arcsin(np.sqrt(np.sin((lat2 - lat1) / 2) ** 2
+                                      + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2))
+
+    pd.DataFrame({'county_name': a['county'], 'county_state': a['state'], 'county_fips': a['fips'],
+                  'bcounty_name': b['county'], 'bcounty_state': b['state'], 'bcounty_fips': b['fips'],
+                  'county_combined': a['fips'].astype(np.int64) * 100000 + b['fips'],
+                  'gc_dist_km': km.round(1), 'd_dist_km': (km * 1.3).round(1),
+                  'duration_min': (km * 1.3 / 1.4).round().astype(np.int64)}).to_csv(path, index=False)
+
+
+def make_fixtures(directory, n_days, n_counties=3300, seed=0):
+    """Writes deterministic synthetic versions of every source file the
+    pipeline and the dashboard read, for n_days days from 1/1/21
+
+    Parameters
+    ----------
+    directory: str
+        Where the files are written (used as data_sources.LOCAL_DIR)
+    n_days: int
+        Number of days from 1/1/21 (the Johns Hopkins files start on 1/22/20 like the real ones)
+    n_counties: int, optional
+        Number of counties (default is 3300)
+    seed: int, optional
+        Random seed (default is 0)
+
+    Returns
+    -------
+    start_date, end_date: str
+        The benchmarked range ('m/d/yy')
+    """
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    counties = synthetic_counties(n_counties, rng)
+    end = FIRST_DAY + timedelta(days=n_days - 1)
+    days = [JHU_FIRST_DAY + timedelta(days=d) for d in range((end - JHU_FIRST_DAY).days + 1)]
+    cases, deaths = synthetic_cumulative(counties, len(days), rng)
+
+    counties.to_csv(os.path.join(directory, 'county_info.csv'), index=False)
+    with_key = counties.assign(combined_key=counties['county'] + ', ' + counties['state'])
+    with_key.to_csv(os.path.join(directory, 'county_info_with_key.csv'), index=False)
+
+    clusters = counties.assign(fips=counties['fips'].map('{:0>5}'.format))
+    for k in range(2, 21):
+        clusters['clusters_{}'.format(k)] = rng.integers(1, k + 1, len(counties))
+    clusters.to_csv(os.path.join(directory, 'Counties_clustered.csv'))
+
+    # Johns Hopkins reports the MISSING_FIPS counties as 0, the NY Times has their real counts
+    missing = counties['fips'].isin(MISSING_FIPS).to_numpy()
+    write_jhu(os.path.join(directory, 'time_series_covid19_confirmed_US.csv'), counties, days,
+              np.where(missing[:, np.newaxis], 0, cases))
+    write_jhu(os.path.join(directory, 'time_series_covid19_deaths_US.csv'), counties, days,
+              np.where(missing[:, np.newaxis], 0, deaths), with_population=True)
+    write_nytimes(directory, counties, days, cases, deaths)
+    write_adjacency(os.path.join(directory, 'adj_dist_all_final.csv'), counties)
+
+    # the published active case table (monthly partitions and the CSV export)
+    active = active_window(daily_diff(cases), 10)[:, -n_days:].astype(np.int32)
+    table_counties = counties.astype({'fips': np.uint32, 'population': np.int32})
+    partitions.write_partitions(table_counties, pd.date_range(FIRST_DAY, periods=n_days), active, directory)
+    partitions.to_output_csv(partitions.join_table(table_counties, pd.date_range(FIRST_DAY, periods=n_days), active),
+                             os.path.join(directory, 'active_cases.csv'))
+
+    return case_store.format_date(FIRST_DAY), case_store.format_date(end)
+
+
+def use_fixtures(directory):
+    """Points every data source and on-disk cache at a fixture directory (no network)"""
+
+    cache = os.path.join(directory, 'cache')
+    data_sources.LOCAL_DIR = directory
+    data_sources.OFFLINE = True
+    data_sources.CACHE_DIR = os.path.join(cache, 'http')
+    case_store.STORE_DIR = os.path.join(cache, 'store')
+    covid_data.NYT_CACHE_DIR = os.path.join(cache, 'nytimes')
+    distance_index.INDEX_FILE = os.path.join(cache, 'distance_index.npz')
+    shared_data.SHARED_DIR = None
+
+
+# ------------------------------------------------------------------------------
+# Measurements
+
+def ignore_setting_with_copy():
+    """Ignores the chained-assignment warnings of pandas (inside warnings.catch_warnings)"""
+
+    if SETTING_WITH_COPY is not None:
+        warnings.simplefilter('ignore', SETTING_WITH_COPY)
+
+
+def measure(function, repeat):
+    """Returns the median time of repeat calls of function and the peak memory
+    allocated by one call (the first, untimed call fills any on-disk cache)"""
+
+    function()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': float(np.median(times)), 'peak_mb': peak / 2 ** 20}
+
+
+def pipeline_stages(start_date, end_date):
+    """Returns the pipeline stages to measure, as name -> function"""
+
+    county_info = covid_data.read_county_info()
+    fips = county_info['fips'].to_numpy(dtype=np.uint32)
+    lookback = covid_data.lookback_date(start_date, 10)
+
+    cumulative = covid_data.get_cumulative(lookback, end_date, fips, 'confirmed')
+    store = case_store.open_case_store('confirmed', end_date)
+    window = store.slice(lookback, end_date, fips)
+    scan = data_quality.scan_store(store)
+    daily = covid_data.get_daily_diff(cumulative)
+    active = covid_data.get_active_cases(daily)
+
+    return {'build_case_store': lambda: case_store.build_case_store('confirmed'),
+            'get_cumulative': lambda: covid_data.get_cumulative(lookback, end_date, fips, 'confirmed'),
+            'detect_anomalies': lambda: data_quality.detect_anomalies(store.matrix),
+            'repair_flagged': lambda: covid_data.repair_flagged(window, scan, 'confirmed'),
+            'get_daily_diff': lambda: covid_data.get_daily_diff(cumulative),
+            'get_active_cases': lambda: covid_data.get_active_cases(daily),
+            'scale_by_pop': lambda: covid_data.scale_by_pop(active, county_info),
+            'get_covid_cases': lambda: covid_data.get_covid_cases(start_date, end_date, county_info=county_info),
+            'get_covid_cases_batch': lambda: covid_data.get_covid_cases_batch(start_date, end_date)}
+
+
+def dashboard_stages(end_date):
+    """Returns the dashboard loads and callbacks to measure, as name -> function
+    (callbacks are called without the callback cache)"""
+
+    import DashboardApp
+
+    # every dataset is loaded again from the current fixtures
+    for loader in (DashboardApp.get_shared_data, DashboardApp.get_case_matrix, DashboardApp.get_df_edges,
+                   DashboardApp.get_routing_engine, DashboardApp.get_distance_index, DashboardApp.get_df_clusters):
+        loader.cache_clear()
+
+    county_from = '{:0>5}'.format(DashboardApp.df_counties['fips'].iloc[0])
+    county_to = '{:0>5}'.format(DashboardApp.df_counties['fips'].iloc[-1])
+    day = case_store.parse_date(end_date).isoformat()
+
+    return {'load_case_matrix': DashboardApp.load_case_matrix,
+            'update_graph': lambda: DashboardApp.update_graph.uncached(county_from, county_to, day),
+            'day_layer': lambda: DashboardApp.day_layer.uncached(day),
+            'apply_clustering': lambda: DashboardApp.apply_clustering.uncached(3)}
+
+
+def run(sizes, n_counties=3300, repeat=5, fixtures_dir=None, stages=None, log=print):
+    """Generates the fixtures of every size and measures every stage on them
+
+    Parameters
+    ----------
+    sizes: list
+        Numbers of days to benchmark
+    n_counties: int, optional
+        Number of synthetic counties (default is 3300)
+    repeat: int, optional
+        Timed calls per stage (default is 5)
+    fixtures_dir: str, optional
+        Where the fixtures are kept (default is None, in which case a temporary
+        directory is used and removed afterwards)
+    stages: list, optional
+        Names of the stages to run (default is None, all of them)
+    log: callable, optional
+        Receives a progress line per measured stage (default is print)
+
+    Returns
+    -------
+    results: dict
+        {'stage/days': {'seconds': median seconds, 'peak_mb': peak MB}}
+    """
+
+    root = fixtures_dir or tempfile.mkdtemp(prefix='mda-benchmark-')
+    results = {}
+    try:
+        for n_days in sizes:
+            directory = os.path.join(root, '{}c-{}d'.format(n_counties, n_days))
+            start_date, end_date = make_fixtures(directory, n_days, n_counties)
+            use_fixtures(directory)
+
+            with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                ignore_setting_with_copy()
+                todo = dict(pipeline_stages(start_date, end_date), **dashboard_stages(end_date))
+
+            for name, function in todo.items():
+                if stages is not None and name not in stages:
+                    continue
+                with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                    ignore_setting_with_copy()
+                    result = measure(function, repeat)
+                results['{}/{}'.format(name, n_days)] = result
+                log('{:<24} {:>5} days {:>10.1f} ms {:>9.1f} MB'.format(name, n_days, result['seconds'] * 1e3,
+                                                                     result['peak_mb']))
+    finally:
+        if fixtures_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.5, memory_tolerance=0.5):
+    """Returns a description of every result that regressed past the baseline
+
+    A time regresses when it is more than (1 + tolerance) times the baseline
+    (and at least MIN_SECONDS slower); peak memory likewise with memory_tolerance
+    and MIN_MB. Stages missing from the baseline are not checked.
+    """
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if (result['seconds'] > base['seconds'] * (1 + tolerance)
+                and result['seconds'] - base['seconds'] > MIN_SECONDS):
+            regressions.append('{}: {:.1f} ms (baseline {:.1f} ms)'.format(key, result['seconds'] * 1e3,
+                                                                          base['seconds'] * 1e3))
+        if (result['peak_mb'] > base['peak_mb'] * (1 + memory_tolerance)
+                and result['peak_mb'] - base['peak_mb'] > MIN_MB):
+            regressions.append('{}: {:.1f} MB peak (baseline {:.1f} MB)'.format(key, result['peak_mb'],
+                                                                               base['peak_mb']))
+    return regressions
+
+
+def environment():
+    """Returns the versions the results were measured with"""
+
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor() or platform.machine()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages and dashboard callbacks '
+                                                 'on synthetic data and check them against a baseline')
+    parser.add_argument('--days', type=int, nargs='+', default=[90, 365, 730],
+                        help='numbers of days to benchmark (default is 90 365 730)')
+    parser.add_argument('--counties', type=int, default=3300, help='number of counties (default is 3300)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per stage (default is 5)')
+    parser.add_argument('--stages', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--fixtures', default=None,
+                        help='directory to keep the generated fixtures in (default is a temporary directory)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file (default is benchmark_baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown as a fraction of the baseline time (default is 0.5)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.5,
+                        help='allowed peak memory growth as a fraction of the baseline (default is 0.5)')
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    measured = run(args.days, args.counties, args.repeat, args.fixtures, args.stages)
+    report = {'environment': environment(), 'counties': args.counties, 'repeat': args.repeat, 'results': measured}
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Saved baseline to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored.get('counties') != args.counties:
+            print('Baseline was measured with {} counties, not checking'.format(stored.get('counties')))
+            sys.exit(0)
+        failed = compare(measured, stored['results'], args.tolerance, args.memory_tolerance)
+        if failed:
+            print('Regressions against {}:'.format(args.baseline))
+            for line in failed:
+                print('  ' + line)
+            sys.exit(1)
+        print('No regressions against {}'.format(args.baseline))
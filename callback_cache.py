@@ -0,0 +1,194 @@
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+# results kept in memory per process
+DEFAULT_MAXSIZE = int(os.environ.get('MDA_CALLBACK_CACHE_SIZE', 64))
+
+# optional directory where results are also written, so every worker (and restart) can reuse them
+DEFAULT_DIRECTORY = os.environ.get('MDA_CALLBACK_CACHE_DIR')
+
+# marks a miss (None is a valid cached result)
+_missing = object()
+
+
+class CallbackCache:
+    """Bounded LRU cache of callback results with an optional on-disk layer
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        Number of results kept in memory; the least recently used one is
+        dropped first (default is MDA_CALLBACK_CACHE_SIZE or 64)
+    directory: str, optional
+        Directory where results are pickled (default is MDA_CALLBACK_CACHE_DIR,
+        or None, in which case nothing is written to disk)
+    max_files: int, optional
+        Number of results kept on disk; the oldest files are removed first
+        (default is 1024)
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, directory=DEFAULT_DIRECTORY, max_files=1024):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_files = max_files
+        self.hits = self.disk_hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl')
+
+    def get(self, key, default=None):
+        """Returns the cached result of key (or default), looking in memory first and then on disk"""
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                self._remember(key, value)
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """Stores the result of key in memory (and on disk if a directory is set)"""
+
+        self._remember(key, value)
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+
+            # unique temporary name, so workers writing the same key don't clash
+            tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._trim_directory()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _trim_directory(self):
+        """Removes the oldest result files once there are more than max_files"""
+
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.pkl')]
+        if len(files) <= self.max_files:
+            return
+
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Removes all results from memory and disk"""
+
+        with self._lock:
+            self._entries.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.pkl'):
+                    os.remove(entry.path)
+
+    def claim(self, key, timeout):
+        """Marks key as being computed by this process, so other workers wait
+        for its result instead of computing it too
+
+        Returns True if the claim was taken (always without a directory), False
+        if another process holds a claim younger than timeout seconds.
+        """
+
+        if self.directory is None:
+            return True
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key) + '.claim'
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+
+        # a claim left by a worker that died is taken over
+        try:
+            if os.stat(path).st_mtime > time.time() - timeout:
+                return False
+            os.utime(path)
+        except FileNotFoundError:
+            return self.claim(key, timeout)
+        return True
+
+    def is_claimed(self, key):
+        """Returns True if some process is computing key"""
+
+        return self.directory is not None and os.path.exists(self._path(key) + '.claim')
+
+    def release(self, key):
+        """Removes the claim on key (after its result was stored, or its computation failed)"""
+
+        if self.directory is not None:
+            try:
+                os.remove(self._path(key) + '.claim')
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Returns the number of memory hits, disk hits and misses so far"""
+
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'entries': len(self._entries)}
+
+    def memoize(self, name, version=None):
+        """Decorator caching a function's results under (name, version, *args)
+
+        Parameters
+        ----------
+        name: str
+            Distinguishes the results of different functions
+        version: callable, optional
+            Returns the version of the data the results depend on (e.g. the
+            latest date of a dataset), so results of older data aren't reused
+        """
+
+        def decorator(function):
+            def cache_key(*args):
+                return (name, version() if version is not None else None) + args
+
+            @functools.wraps(function)
+            def wrapper(*args):
+                key = cache_key(*args)
+                value = self.get(key, _missing)
+                if value is _missing:
+                    value = function(*args)
+                    self.put(key, value)
+                return value
+
+            wrapper.uncached = function
+            wrapper.key = cache_key
+            return wrapper
+
+        return decorator
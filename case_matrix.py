@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import data_sources
+import instrumentation
+import partitions
+from covid_data import COUNTY_DTYPES
+
+
+class CaseMatrix:
+    """Active cases held as a dense fips x day matrix
+
+    A day (one column) and a county's time series (one row) are both
+    returned as views found through hash lookups, so neither depends on the
+    size of the table.
+
+    Parameters
+    ----------
+    counties: dataframe
+        One row per county (fips, county, state, lat, long, population), in matrix row order
+    dates: DatetimeIndex
+        The day of every matrix column
+    values: numpy array
+        (n_counties, n_days) active cases (int32, or float32 if some are missing)
+    """
+
+    def __init__(self, counties, dates, values):
+        self.counties = counties.reset_index(drop=True)
+        self.fips = self.counties['fips'].to_numpy()
+        self.dates = pd.DatetimeIndex(dates)
+        self.values = values
+
+        # fips -> row and date -> column lookups
+        self.rows = pd.Index(self.fips)
+
+        # presentation forms of the keys (5-digit FIPS as used by the map, ISO dates)
+        self.fips_labels = np.array(['{:0>5}'.format(code) for code in self.fips.tolist()], dtype=object)
+        self.date_labels = self.dates.strftime('%Y-%m-%d')
+
+    @property
+    def last_date(self):
+        """Returns the latest day of the matrix as YYYY-MM-DD"""
+
+        return self.date_labels[-1]
+
+    def has_day(self, date_value):
+        """Returns True if the matrix has a column for the day"""
+
+        try:
+            self.day_index(date_value)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def day_index(self, date_value):
+        """Returns the column of a day (YYYY-MM-DD string, date or timestamp)"""
+
+        return self.dates.get_loc(pd.Timestamp(date_value).normalize())
+
+    def day(self, date_value):
+        """Returns the active cases of every county on a day (in row order)"""
+
+        return self.values[:, self.day_index(date_value)]
+
+    def row(self, fips):
+        """Returns the matrix row of a county"""
+
+        return self.rows.get_loc(fips)
+
+    def series(self, fips):
+        """Returns the active cases of a county on every day"""
+
+        return self.values[self.row(fips)]
+
+
+@instrumentation.timed()
+def build_case_matrix(df_active, first_date_column=6):
+    """Returns the case matrix of a wide active case table
+
+    Parameters
+    ----------
+    df_active: dataframe
+        Table as written by main.py: county columns followed by one dMMDDYYYY column per day
+    first_date_column: int, optional
+        Position of the first day column (default is 6)
+
+    Returns
+    -------
+    matrix: CaseMatrix
+        The same cases as a matrix with date and fips indexes
+    """
+
+    date_columns = df_active.columns[first_date_column:]
+    dates = pd.to_datetime(date_columns, format='d%m%d%Y')
+
+    # counts are whole numbers, so int32 holds them unless some are missing
+    values = df_active[date_columns].to_numpy(dtype=np.float32)
+    if not np.isnan(values).any():
+        values = values.astype(np.int32)
+    return CaseMatrix(df_active.iloc[:, :first_date_column], dates, values)
+
+
+@instrumentation.timed()
+def load_case_matrix(first_month='2021-01', county_columns=('fips', 'county', 'population')):
+    """Returns the case matrix of the published active cases
+
+    Only the partitions from first_month on and the given county columns are
+    read; if no partitions are published (or they can't be reached) the
+    active_cases.csv export is read instead.
+    """
+
+    try:
+        return CaseMatrix(*partitions.read_partitions(first_month=first_month, county_columns=list(county_columns)))
+    except OSError:
+        return build_case_matrix(data_sources.read_csv('active_cases', dtype=COUNTY_DTYPES))
@@ -0,0 +1,282 @@
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import data_sources
+import instrumentation
+from datetime import date, datetime, timedelta
+
+
+# default location of the on-disk case store (one matrix + index per case type)
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'cache', 'store')
+
+
+def parse_date(date_str):
+    """Returns a date object for a date string in the Johns Hopkins format
+
+    Parameters
+    ----------
+    date_str : str
+        A date in the format 'm/d/yy' (e.g. '1/1/21')
+
+    Returns
+    -------
+    day: date
+        The corresponding date object
+    """
+
+    month, day, year = date_str.split('/')
+    return date(2000 + int(year) % 100, int(month), int(day))
+
+
+def format_date(day):
+    """Returns a date string in the Johns Hopkins format ('m/d/yy')
+
+    Parameters
+    ----------
+    day : date
+        The date to format
+
+    Returns
+    -------
+    date_str: str
+        The date in the format 'm/d/yy' (e.g. '1/1/21')
+    """
+
+    return str(day.month) + '/' + str(day.day) + '/' + str(day.year)[-2:]
+
+
+# times a reader re-reads the index when the matrix it names was removed meanwhile
+LOAD_ATTEMPTS = 3
+
+
+def _store_paths(type_cases, store_dir=None):
+    """Returns the directory of the store and the path of the index of a case type"""
+
+    # STORE_DIR is looked up on every call, so it can be pointed elsewhere (e.g. by benchmark.py)
+    directory = STORE_DIR if store_dir is None else store_dir
+    return directory, os.path.join(directory, type_cases + '.json')
+
+
+def _read_index(index_path):
+    """Returns the index of a store (None if there is none)"""
+
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def source_version(source):
+    """Returns what identifies the contents of a source file: its absolute path,
+    modification time and size (data_sources only replaces a cached copy when
+    the server sends a new one, so the mtime changes exactly then)"""
+
+    if not os.path.exists(source):
+        return {'path': source}
+    info = os.stat(source)
+    return {'path': os.path.abspath(source), 'mtime': info.st_mtime, 'size': info.st_size}
+
+
+@instrumentation.timed()
+def build_case_store(type_cases='confirmed', store_dir=None, source=None):
+    """Ingests the Johns Hopkins time series once and writes it to disk as a
+    fips x day int32 matrix with a small JSON sidecar index
+
+    Parameters
+    ----------
+    type_cases : str, optional
+        Choice of COVID cases ('confirmed') or deaths ('deaths') to be stored
+    store_dir : str, optional
+        Directory the store is written to (default is None, in which case
+        STORE_DIR is used: Data/cache/store)
+    source : str, optional
+        Path or URL of the Johns Hopkins time series file (default is None,
+        in which case the file comes from the 'jhu' data source)
+
+    Returns
+    -------
+    store: CaseStore
+        The freshly built case store
+    """
+
+    if source is None:
+        source = data_sources.fetch('jhu', type_cases=type_cases)
+    covid_data = pd.read_csv(source)
+
+    # fill in missing FIPS with 0s (these rows are dropped, they are not counties)
+    covid_data['FIPS'] = covid_data['FIPS'].fillna(0).astype(np.int64)
+    covid_data = covid_data[covid_data['FIPS'] > 0]
+
+    # date columns are all columns that parse as 'm/d/yy', in order
+    date_cols = [col for col in covid_data.columns if col.count('/') == 2]
+    first_day = parse_date(date_cols[0])
+
+    values = covid_data[date_cols].to_numpy(dtype=np.int64)
+    values = np.clip(values, np.iinfo(np.int32).min, np.iinfo(np.int32).max).astype(np.int32)
+    fips = covid_data['FIPS'].to_numpy()
+
+    directory, index_path = _store_paths(type_cases, store_dir)
+    os.makedirs(directory, exist_ok=True)
+    previous = _read_index(index_path) or {}
+
+    # every build writes its own matrix file and the index naming it is replaced
+    # last, so readers always get a matrix and an index of the same build
+    matrix_file = '{}-{}-{}-{}.int32'.format(type_cases, time.strftime('%Y%m%d%H%M%S'), os.getpid(),
+                                             os.urandom(3).hex())
+    matrix = np.memmap(os.path.join(directory, matrix_file), dtype=np.int32, mode='w+', shape=values.shape)
+    matrix[:] = values
+    matrix.flush()
+    del matrix
+    index = {'type_cases': type_cases,
+             'matrix': matrix_file,
+             'first_day': first_day.isoformat(),
+             'n_days': len(date_cols),
+             'fips': fips.tolist(),
+             'built': datetime.now().isoformat(timespec='seconds'),
+             'source': source_version(source)}
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+    # the previous build's matrix is kept until the next build, for readers that
+    # read the old index just before it was replaced; older ones are removed
+    kept = {matrix_file, previous.get('matrix')}
+    for entry in os.scandir(directory):
+        if (entry.name.startswith(type_cases) and entry.name.endswith('.int32') and entry.name not in kept
+                and entry.name[len(type_cases)] in '.-'):
+            os.remove(entry.path)
+
+    return CaseStore(type_cases, store_dir)
+
+
+class CaseStore:
+    """Read-only, memory-mapped view of the cumulative cases/deaths of every
+    county (rows keyed by FIPS, columns keyed by day index)"""
+
+    def __init__(self, type_cases='confirmed', store_dir=None):
+        directory, index_path = _store_paths(type_cases, store_dir)
+        for attempt in range(LOAD_ATTEMPTS):
+            index = _read_index(index_path)
+            try:
+                matrix = np.memmap(os.path.join(directory, index['matrix']), dtype=np.int32, mode='r',
+                                   shape=(len(index['fips']), index['n_days']))
+                break
+            except FileNotFoundError:
+                # rebuilt twice since the index was read: read the new one
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+
+        self.type_cases = type_cases
+        self.first_day = date.fromisoformat(index['first_day'])
+        self.n_days = index['n_days']
+        self.built = datetime.fromisoformat(index['built'])
+        self.source = index.get('source')
+        self.fips = np.array(index['fips'], dtype=np.uint32)
+        self.matrix = matrix
+
+        # map FIPS -> row (the first occurrence wins if a FIPS is ever duplicated)
+        self.rows = {}
+        for row, code in enumerate(self.fips.tolist()):
+            self.rows.setdefault(code, row)
+
+    @property
+    def last_day(self):
+        return self.first_day + timedelta(days=self.n_days - 1)
+
+    def day_index(self, day):
+        """Returns the column index of a date (date object or 'm/d/yy' string)"""
+
+        if isinstance(day, str):
+            day = parse_date(day)
+        return (day - self.first_day).days
+
+    def covers(self, start_date, end_date):
+        """Returns True if every date between start_date and end_date is stored"""
+
+        return self.day_index(start_date) >= 0 and self.day_index(end_date) < self.n_days
+
+    def row_indices(self, county_fips):
+        """Returns the matrix rows of the given county FIPS (unknown FIPS are skipped)"""
+
+        codes = np.asarray(county_fips).astype(np.int64)
+        return np.array([self.rows[c] for c in codes.tolist() if c in self.rows], dtype=np.int64)
+
+    @instrumentation.timed('case_store.CaseStore.slice')
+    def slice(self, start_date, end_date, county_fips=None):
+        """Returns the cumulative counts between two dates (inclusive) as a
+        dataframe in the Johns Hopkins layout ('fips' + one 'm/d/yy' column per day)
+
+        Parameters
+        ----------
+        start_date : str
+            The first date that cases/deaths should be reported for
+        end_date : str
+            The last date that cases/deaths should be reported for
+        county_fips: numpy array, optional
+            Array of county FIPS to report (default is None and all counties
+            get reported)
+
+        Returns
+        -------
+        covid_data: dataframe
+            a dataframe of specified counties (uint32 FIPS) in the specified
+            time frame with COVID cumulative cases or deaths (int32)
+        """
+
+        first = max(self.day_index(start_date), 0)
+        last = min(self.day_index(end_date), self.n_days - 1)
+
+        if county_fips is None:
+            rows = np.arange(len(self.fips))
+        else:
+            rows = self.row_indices(county_fips)
+
+        # fancy indexing only touches the pages of the requested rows/days
+        values = np.asarray(self.matrix[rows, first:last + 1])
+        days = [format_date(self.first_day + timedelta(days=d)) for d in range(first, last + 1)]
+
+        covid_data = pd.DataFrame(values, columns=days)
+        covid_data.insert(0, 'fips', self.fips[rows])
+
+        return covid_data
+
+
+@instrumentation.timed()
+def open_case_store(type_cases='confirmed', end_date=None, store_dir=None, source=None):
+    """Returns the on-disk case store, ingesting the Johns Hopkins file only if
+    the store does not exist yet or was built from another version of the file
+
+    Parameters
+    ----------
+    type_cases : str, optional
+        Choice of COVID cases ('confirmed') or deaths ('deaths')
+    end_date : str, optional
+        Last date ('m/d/yy') the caller needs (unused: the store always holds
+        every date of the current source file, which is refreshed by
+        data_sources once its TTL has passed)
+    store_dir : str, optional
+        Directory of the store (default is None, in which case STORE_DIR is used)
+    source : str, optional
+        Path or URL of the Johns Hopkins file (default is None, in which case
+        the file comes from the 'jhu' data source)
+
+    Returns
+    -------
+    store: CaseStore
+        A case store matching the current source file
+    """
+
+    if source is None:
+        source = data_sources.fetch('jhu', type_cases=type_cases)
+
+    # the store is reused as long as the source it was built from hasn't changed
+    # (revised past values, a different source and an index from before
+    # build-specific matrix files all trigger a rebuild)
+    index = _read_index(_store_paths(type_cases, store_dir)[1])
+    if index is not None and 'matrix' in index and index.get('source') == source_version(source):
+        return CaseStore(type_cases, store_dir)
+
+    return build_case_store(type_cases, store_dir, source)
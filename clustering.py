@@ -0,0 +1,264 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+from threadpoolctl import threadpool_limits
+import instrumentation
+from case_matrix import load_case_matrix
+from covid_data import COUNTY_DTYPES
+
+
+# the cluster labels read by the dashboard (one clusters_<k> column per number of clusters)
+OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'Counties_clustered.csv')
+
+# numbers of clusters offered by the dashboard
+K_RANGE = range(1, 21)
+
+# the representation chosen in TS_Clust.ipynb: robust-scaled county series reduced to 3 principal components
+N_COMPONENTS = 3
+MAX_ITER = 5000
+
+# random restarts of a cold fit (a warm-started fit runs once, from the previous clusters)
+N_INIT = 10
+
+COUNTY_COLUMNS = ('fips', 'county', 'state', 'lat', 'long', 'population')
+
+
+def robust_scale(values):
+    """Returns every county's time series centered on its median and divided
+    by its interquartile range (RobustScaler applied per county, in one step)
+
+    Missing days are ignored by the statistics and then set to the median.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    median = np.nanmedian(values, axis=1, keepdims=True)
+    q25, q75 = np.nanpercentile(values, [25, 75], axis=1, keepdims=True)
+
+    # a constant series is only centered, as RobustScaler does
+    scale = q75 - q25
+    scale[scale == 0] = 1
+    return np.nan_to_num((values - median) / scale)
+
+
+@instrumentation.timed()
+def embed(values, n_components=N_COMPONENTS, seed=0):
+    """Returns the (n_counties, n_components) PCA representation of the robust-scaled series"""
+
+    return PCA(n_components=n_components, random_state=seed).fit_transform(robust_scale(values))
+
+
+def warm_start_centroids(embedding, previous, k, seed=0):
+    """Returns initial centroids for k clusters: the mean of every previous
+    cluster in the current embedding
+
+    Parameters
+    ----------
+    embedding: numpy array
+        (n_counties, n_components) representation of the counties
+    previous: numpy array
+        Previous label (0 to k-1) of every county, -1 for counties that had none
+    k: int
+        Number of clusters
+    seed: int, optional
+        Seed of the counties picked for previous clusters that are now empty
+
+    Returns
+    -------
+    centroids: numpy array
+        (k, n_components) initial centroids
+    """
+
+    known = previous >= 0
+    counts = np.bincount(previous[known], minlength=k)
+    sums = np.stack([np.bincount(previous[known], weights=embedding[known, dim], minlength=k)
+                     for dim in range(embedding.shape[1])], axis=1)
+
+    centroids = sums / np.maximum(counts, 1)[:, None]
+    empty = np.flatnonzero(counts == 0)
+    if len(empty):
+        rng = np.random.default_rng(seed)
+        centroids[empty] = embedding[rng.choice(len(embedding), size=len(empty), replace=False)]
+    return centroids
+
+
+def match_labels(labels, previous, k):
+    """Renumbers labels so that they agree with previous labels on as many
+    counties as possible (a cluster keeps its number when new days arrive)
+
+    Parameters
+    ----------
+    labels: numpy array
+        New label (0 to k-1) of every county
+    previous: numpy array
+        Previous label (0 to k-1) of every county, -1 for counties that had none
+    k: int
+        Number of clusters
+
+    Returns
+    -------
+    labels: numpy array
+        The same clusters, renumbered
+    """
+
+    known = previous >= 0
+    overlap = np.bincount(labels[known] * k + previous[known], minlength=k * k).reshape(k, k)
+    new, old = linear_sum_assignment(overlap, maximize=True)
+
+    mapping = np.empty(k, dtype=labels.dtype)
+    mapping[new] = old
+    return mapping[labels]
+
+
+def _fit(embedding, k, init, seed):
+    # one KMeans per process, so each keeps to one thread instead of competing for every core
+    with threadpool_limits(limits=1):
+        if init is None:
+            model = KMeans(n_clusters=k, n_init=N_INIT, max_iter=MAX_ITER, random_state=seed)
+        else:
+            model = KMeans(n_clusters=k, init=init, n_init=1, max_iter=MAX_ITER, random_state=seed)
+        model.fit(embedding)
+    return model.labels_, model.inertia_, model.n_iter_
+
+
+@instrumentation.timed()
+def cluster_sweep(embedding, ks=K_RANGE, previous=None, max_workers=None, seed=0):
+    """Clusters the counties with KMeans for every number of clusters in ks,
+    fitting the different numbers of clusters in parallel processes
+
+    Parameters
+    ----------
+    embedding: numpy array
+        (n_counties, n_components) representation of the counties (see embed)
+    ks: iterable, optional
+        Numbers of clusters (default is 1 to 20)
+    previous: dict, optional
+        k -> previous label (0 to k-1, -1 if unknown) of every county; these
+        clusterings are warm-started from the previous clusters and renumbered
+        to match them, the others are fitted from scratch (default is None)
+    max_workers: int, optional
+        Number of processes (default is None, one per core; 1 fits in this process)
+    seed: int, optional
+        Random seed of the fits
+
+    Returns
+    -------
+    labels: dict
+        k -> label (0 to k-1) of every county
+    inertia: dict
+        k -> sum of squared distances to the centroids (for the elbow curve)
+    """
+
+    previous = previous or {}
+    ks = list(ks)
+    inits = [warm_start_centroids(embedding, previous[k], k, seed) if k in previous else None for k in ks]
+
+    if max_workers == 1:
+        fits = [_fit(embedding, k, init, seed) for k, init in zip(ks, inits)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            fits = list(executor.map(_fit, [embedding] * len(ks), ks, inits, [seed] * len(ks)))
+
+    labels, inertia = {}, {}
+    for k, (k_labels, k_inertia, _) in zip(ks, fits):
+        labels[k] = match_labels(k_labels, previous[k], k) if k in previous else k_labels
+        inertia[k] = k_inertia
+    return labels, inertia
+
+
+def read_clusters(path=OUTPUT_FILE):
+    """Returns the county cluster labels written by write_clusters (None if there is no file)"""
+
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, index_col=0, dtype=COUNTY_DTYPES)
+
+
+def previous_labels(df_clusters, fips, ks=K_RANGE):
+    """Returns k -> previous label (0 to k-1, -1 if unknown) of the counties
+    fips, for every k of ks with a clusters_<k> column in df_clusters"""
+
+    rows = pd.Index(df_clusters['fips'].to_numpy(dtype=np.uint32)).get_indexer(np.asarray(fips, dtype=np.uint32))
+    previous = {}
+    for k in ks:
+        column = 'clusters_{}'.format(k)
+        if column in df_clusters:
+            labels = df_clusters[column].to_numpy(dtype=np.int64)[rows] - 1
+            labels[(rows < 0) | (labels >= k)] = -1
+            previous[k] = labels
+    return previous
+
+
+@instrumentation.timed()
+def cluster_counties(matrix, previous=None, ks=K_RANGE, n_components=N_COMPONENTS, max_workers=None, seed=0):
+    """Returns the cluster labels of every county for every number of clusters
+
+    Parameters
+    ----------
+    matrix: CaseMatrix
+        Active cases of every county
+    previous: dataframe, optional
+        Labels of an earlier run (as returned by read_clusters) to warm-start
+        from and keep the cluster numbers of (default is None, a cold start)
+    ks: iterable, optional
+        Numbers of clusters (default is 1 to 20)
+    n_components: int, optional
+        Number of principal components clustered (default is 3)
+    max_workers: int, optional
+        Number of processes of the sweep (default is None, one per core)
+    seed: int, optional
+        Random seed of the fits
+
+    Returns
+    -------
+    df_clusters: dataframe
+        The county columns of matrix followed by one clusters_<k> column (labels 1 to k) per k
+    """
+
+    embedding = embed(matrix.values, n_components, seed)
+    if previous is not None:
+        previous = previous_labels(previous, matrix.fips, ks)
+    labels, _ = cluster_sweep(embedding, ks, previous, max_workers, seed)
+
+    columns = {'clusters_{}'.format(k): labels[k].astype(np.int32) + 1 for k in ks}
+    return pd.concat([matrix.counties, pd.DataFrame(columns)], axis=1)
+
+
+def write_clusters(df_clusters, path=OUTPUT_FILE):
+    """Writes the cluster labels (with 5-digit FIPS codes) in the layout the dashboard reads"""
+
+    df_clusters = df_clusters.copy()
+    df_clusters['fips'] = df_clusters['fips'].map('{:0>5}'.format)
+    df_clusters.to_csv(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cluster the counties by their active case time series')
+    parser.add_argument('--output', default=OUTPUT_FILE, help='where the labels are written '
+                                                              '(default is Data/Counties_clustered.csv)')
+    parser.add_argument('--previous', default=None,
+                        help='labels to warm-start from and keep the cluster numbers of (default is --output)')
+    parser.add_argument('--cold', action='store_true', help='ignore the previous labels and fit from scratch')
+    parser.add_argument('--max-k', type=int, default=K_RANGE[-1], help='largest number of clusters (default is 20)')
+    parser.add_argument('--components', type=int, default=N_COMPONENTS,
+                        help='number of principal components clustered (default is 3)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default is one per core)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the fits')
+    args = parser.parse_args()
+
+    instrumentation.configure_logging()
+    with instrumentation.span('clustering.run') as run:
+        cases = load_case_matrix(county_columns=COUNTY_COLUMNS)
+        earlier = None if args.cold else read_clusters(args.previous or args.output)
+        run.update(last_date=cases.last_date, warm_start=earlier is not None)
+
+        clusters = cluster_counties(cases, earlier, range(1, args.max_k + 1), args.components, args.workers,
+                                    args.seed)
+        write_clusters(clusters, args.output)
+    print('Wrote {} clusterings of {} counties up to {} to {}'.format(args.max_k, len(clusters), cases.last_date,
+                                                                      args.output))
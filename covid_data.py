@@ -1,9 +1,35 @@
+import hashlib
+import json
+import os
+import threading
 import pandas as pd
 import numpy as np
-from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import data_sources
+import instrumentation
+from case_store import format_date, open_case_store, parse_date, source_version
+from data_quality import scan_store
 
 
-def get_covid_cases(start_date, end_date=None, type_cases='confirmed', county_fips=None, scale=True):
+# parsed per-year NY Times files are cached here (see read_times_year)
+NYT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'cache', 'nytimes')
+
+# compact schema of the county tables: integer keys and categorical names
+# (FIPS codes are only written as 5-digit strings when output is presented)
+COUNTY_DTYPES = {'fips': np.uint32, 'county': 'category', 'state': 'category', 'population': np.int32}
+
+# metrics reported by get_covid_cases_batch by default: name -> (type_cases, scale)
+DEFAULT_METRICS = {'confirmed': ('confirmed', True), 'deaths': ('deaths', True)}
+
+# one lock per cached NY Times file, so concurrent readers parse each file only once
+_times_locks = {}
+_times_locks_guard = threading.Lock()
+
+
+@instrumentation.timed()
+def get_covid_cases(start_date, end_date=None, type_cases='confirmed', county_fips=None, scale=True,
+                    active_days=10, county_info=None):
     """Returns a dataframe specifying daily COVID active cases or COVID deaths
     scaled by population
 
@@ -22,58 +48,154 @@ def get_covid_cases(start_date, end_date=None, type_cases='confirmed', county_fi
         (default is None and all counties get reported)
     scale: bool, optional
         Indicates if data should be scaled by populations (default is True)
+    active_days: int, optional
+        Number of days a case counts as active (default is 10, only used
+        for 'confirmed')
+    county_info: dataframe, optional
+        Already loaded county information (default is None, in which case
+        it is read with read_county_info)
 
     Returns
     -------
     active: dataframe
-        a dataframe of specified counties in the specified time frame with
-        COVID active cases or deaths scaled by population (per 100,000 people)
+        a dataframe of specified counties (uint32 FIPS) in the specified time
+        frame with COVID active cases or deaths (int32) or the same scaled by
+        population (float32, per 100,000 people)
     """
 
     # if end date is not specified, assume we are looking for only one date
     if end_date is None:
         end_date = start_date
 
-    # since raw data contains cumulative cases/deaths, we must consider:
-    # when counting active cases, we consider 10 days prior (case is active for 10 days)
-    # when counting deaths, we only look at difference from the last day
-    days_behind = 10
-    if type_cases == 'deaths':
-        days_behind = 1
-
     # get a new start_date based on how many days prior we must look at
-    start_date_new = date(int('20' + start_date.split('/')[2]), int(start_date.split('/')[0]),
-                          int(start_date.split('/')[1])) - timedelta(days=days_behind)
-    start_date_new = str(start_date_new.month) + '/' + str(start_date_new.day) + '/' + str(start_date_new.year)[-2:]
+    start_date_new = lookback_date(start_date, days_behind(type_cases, active_days))
 
-    # get information on all potential counties from GitHub
-    county_info = pd.read_csv(
-        'https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/Data/county_info.csv')
-    county_info['fips'] = county_info['fips'].apply('{:0>5}'.format)
+    # get information on all potential counties
+    if county_info is None:
+        county_info = read_county_info()
 
     # if county FIPS are not specified, we consider all counties
     if county_fips is None:
         county_fips = county_info['fips'].unique()
+    county_fips = np.asarray(county_fips).astype(np.uint32)
 
-    # get cumulative and daily cases/deaths
+    # get cumulative cases/deaths and run all transforms on one fips x day array
     cumulative = get_cumulative(start_date_new, end_date, county_fips, type_cases)
-    daily = get_daily_diff(cumulative)
-    active = daily.copy()
+    fips = cumulative['fips'].to_numpy()
+    dates = cumulative.columns[1:]
+    values = daily_diff(cumulative[dates].to_numpy())
 
     # if counting cases (not deaths), we additionally get rolling sum over 10 days
     if type_cases == 'confirmed':
-        active = get_active_cases(daily)
+        values = active_window(values, active_days)
 
     # scale data by population
     if scale:
-        active = scale_by_pop(active, county_info)
+        values = scale_values(values, population_vector(fips, county_info))
+
+    active = pd.DataFrame(values, columns=dates[len(dates) - values.shape[1]:])
+    active.insert(0, 'fips', fips)
 
     # change FIPS of one DS county to match format for mapbox (used later for plotting)
-    # active.loc[active.fips == '46102', 'fips'] = '46113'
+    # active.loc[active.fips == 46102, 'fips'] = 46113
 
     return active
 
 
+@instrumentation.timed()
+def get_covid_cases_batch(start_date, end_date=None, metrics=None, county_fips=None, active_days=10,
+                          max_workers=None):
+    """Returns several case/death metrics at once, downloading and parsing
+    every input they need concurrently and only once
+
+    Parameters
+    ----------
+    start_date : str
+        The first date that cases/deaths should be reported for
+    end_date : str, optional
+        The last date that cases/deaths should be reported for (default is None,
+        in which case only the start_date gets reported)
+    metrics : dict, optional
+        Metrics to report, as name -> (type_cases, scale) (default is
+        DEFAULT_METRICS: scaled confirmed cases and scaled deaths)
+    county_fips: numpy array, optional
+        Array of county FIPS for which cases/deaths should be reported for
+        (default is None and all counties get reported)
+    active_days: int, optional
+        Number of days a case counts as active (default is 10)
+    max_workers: int, optional
+        Size of the thread pool (default is None, the executor default)
+
+    Returns
+    -------
+    results: dict
+        A dataframe per metric name, in the format returned by get_covid_cases
+    """
+
+    if end_date is None:
+        end_date = start_date
+    if metrics is None:
+        metrics = DEFAULT_METRICS
+
+    types = sorted({type_cases for type_cases, scale in metrics.values()})
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        # shared inputs: every source is fetched/parsed once, all at the same time
+        prefetch = [executor.submit(instrumentation.in_current_span(read_county_info))]
+        prefetch.extend(executor.submit(instrumentation.in_current_span(open_case_store), type_cases, end_date)
+                        for type_cases in types)
+
+        county_info = prefetch[0].result()
+        if county_fips is None:
+            county_fips = county_info['fips'].unique()
+        county_fips = np.asarray(county_fips).astype(np.uint32)
+
+        # the NY Times files are only needed for the counties and years the
+        # data-quality scan flagged in the range get_cumulative will read
+        backfill = []
+        for type_cases, future in zip(types, prefetch[1:]):
+            store = future.result()
+            window = store.slice(lookback_date(start_date, days_behind(type_cases, active_days)), end_date,
+                                 county_fips)
+            _, repair_fips, years = repair_plan(window, scan_store(store))
+            backfill.extend(executor.submit(instrumentation.in_current_span(read_times_year), year, repair_fips)
+                            for year in years)
+
+        # re-raise any download/parse error before computing
+        for future in prefetch + backfill:
+            future.result()
+
+        futures = {name: executor.submit(instrumentation.in_current_span(get_covid_cases), start_date, end_date,
+                                         type_cases, county_fips, scale, active_days, county_info)
+                   for name, (type_cases, scale) in metrics.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+
+def read_county_info():
+    """Returns the county information table with compact dtypes (uint32 FIPS,
+    categorical names, int32 population)"""
+
+    # from GitHub, through the local cache
+    return data_sources.read_csv('county_info', dtype=COUNTY_DTYPES)
+
+
+def days_behind(type_cases, active_days=10):
+    """Returns the number of days before the first reported date whose cumulative
+    counts are needed: active cases look back active_days (a case is active for
+    that long), deaths only need the previous day to take the difference"""
+
+    return 1 if type_cases == 'deaths' else active_days
+
+
+def lookback_date(start_date, days_behind):
+    """Returns the 'm/d/yy' date days_behind days before start_date"""
+
+    day = parse_date(start_date) - timedelta(days=days_behind)
+    return str(day.month) + '/' + str(day.day) + '/' + str(day.year)[-2:]
+
+
+@instrumentation.timed()
 def get_cumulative(start_date, end_date, county_fips, type_cases):
     """Returns a dataframe of cumulative COVID cases or deaths (collected from
     Johns Hopkins)
@@ -97,93 +219,234 @@ def get_cumulative(start_date, end_date, county_fips, type_cases):
         COVID cumulative cases or deaths
     """
 
-    # read raw data from johns Hopkins GitHub
-    url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/' \
-          'csse_covid_19_data/csse_covid_19_time_series/' \
-          'time_series_covid19_' + type_cases + '_US.csv'
-    covid_data = pd.read_csv(url)
-
-    # fill in missing FIPS with 0s and format to 5 digits
-    covid_data['FIPS'] = covid_data['FIPS'].fillna(0)
-    covid_data.FIPS = (covid_data.FIPS.astype(int)).astype(object)
-    covid_data['FIPS'] = covid_data['FIPS'].apply('{:0>5}'.format)
-    covid_data.rename(columns={'FIPS': 'fips'}, inplace=True)
-
-    # drop all dates and columns we don't need
-    covid_data = pd.concat([covid_data['fips'], covid_data.loc[:, start_date:end_date]], axis=1)
-
-    # only keep rows were FIPS matches one of the ones we want
-    covid_data = covid_data[covid_data['fips'].isin(county_fips)]
-
-    # from previous analysis, these are all the FIPS codes with missing/incorrect data
-    # these counties all have cases set to 0, when that is not actually true
-    missing_fips = np.array(['49001', '49003', '49005', '49007', '49009', '49013', '49015',
-                             '49017', '49019', '49021', '49023', '49025', '49027', '49029',
-                             '49031', '49033', '49039', '49041', '49047', '49053', '49055',
-                             '49057'], dtype=object)
-
-    # check if any of our counties of interest are in this set
-    missing_fips = np.intersect1d(missing_fips, county_fips)
-
-    # if so, fill in the missing data
-    if missing_fips.size != 0:
-        # drop these counties from the dataset temporarily
-        missing_counties = covid_data[covid_data['fips'].isin(missing_fips)]
-        covid_data.drop(covid_data.loc[covid_data['fips'].isin(missing_fips)].index, inplace=True)
-
-        # fill in the missing/incorrect data and merge back with the rest of the data set
-        missing_counties = fill_missing_vals(missing_counties, start_date, end_date, missing_fips, type_cases)
-        covid_data = pd.concat([covid_data, missing_counties], ignore_index=True)
-        covid_data.reset_index(inplace=True, drop=True)
+    # slice the requested dates and counties out of the local case store
+    # (the Johns Hopkins file is only downloaded and parsed when the store is out of date)
+    store = open_case_store(type_cases, end_date)
+    covid_data = store.slice(start_date, end_date, county_fips)
+
+    # replace the cells the data-quality scan of the store flagged (flat zeros,
+    # downward corrections, backlog spikes) with the NY Times counts; nothing is
+    # downloaded if none of the requested cells are flagged
+    scan = scan_store(store)
+    if scan.flags_like(covid_data).any():
+        covid_data = repair_flagged(covid_data, scan, type_cases)
 
     return covid_data
 
 
-def fill_missing_vals(missing_counties, start_date, end_date, missing_fips, type_cases):
-    """Returns a dataframe of cumulative COVID cases or deaths for only the
-    specified missing counties (collected from NY Times)
+def repair_plan(covid_data, scan):
+    """Returns the flagged runs a repair of a slice of the store replaces (see
+    QualityScan.runs_like), the FIPS of their counties and the dates of every
+    year ({'2021': ['1/1/21', ...]}) it reads from the NY Times: the flagged
+    days of the slice and the good day on each side of every run"""
+
+    store = scan.store
+    rows, starts, ends = runs = scan.runs_like(covid_data)
+    first = store.day_index(covid_data.columns[1]) if covid_data.shape[1] > 1 else 0
+    last = first + covid_data.shape[1] - 2
+
+    # flagged days within the slice, marked with +1/-1 boundaries, then the run edges
+    marks = np.zeros(store.n_days + 1, dtype=np.int32)
+    np.add.at(marks, np.maximum(starts, first), 1)
+    np.add.at(marks, np.minimum(ends, last + 1), -1)
+    days = np.cumsum(marks[:-1]) > 0
+    days[starts[starts > 0] - 1] = True
+    days[ends[ends < store.n_days]] = True
+
+    years = {}
+    for day in np.flatnonzero(days).tolist():
+        col = format_date(store.first_day + timedelta(days=day))
+        years.setdefault('20' + col[-2:], []).append(col)
+    return runs, np.unique(covid_data['fips'].to_numpy()[rows]), years
+
+
+@instrumentation.timed()
+def repair_flagged(covid_data, scan, type_cases):
+    """Returns a dataframe of cumulative COVID cases or deaths in which the
+    flagged cells are replaced by the NY Times counts
+
+    Every run of flagged days is repaired as a whole (also where it reaches
+    past the slice), with the NY Times counts shifted to meet the Johns Hopkins
+    counts of the good days on both sides of the run: the shift goes linearly
+    from the difference on the day before the run to the difference on the day
+    after it (a run with one good neighbour is shifted by that difference, one
+    with none isn't shifted). The repaired series has no step where a run
+    starts or ends, so no cases appear that neither source reported, and a cell
+    is repaired the same way whatever slice it is read in. Cells the NY Times
+    has no count for are kept.
 
     Parameters
     ----------
-    missing_counties: dataframe
-        A dataframe of counties with missing/incorrect cumulative data
-    start_date : str
-        The first date that cases/deaths should be reported for
-    end_date : str
-        The last date that cases/deaths should be reported for (default is None,
-        in which case only the start_date gets reported)
-    missing_fips: numpy array
-        An array of county FIPS with missing/incorrect cumulative data
+    covid_data: dataframe
+        A slice of the store (see CaseStore.slice)
+    scan: QualityScan
+        The data-quality scan of the store (see data_quality.scan_store)
     type_cases : str
         Choice of COVID cases ('confirmed') or deaths ('deaths') to be reported
 
     Returns
     -------
-    missing_counties: dataframe
-        A dataframe of missing counties in the specified time frame with
-        COVID cumulative cases or deaths
+    covid_data: dataframe
+        The repaired cumulative counts, in the same layout and order
     """
 
-    # get a list of all years we will need to look at
-    year_range = list(range(int(start_date[-2:]), int(end_date[-2:]) + 1))
-
-    # get a list of all dates we will need
-    case_cols = (missing_counties.columns[1:]).tolist()
-
-    # start with a dataframe with only the missing FIPS codes
-    missing_counties = missing_counties[['fips']]
-
-    # for each year needed, get the NY Times data and add on to the missing data frame
-    for year in year_range:
-        times_data = extract_times_data('20' + str(year), case_cols, missing_fips, type_cases)
-        missing_counties = pd.merge(missing_counties, times_data, on='fips', how='left')
-
-    # fill in any missing values with 0 (for dates in 2020 when COVID was just starting)
-    missing_counties = missing_counties.fillna(0)
+    store = scan.store
+    (rows, starts, ends), repair_fips, years = repair_plan(covid_data, scan)
+    first = store.day_index(covid_data.columns[1]) if covid_data.shape[1] > 1 else 0
+
+    # only the flagged counties and the dates of the runs are read, all years concurrently
+    with ThreadPoolExecutor() as executor:
+        times_frames = list(executor.map(instrumentation.in_current_span(
+            lambda year: extract_times_data(year, years[year], repair_fips, type_cases)), years))
+    times_data = pd.DataFrame({'fips': repair_fips})
+    for frame in times_frames:
+        times_data = pd.merge(times_data, frame, on='fips', how='left')
+    labels = [col for cols in years.values() for col in cols]
+    times = times_data.reindex(columns=labels).to_numpy(dtype=np.float64)
+    times_day = np.full(store.n_days, -1, dtype=np.int64)
+    times_day[[store.day_index(col) for col in labels]] = np.arange(len(labels))
+    times_row = np.searchsorted(repair_fips, covid_data['fips'].to_numpy()[rows])
+    store_rows = store.row_indices(covid_data['fips'].to_numpy())[rows]
+
+    def edge_shift(days, known):
+        # Johns Hopkins minus NY Times on the good day next to every run (NaN if unknown)
+        shift = np.full(len(days), np.nan)
+        shift[known] = (store.matrix[store_rows[known], days[known]]
+                        - times[times_row[known], times_day[days[known]]])
+        return shift
+
+    # a run with one good neighbour is shifted by its difference, one with none isn't shifted
+    left = edge_shift(starts - 1, starts > 0)
+    right = edge_shift(ends, ends < store.n_days)
+    left = np.where(np.isnan(left), right, left)
+    right = np.where(np.isnan(right), left, right)
+    left, right = np.nan_to_num(left), np.nan_to_num(right)
+
+    # one entry per flagged cell of the slice: its run and store day
+    first_days = np.maximum(starts, first)
+    lengths = np.minimum(ends, first + covid_data.shape[1] - 1) - first_days
+    run = np.repeat(np.arange(len(starts)), lengths)
+    days = first_days[run] + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    share = (days - starts[run] + 1) / (ends[run] - starts[run] + 1)
+    repaired = np.rint(times[times_row[run], times_day[days]] + left[run] + (right[run] - left[run]) * share)
+    replace = ~np.isnan(repaired)
+    values = covid_data.iloc[:, 1:].to_numpy(copy=True)
+    values[rows[run][replace], days[replace] - first] = repaired[replace]
+
+    instrumentation.increment('covid_data.repaired_cells', int(replace.sum()), type_cases=type_cases)
+    instrumentation.increment('covid_data.unrepaired_cells', int(len(replace) - replace.sum()),
+                              type_cases=type_cases)
+
+    repaired_data = pd.DataFrame(values, columns=covid_data.columns[1:], index=covid_data.index)
+    repaired_data.insert(0, 'fips', covid_data['fips'])
+    return repaired_data
+
+
+# record layout of the parsed per-year NY Times files
+TIMES_DTYPE = np.dtype([('fips', np.uint32), ('date', 'datetime64[D]'), ('cases', np.float64),
+                        ('deaths', np.float64)])
+
+
+def _parse_times_year(source, chunksize):
+    """Returns the county rows of a NY Times file as records sorted by FIPS
+    (in file order within a county), streamed in chunks (rows without FIPS are dropped)"""
+
+    chunks = []
+    for chunk in pd.read_csv(source, usecols=['date', 'fips', 'cases', 'deaths'],
+                             dtype={'date': str, 'fips': np.float64, 'cases': np.float64, 'deaths': np.float64},
+                             chunksize=chunksize):
+        chunk = chunk[chunk['fips'].notna()]
+        records = np.empty(len(chunk), dtype=TIMES_DTYPE)
+        records['fips'] = chunk['fips'].to_numpy()
+        records['date'] = pd.to_datetime(chunk['date'], format='%Y-%m-%d').to_numpy()
+        records['cases'] = chunk['cases'].to_numpy()
+        records['deaths'] = chunk['deaths'].to_numpy()
+        chunks.append(records)
+
+    records = np.concatenate(chunks) if chunks else np.empty(0, dtype=TIMES_DTYPE)
+    return records[np.argsort(records['fips'], kind='stable')]
+
+
+@instrumentation.timed()
+def read_times_year(year, missing_fips, cache_dir=None, chunksize=250000):
+    """Returns the NY Times rows of one year for only the specified counties
+
+    The national file is parsed once per downloaded version and cached as
+    records sorted by FIPS with an index of the rows of every county; the
+    records are memory-mapped, so only the rows of the specified counties are read.
 
-    return missing_counties
+    Parameters
+    ----------
+    year: str
+        Year that the data needs to be collected for
+    missing_fips: numpy array
+        An array of county FIPS that should be kept
+    cache_dir: str, optional
+        Directory the parsed per-year files are cached in (default is
+        None, in which case NYT_CACHE_DIR is used: Data/cache/nytimes)
+    chunksize: int, optional
+        Number of rows parsed at a time (default is 250,000)
 
+    Returns
+    -------
+    nytimes: dataframe
+        A long dataframe (date, fips, cases, deaths) of the specified counties
+    """
 
+    if cache_dir is None:
+        cache_dir = NYT_CACHE_DIR
+    wanted = np.unique(np.asarray(missing_fips).astype(np.int64))
+    source = data_sources.fetch('nytimes', year=year)
+
+    # the cache key is the version of the downloaded file, so every county
+    # selection shares one parse and a new download gets a new file
+    key = hashlib.sha1(json.dumps(source_version(source), sort_keys=True).encode()).hexdigest()[:10]
+    prefix = 'us-counties-' + year + '-'
+    cache_file = os.path.join(cache_dir, prefix + key + '.npy')
+    index_file = os.path.join(cache_dir, prefix + key + '-index.npy')
+
+    with _times_locks_guard:
+        lock = _times_locks.setdefault(cache_file, threading.Lock())
+
+    with lock:
+        # the index is written last, so the records exist whenever it does
+        try:
+            index = np.load(index_file)
+        except FileNotFoundError:
+            records = _parse_times_year(source, chunksize)
+            counties, starts = np.unique(records['fips'], return_index=True)
+            index = np.stack([counties, starts, np.append(starts[1:], len(records))]).astype(np.int64)
+
+            os.makedirs(cache_dir, exist_ok=True)
+            for path, array in ((cache_file, records), (index_file, index)):
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, array)
+                os.replace(path + '.tmp', path)
+            del records
+
+            # files of older versions of the year (and the per-county-set files
+            # cached before) are never read again
+            for entry in os.scandir(cache_dir):
+                if (entry.name.startswith(prefix) and not entry.name.startswith(prefix + key)
+                        and not entry.name.endswith('.tmp')):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        # (removed by another process meanwhile)
+                        pass
+        records = np.load(cache_file, mmap_mode='r')
+
+    # every county is one block of rows: only those pages of the records are read
+    counties, starts, ends = index
+    found = np.isin(counties, wanted)
+    rows = np.concatenate([records[start:end] for start, end in zip(starts[found].tolist(), ends[found].tolist())] +
+                          [np.empty(0, dtype=TIMES_DTYPE)])
+    return pd.DataFrame({'date': rows['date'].astype('datetime64[ns]'), 'fips': rows['fips'],
+                         'cases': rows['cases'], 'deaths': rows['deaths']})
+
+
+@instrumentation.timed()
 def extract_times_data(year, case_cols, missing_fips, type_cases):
     """ Extracts missing data and returns a dataframe of cumulative COVID
     cases or deaths for only the specified missing counties (collected from NY Times)
@@ -206,34 +469,94 @@ def extract_times_data(year, case_cols, missing_fips, type_cases):
         COVID cumulative cases or deaths
     """
 
-    # access and read in the file for the correct year
-    url = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/' \
-          'us-counties-' + year + '.csv'
-    nytimes = pd.read_csv(url)
-
-    # reformat FIPS to match 5-digit format
-    nytimes['fips'] = nytimes['fips'].fillna(0)
-    nytimes.fips = (nytimes.fips.astype(int)).astype(object)
-    nytimes['fips'] = nytimes['fips'].apply('{:0>5}'.format)
-
-    # get only rows with missing Utah counties
-    nytimes = nytimes[nytimes['fips'].isin(missing_fips)]
+    nytimes = read_times_year(year, missing_fips)
 
-    # change date to format used for covid_data columns and only keep the dates we need
-    nytimes['date'] = nytimes.date.str[5:7].astype(int).astype(str) + '/' + nytimes.date.str[8:10].astype(int).astype(
-        str) + '/' + nytimes.date.str[2:4].astype(int).astype(str)
-    nytimes = nytimes[nytimes['date'].isin(case_cols)]
+    # map the dates we need (format used for covid_data columns) to timestamps once
+    # and only keep those dates
+    col_dates = pd.to_datetime(pd.Series(case_cols), format='%m/%d/%y')
+    nytimes = nytimes[nytimes['date'].isin(col_dates)]
 
     # transform into wide table and add FIPS code
     if type_cases == 'confirmed':
         nytimes_wide = nytimes.pivot(index='fips', columns='date', values='cases')
     else:
         nytimes_wide = nytimes.pivot(index='fips', columns='date', values='deaths')
+    nytimes_wide.columns = nytimes_wide.columns.map(dict(zip(col_dates, case_cols)))
+    nytimes_wide.index = nytimes_wide.index.astype(np.uint32)
+    nytimes_wide.index.name = 'fips'
+    nytimes_wide.columns.name = None
     nytimes_wide.reset_index(inplace=True)
 
     return nytimes_wide
 
 
+@instrumentation.timed()
+def daily_diff(values):
+    """Returns the daily change of a fips x day array of cumulative counts
+    (one column shorter than the input, negative changes set to 0)
+
+    Parameters
+    ----------
+    values: numpy array
+        A 2D array of cumulative counts (one row per county, one column per day)
+
+    Returns
+    -------
+    daily: numpy array
+        A 2D array of daily new counts
+    """
+
+    # negative values are errors in the cumulative data (get_cumulative repairs
+    # the ones the NY Times has correct counts for)
+    return np.clip(np.diff(values, axis=1), 0, None)
+
+
+@instrumentation.timed()
+def active_window(daily, active_days=10):
+    """Returns the sum of daily counts over a trailing window of active_days
+    (the first active_days - 1 columns are dropped, since their window is incomplete)
+
+    Parameters
+    ----------
+    daily: numpy array
+        A 2D array of daily new counts (one row per county, one column per day)
+    active_days: int, optional
+        Length of the window in days (default is 10)
+
+    Returns
+    -------
+    active: numpy array
+        A 2D array of active counts
+    """
+
+    # window sums are differences of the running total, so every day costs O(1)
+    # (the running total is kept in 64 bits, the window sums fit the input type again)
+    totals = np.cumsum(daily, axis=1, dtype=np.int64)
+    active = totals[:, active_days - 1:].copy()
+    active[:, 1:] -= totals[:, :-active_days]
+
+    return active.astype(daily.dtype)
+
+
+def population_vector(fips, county_info):
+    """Returns the population of each county in fips, in the same order
+    (NaN for counties missing from county_info)"""
+
+    rows = pd.Index(county_info['fips']).get_indexer(fips)
+    population = county_info['population'].to_numpy(dtype=np.float64)[rows]
+    population[rows < 0] = np.nan
+
+    return population
+
+
+def scale_values(values, population):
+    """Returns a fips x day float32 array of counts scaled by population
+    (units returned: per 100,000 people)"""
+
+    return (values / population[:, np.newaxis] * 100000).astype(np.float32)
+
+
+@instrumentation.timed()
 def get_daily_diff(covid_data):
     """Returns a dataframe of daily change in COVID cases or deaths based
     on cumulative data
@@ -246,23 +569,20 @@ def get_daily_diff(covid_data):
     Returns
     -------
     covid_data: dataframe
-        A modified dataframe containing daily counts of new cases or deaths
+        A dataframe containing daily counts of new cases or deaths
     """
 
-    # calculate change in cases for all columns except FIPS
-    covid_data.loc[:, covid_data.columns != 'fips'] = covid_data.loc[:, covid_data.columns != 'fips'].diff(axis=1)
+    daily = daily_diff(covid_data.iloc[:, 1:].to_numpy())
 
-    # set all negative values to 0 (errors in cumulative data)
-    case_cols = (covid_data.columns[1:]).tolist()
-    covid_data[case_cols] = covid_data[case_cols].mask(covid_data[case_cols] < 0, 0)
+    # the first date column is dropped (it has no previous day to compare to)
+    daily = pd.DataFrame(daily, columns=covid_data.columns[2:], index=covid_data.index)
+    daily.insert(0, 'fips', covid_data['fips'])
 
-    # remove first column after FIPS (since it will be NaN)
-    covid_data.drop([covid_data.columns[1]], axis=1, inplace=True)
-
-    return covid_data
+    return daily
 
 
-def get_active_cases(covid_data):
+@instrumentation.timed()
+def get_active_cases(covid_data, active_days=10):
     """Returns a dataframe of active COVID cases based on daily new cases,
     assuming a case is active for 10 days
 
@@ -270,25 +590,25 @@ def get_active_cases(covid_data):
     ----------
     covid_data: dataframe
         A dataframe containing daily new case counts
+    active_days: int, optional
+        Number of days a case counts as active (default is 10, by CDC rules)
 
     Returns
     -------
     covid_data: dataframe
-        A modified dataframe containing daily active cases (assuming
-        a 10-day active period of the virus)
+        A dataframe containing daily active cases (the first
+        active_days - 1 dates are dropped)
     """
 
-    # get active cases by summing up new cases over 10 days
-    # (assuming a case is active for 10-days by CDC rules)
-    covid_data.loc[:, covid_data.columns != 'fips'] = covid_data.loc[:, covid_data.columns != 'fips'].rolling(
-        10, axis=1).sum()
+    active = active_window(covid_data.iloc[:, 1:].to_numpy(), active_days)
 
-    # drop columns we don't need
-    covid_data.drop(covid_data.iloc[:, 1:10], axis=1, inplace=True)
+    active = pd.DataFrame(active, columns=covid_data.columns[active_days:], index=covid_data.index)
+    active.insert(0, 'fips', covid_data['fips'])
 
-    return covid_data
+    return active
 
 
+@instrumentation.timed()
 def scale_by_pop(covid_data, county_info):
     """Returns a dataframe of case/death counts scaled by population of each
     county (units returned: per 100,000 people)
@@ -303,16 +623,14 @@ def scale_by_pop(covid_data, county_info):
     Returns
     -------
     covid_data: dataframe
-        A modified dataframe containing scaled case or death counts
+        A dataframe containing scaled case or death counts
         (with units per 100,000 people)
     """
 
-    # add population data to dataframe
-    covid_data = pd.merge(county_info[['fips', 'population']], covid_data, on='fips', how='right')
-
-    # scale active cases by population * 100,000 (to get cases per 100,000 people)
-    covid_data.iloc[:, 2:] = covid_data.iloc[:, 2:].div(covid_data.population, axis=0)*100000
-    covid_data.drop(['population'], axis=1, inplace=True)
+    population = population_vector(covid_data['fips'].to_numpy(), county_info)
+    scaled = scale_values(covid_data.iloc[:, 1:].to_numpy(), population)
 
-    return covid_data
+    scaled = pd.DataFrame(scaled, columns=covid_data.columns[1:], index=covid_data.index)
+    scaled.insert(0, 'fips', covid_data['fips'])
 
+    return scaled
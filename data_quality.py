@@ -0,0 +1,244 @@
+import threading
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import instrumentation
+
+
+# kinds of anomalies, one bit each in the flag matrix
+FLAT_ZERO = 1
+NEGATIVE_DIFF = 2
+SPIKE = 4
+KINDS = {FLAT_ZERO: 'flat_zero', NEGATIVE_DIFF: 'negative_diff', SPIKE: 'spike'}
+
+# counties still reporting 0 cumulative cases for this many days in a row once the
+# outbreak reached ONSET_SHARE of all counties aren't reporting (e.g. the Utah
+# counties Johns Hopkins only reports as health districts)
+FLAT_ZERO_DAYS = 14
+ONSET_SHARE = 0.9
+
+# a daily increase of at least MIN_SPIKE that is SPIKE_FACTOR times the mean of the
+# SPIKE_WINDOW days before it is a reporting backlog; the days without any
+# increase right before it (up to SPIKE_WINDOW) are flagged with it
+SPIKE_FACTOR = 10
+SPIKE_WINDOW = 14
+MIN_SPIKE = 100
+
+# flags of the stores scanned so far, by matrix file (see scan_store)
+_scans = {}
+_scans_lock = threading.Lock()
+
+
+def _runs(mask):
+    """Returns the (row, first column, end column) of every run of True along the rows of mask"""
+
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+
+    # row-major order pairs every run start with its end
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return rows, starts, ends
+
+
+def _run_lengths(mask):
+    """Returns the length of the run of True every cell of mask is in (0 for False cells)"""
+
+    rows, starts, ends = _runs(mask)
+    lengths = np.zeros(mask.shape, dtype=np.int64)
+    lengths[mask] = np.repeat(ends - starts, ends - starts)
+    return lengths
+
+
+@instrumentation.timed()
+def detect_anomalies(values):
+    """Returns the anomalies of a fips x day array of cumulative counts, found
+    with whole-array operations (no loop over counties or days)
+
+    Parameters
+    ----------
+    values: numpy array
+        A 2D array of cumulative counts (one row per county, one column per day)
+
+    Returns
+    -------
+    flags: numpy array
+        A uint8 array of the same shape, with the bits of the anomalies (FLAT_ZERO,
+        NEGATIVE_DIFF, SPIKE) every cell is part of (0 for good cells)
+    """
+
+    values = np.asarray(values)
+    n_counties, n_days = values.shape
+    flags = np.zeros(values.shape, dtype=np.uint8)
+    if values.size == 0:
+        return flags
+
+    # flat zeros: long runs of 0 after the day most counties reported cases
+    zero = values == 0
+    reached = np.count_nonzero(~zero, axis=0) >= ONSET_SHARE * n_counties
+    onset = int(np.argmax(reached)) if reached.any() else n_days
+    zero[:, :onset] = False
+    flags[_run_lengths(zero) >= FLAT_ZERO_DAYS] |= FLAT_ZERO
+
+    # negative diffs: every count above a later one was corrected downwards
+    # (only the days between the overcount and the correction are flagged)
+    later_min = np.minimum.accumulate(values[:, ::-1], axis=1)[:, ::-1]
+    flags[values > later_min] |= NEGATIVE_DIFF
+
+    # spikes: daily increases far above the mean of the previous days (computed
+    # from the running total, so every day costs O(1))
+    daily = np.diff(values, axis=1, prepend=values[:, :1]).astype(np.int64)
+    totals = np.zeros((n_counties, n_days + 1), dtype=np.int64)
+    totals[:, 1:] = np.cumsum(np.clip(daily, 0, None), axis=1)
+    mean = np.zeros(values.shape)
+    mean[:, SPIKE_WINDOW:] = (totals[:, SPIKE_WINDOW:n_days] - totals[:, :n_days - SPIKE_WINDOW]) / SPIKE_WINDOW
+    spike = (daily >= MIN_SPIKE) & (daily > SPIKE_FACTOR * np.maximum(mean, 1))
+    spike[:, :SPIKE_WINDOW] = False
+
+    # a backlog starts the day after the last reported increase before the spike
+    rows, days = np.nonzero(spike)
+    last_reported = np.maximum.accumulate(np.where(daily != 0, np.arange(n_days), -1), axis=1)
+    starts = np.maximum(last_reported[rows, days - 1] + 1, days - SPIKE_WINDOW)
+
+    # mark [start, day] of every spike with +1/-1 boundaries summed along the rows
+    marks = np.zeros((n_counties, n_days + 1), dtype=np.int32)
+    np.add.at(marks, (rows, starts), 1)
+    np.add.at(marks, (rows, days + 1), -1)
+    flags[np.cumsum(marks[:, :-1], axis=1) > 0] |= SPIKE
+
+    return flags
+
+
+def flag_ranges(flags, fips, first_day):
+    """Returns one row per run of consecutive days flagged with the same kind
+
+    Parameters
+    ----------
+    flags: numpy array
+        A fips x day flag array (see detect_anomalies)
+    fips: numpy array
+        FIPS of the rows of flags
+    first_day: date
+        Date of the first column of flags
+
+    Returns
+    -------
+    report: dataframe
+        fips, kind, first_date, last_date and days of every flagged range
+    """
+
+    frames = []
+    for bit, kind in KINDS.items():
+        rows, starts, ends = _runs((flags & bit) != 0)
+        frames.append(pd.DataFrame({'fips': np.asarray(fips, dtype=np.uint32)[rows],
+                                    'kind': kind,
+                                    'first_date': np.datetime64(first_day, 'D') + starts,
+                                    'last_date': np.datetime64(first_day, 'D') + ends - 1,
+                                    'days': ends - starts}))
+
+    report = pd.concat(frames, ignore_index=True)
+    return report.sort_values(['fips', 'first_date', 'kind'], ignore_index=True)
+
+
+def merge_ranges(report):
+    """Returns the runs of consecutive flagged days of every county whatever
+    their kind (the runs covid_data.repair_flagged repairs as a whole), merging
+    the overlapping and adjacent ranges of a report (see flag_ranges)
+
+    Parameters
+    ----------
+    report: dataframe
+        fips, kind, first_date and last_date of flagged ranges
+
+    Returns
+    -------
+    runs: dataframe
+        fips, first_date and last_date of every run
+    """
+
+    report = report.sort_values(['fips', 'first_date'], ignore_index=True)
+    fips = report['fips'].to_numpy(dtype=np.int64)
+    first = report['first_date'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+    last = report['last_date'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+
+    # a range starts a new run unless it begins by the day after the latest end
+    # of the earlier ranges of its county
+    reach = pd.Series(last).groupby(fips).cummax().to_numpy()
+    new_run = np.ones(len(report), dtype=bool)
+    new_run[1:] = (fips[1:] != fips[:-1]) | (first[1:] > reach[:-1] + 1)
+    ends = np.flatnonzero(np.append(new_run[1:], len(report) > 0))
+
+    return pd.DataFrame({'fips': fips[new_run], 'first_date': first[new_run].astype('datetime64[D]'),
+                         'last_date': reach[ends].astype('datetime64[D]')})
+
+
+class QualityScan:
+    """Anomaly flags of every cell of a case store
+
+    Parameters
+    ----------
+    store: CaseStore
+        The scanned store
+    flags: numpy array
+        Flags of every cell of the store matrix (see detect_anomalies)
+    """
+
+    def __init__(self, store, flags):
+        self.store = store
+        self.flags = flags
+
+    def flags_like(self, covid_data):
+        """Returns the flags of the cells of a slice of the store (the
+        dataframe returned by CaseStore.slice), in the same order"""
+
+        rows = self.store.row_indices(covid_data['fips'].to_numpy())
+        first = self.store.day_index(covid_data.columns[1]) if covid_data.shape[1] > 1 else 0
+        return self.flags[rows, first:first + covid_data.shape[1] - 1]
+
+    def runs_like(self, covid_data):
+        """Returns the flagged runs (consecutive days flagged with any kind) of the
+        counties of a slice of the store that overlap the slice, as the slice row,
+        first day and end day (store day indices, end excluded) of every run; runs
+        reaching past the slice are returned whole"""
+
+        first = self.store.day_index(covid_data.columns[1]) if covid_data.shape[1] > 1 else 0
+        last = first + covid_data.shape[1] - 2
+        flagged = np.flatnonzero(self.flags_like(covid_data).any(axis=1))
+        rows = self.store.row_indices(covid_data['fips'].to_numpy()[flagged])
+
+        run_rows, starts, ends = _runs(self.flags[rows] != 0)
+        overlap = (starts <= last) & (ends > first)
+        return flagged[run_rows[overlap]], starts[overlap], ends[overlap]
+
+    def counts(self):
+        """Returns the number of flagged cells of every kind"""
+
+        return {kind: int(np.count_nonzero(self.flags & bit)) for bit, kind in KINDS.items()}
+
+    def report(self, start_date=None, end_date=None, county_fips=None):
+        """Returns the flagged ranges (see flag_ranges) between two dates
+        (inclusive, 'm/d/yy') of the given counties (default is everything)"""
+
+        first = 0 if start_date is None else max(self.store.day_index(start_date), 0)
+        last = self.store.n_days - 1 if end_date is None else min(self.store.day_index(end_date), self.store.n_days - 1)
+        if county_fips is None:
+            rows = np.arange(len(self.store.fips))
+        else:
+            rows = self.store.row_indices(county_fips)
+
+        return flag_ranges(self.flags[rows, first:last + 1], self.store.fips[rows],
+                           self.store.first_day + timedelta(days=first))
+
+
+@instrumentation.timed()
+def scan_store(store):
+    """Returns the QualityScan of a case store, scanning its whole matrix once
+    per build (later calls return the same scan)"""
+
+    key = (store.matrix.filename, store.built, store.n_days)
+    with _scans_lock:
+        scan = _scans.get(store.matrix.filename)
+        if scan is None or scan[0] != key:
+            scan = _scans[store.matrix.filename] = (key, QualityScan(store, detect_anomalies(store.matrix)))
+    return scan[1]
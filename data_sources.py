@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import pandas as pd
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+import instrumentation
+
+
+REPO_URL = 'https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/'
+
+# every remote file used by the project: name -> (url, seconds a cached copy stays fresh)
+# urls may contain {placeholders} that are filled in by fetch(name, **kwargs)
+SOURCES = {
+    'county_info': (REPO_URL + 'Data/county_info.csv', 7 * 86400),
+    'county_info_with_key': (REPO_URL + 'Data/Mid-Points/county_info_with_key.csv', 7 * 86400),
+    'adj_dist_all_final': (REPO_URL + 'Data/adj_dist_all_final.csv', 7 * 86400),
+    'counties_clustered': (REPO_URL + 'Data/Counties_clustered.csv', 86400),
+    'all_predictions': (REPO_URL + 'Data/all_predictions.csv', 7 * 86400),
+    'active_cases': (REPO_URL + 'active_cases.csv', 3600),
+    'active_cases_partition': (REPO_URL + 'active_cases/{file_name}', 7 * 86400),
+    'counties_geojson': ('https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json',
+                         30 * 86400),
+    'jhu': ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/'
+            'csse_covid_19_time_series/time_series_covid19_{type_cases}_US.csv', 6 * 3600),
+    'nytimes': ('https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties-{year}.csv',
+                86400),
+}
+
+# downloaded files and their validators (ETag/Last-Modified) are kept here
+CACHE_DIR = os.environ.get('MDA_CACHE_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'cache', 'http'))
+
+# in offline mode nothing is downloaded: files come from LOCAL_DIR or the cache
+OFFLINE = os.environ.get('MDA_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+# optional directory standing in for the remote sources (files are matched by file name)
+LOCAL_DIR = os.environ.get('MDA_LOCAL_DATA')
+
+# seconds a request may wait for the server (to connect or for more data) before
+# the cached copy is served instead
+TIMEOUT = float(os.environ.get('MDA_HTTP_TIMEOUT', 30))
+
+# one lock per url, so concurrent callers wait for a single download instead of repeating it
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def source_url(name, **kwargs):
+    """Returns the remote url of a source (with its placeholders filled in)"""
+
+    return SOURCES[name][0].format(**kwargs)
+
+
+def _cache_paths(url):
+    """Returns the cached file and metadata paths of a url"""
+
+    # keep the original file name readable and make it unique with the url's directory
+    directory, file_name = url.rsplit('/', 1)
+    prefix = hashlib.sha1(directory.encode()).hexdigest()[:8]
+    path = os.path.join(CACHE_DIR, prefix + '-' + file_name)
+    return path, path + '.json'
+
+
+def _read_meta(meta_path):
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_meta(meta_path, meta):
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def fetch(name, ttl=None, **kwargs):
+    """Returns the path of a local copy of a data source, downloading it only
+    when the cached copy is older than its TTL and the server reports a change
+
+    Parameters
+    ----------
+    name : str
+        Name of the source (a key of SOURCES)
+    ttl : float, optional
+        Seconds a cached copy is used without asking the server (default is
+        None, in which case the TTL from SOURCES is used)
+    **kwargs
+        Values for the placeholders of the source url (e.g. year='2021')
+
+    Returns
+    -------
+    path: str
+        Path of the local file
+    """
+
+    url = source_url(name, **kwargs)
+    if ttl is None:
+        ttl = SOURCES[name][1]
+
+    with instrumentation.span('data_sources.fetch', source=name) as record:
+        # a local stand-in directory always wins (air-gapped runs, fixtures)
+        local_path = None
+        if LOCAL_DIR is not None:
+            local_path = os.path.join(LOCAL_DIR, url.rsplit('/', 1)[1])
+        if local_path is not None and os.path.exists(local_path):
+            path, record['outcome'] = local_path, 'local'
+        else:
+            with _locks_guard:
+                lock = _locks.setdefault(url, threading.Lock())
+            with lock:
+                path, record['outcome'] = _fetch_url(url, ttl)
+
+    instrumentation.increment('data_sources.fetch', source=name, outcome=record['outcome'])
+    return path
+
+
+def _fetch_url(url, ttl):
+    """Returns the path of the cached copy of url, (re)validating it if needed,
+    and how it was obtained ('cached', 'not modified', 'downloaded' or 'stale')"""
+
+    path, meta_path = _cache_paths(url)
+    meta = _read_meta(meta_path)
+    cached = meta is not None and os.path.exists(path)
+
+    if OFFLINE:
+        if not cached:
+            raise FileNotFoundError('offline mode: no cached or local copy of ' + url)
+        return path, 'cached'
+
+    if cached and time.time() - meta['fetched'] < ttl:
+        return path, 'cached'
+
+    # revalidate (or download) with a conditional request
+    headers = {}
+    if cached and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if cached and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    outcome = 'downloaded'
+    try:
+        with urlopen(Request(url, headers=headers), timeout=TIMEOUT) as response:
+            with open(path + '.tmp', 'wb') as f:
+                shutil.copyfileobj(response, f)
+            os.replace(path + '.tmp', path)
+            meta = {'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')}
+    except HTTPError as error:
+        # 304 Not Modified: the cached copy is still current
+        if not cached:
+            raise
+        if error.code != 304:
+            return path, 'stale'
+        outcome = 'not modified'
+    except (URLError, socket.timeout):
+        # serve a stale copy rather than failing when the network is down or the
+        # server stops responding (a timeout while reading isn't wrapped in a URLError)
+        if not cached:
+            raise
+        return path, 'stale'
+
+    meta['fetched'] = time.time()
+    _write_meta(meta_path, meta)
+
+    return path, outcome
+
+
+def read_csv(name, ttl=None, url_kwargs=None, **kwargs):
+    """Returns a data source read with pd.read_csv (through the local cache)
+
+    Parameters
+    ----------
+    name : str
+        Name of the source (a key of SOURCES)
+    ttl : float, optional
+        Seconds a cached copy is used without asking the server
+    url_kwargs : dict, optional
+        Values for the placeholders of the source url
+    **kwargs
+        Passed on to pd.read_csv
+
+    Returns
+    -------
+    data: dataframe
+        The parsed file
+    """
+
+    return pd.read_csv(fetch(name, ttl, **(url_kwargs or {})), **kwargs)
+
+
+def read_json(name, ttl=None, **kwargs):
+    """Returns a JSON data source (through the local cache)"""
+
+    with open(fetch(name, ttl, **kwargs)) as f:
+        return json.load(f)
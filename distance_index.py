@@ -0,0 +1,252 @@
+import argparse
+import hashlib
+import heapq
+import os
+import time
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+import data_sources
+import instrumentation
+from routing import RoutingEngine
+
+
+# precomputed landmark index for the (static) great-circle distance graph
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'cache', 'distance_index.npz')
+
+
+# columns of the adjacency list used for routing, with compact dtypes
+EDGE_DTYPES = {'county_fips': np.uint32, 'bcounty_fips': np.uint32, 'gc_dist_km': np.float64, 'duration_min': np.int32}
+
+
+def read_edges():
+    """Returns the county adjacency list (uint32 FIPS codes, distance and duration)"""
+
+    return data_sources.read_csv('adj_dist_all_final', usecols=list(EDGE_DTYPES), dtype=EDGE_DTYPES)
+
+
+def engine_key(engine):
+    """Returns the key of the graph an index is built from (a digest of the engine arrays)"""
+
+    digest = hashlib.sha1()
+    for name, array in sorted(engine.arrays().items()):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def select_landmarks(engine, n_landmarks, seed=0):
+    """Returns landmark nodes picked by farthest-point selection, together with
+    their distances to every node
+
+    Landmarks on the edge of the map give the tightest lower bounds, so each
+    new landmark is the node farthest from all landmarks chosen so far.
+    """
+
+    def farthest(distances):
+        return int(np.argmax(np.where(np.isfinite(distances), distances, -1)))
+
+    # the random start is only used to find the first far-away node
+    start = int(np.random.default_rng(seed).integers(engine.n))
+    landmarks = [farthest(dijkstra(engine.distance_graph, directed=True, indices=start))]
+    distances = [dijkstra(engine.distance_graph, directed=True, indices=landmarks[0])]
+    nearest = distances[0].copy()
+
+    while len(landmarks) < n_landmarks:
+        landmark = farthest(nearest)
+        landmarks.append(landmark)
+        distances.append(dijkstra(engine.distance_graph, directed=True, indices=landmark))
+        nearest = np.minimum(nearest, distances[-1])
+
+    return np.array(landmarks), np.vstack(distances)
+
+
+@instrumentation.timed()
+def build_distance_index(engine=None, n_landmarks=16, path=None):
+    """Builds the ALT (A*, landmarks, triangle inequality) index of the
+    great-circle distance graph and saves it to disk
+
+    Parameters
+    ----------
+    engine: RoutingEngine, optional
+        Engine holding the county graph (default is None, in which case it is
+        built from adj_dist_all_final.csv)
+    n_landmarks: int, optional
+        Number of landmarks (default is 16)
+    path: str, optional
+        Where the index is written (default is None, in which case INDEX_FILE
+        is used: Data/cache/distance_index.npz)
+
+    Returns
+    -------
+    index: DistanceIndex
+        The freshly built index
+    """
+
+    if engine is None:
+        engine = RoutingEngine(read_edges())
+
+    if path is None:
+        path = INDEX_FILE
+    landmarks, landmark_distances = select_landmarks(engine, n_landmarks)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, nodes=engine.nodes, indptr=engine.indptr, indices=engine.indices,
+                 distance=engine.distance, landmarks=landmarks, landmark_distances=landmark_distances,
+                 graph=np.array(engine_key(engine)))
+    os.replace(path + '.tmp', path)
+
+    return DistanceIndex(path)
+
+
+class DistanceIndex:
+    """Point-to-point distance and path queries on the static distance graph,
+    answered with A* guided by landmark lower bounds"""
+
+    def __init__(self, path=None):
+        with np.load(INDEX_FILE if path is None else path) as data:
+            # (older index files stored the FIPS codes as strings)
+            self.nodes = data['nodes'].astype(np.uint32)
+            indptr, indices, distance = data['indptr'], data['indices'], data['distance']
+            self.landmarks = data['landmarks']
+            self.landmark_distances = data['landmark_distances']
+            # (older index files don't record the graph they were built from)
+            self.graph = str(data['graph']) if 'graph' in data else None
+
+        self.node_ids = {fips: i for i, fips in enumerate(self.nodes.tolist())}
+
+        # plain python adjacency lists are the fastest thing to walk from a heap loop
+        self.adjacency = [list(zip(indices[indptr[v]:indptr[v + 1]].tolist(),
+                                   distance[indptr[v]:indptr[v + 1]].tolist())) for v in range(len(self.nodes))]
+
+    def lower_bounds(self, target):
+        """Returns a lower bound on the distance from every node to target
+
+        By the triangle inequality |d(L, target) - d(L, v)| <= d(v, target)
+        for every landmark L; the largest of these bounds is used.
+        """
+
+        to_target = self.landmark_distances[:, target]
+        bounds = np.abs(to_target[:, np.newaxis] - self.landmark_distances)
+        bounds[~np.isfinite(bounds)] = 0
+        return bounds.max(axis=0).tolist()
+
+    def search(self, origin, target):
+        """Returns (distance, predecessor dict) of an A* search between two node numbers"""
+
+        bound = self.lower_bounds(target)
+        best = {origin: 0.0}
+        previous = {}
+        settled = set()
+        heap = [(bound[origin], origin)]
+        while heap:
+            _, v = heapq.heappop(heap)
+            if v == target:
+                return best[v], previous
+            if v in settled:
+                continue
+            settled.add(v)
+
+            dv = best[v]
+            for w, length in self.adjacency[v]:
+                candidate = dv + length
+                if candidate < best.get(w, np.inf):
+                    best[w] = candidate
+                    previous[w] = v
+                    heapq.heappush(heap, (candidate + bound[w], w))
+
+        return np.inf, previous
+
+    def distance(self, origin_fips, target_fips):
+        """Returns the great-circle distance (km) of the shortest path between two counties"""
+
+        return self.search(self.node_ids[origin_fips], self.node_ids[target_fips])[0]
+
+    @instrumentation.timed('distance_index.route')
+    def route(self, origin_fips, target_fips):
+        """Returns the shortest path between two counties
+
+        Returns
+        -------
+        distance: float
+            Total great-circle distance of the path (inf if there is no path)
+        path: list
+            FIPS codes of all counties on the path, in order
+        """
+
+        origin, target = self.node_ids[origin_fips], self.node_ids[target_fips]
+        distance, previous = self.search(origin, target)
+        if not np.isfinite(distance):
+            return distance, []
+
+        path = [target]
+        while path[-1] != origin:
+            path.append(previous[path[-1]])
+        return distance, self.nodes[path[::-1]].tolist()
+
+
+def load_distance_index(path=None, engine=None):
+    """Returns the distance index, building it first if it doesn't exist yet or
+    was built from another graph (default path is None, in which case
+    INDEX_FILE is used; default engine is None, in which case it is built
+    from adj_dist_all_final.csv)"""
+
+    if path is None:
+        path = INDEX_FILE
+    if engine is None:
+        engine = RoutingEngine(read_edges())
+
+    # the index is reused as long as the graph it was built from hasn't changed
+    # (a new adjacency list and an index from before graph keys both trigger a rebuild)
+    if os.path.exists(path):
+        index = DistanceIndex(path)
+        if index.graph == engine_key(engine):
+            return index
+    return build_distance_index(engine, path=path)
+
+
+def benchmark(index, df_edges, n_pairs=200, seed=0):
+    """Times the index against nx.single_source_dijkstra on random
+    origin-destination pairs and checks that the distances agree
+
+    Returns
+    -------
+    results: dict
+        Mean query time (seconds) of both methods and the largest distance difference
+    """
+
+    import networkx as nx
+
+    graph = nx.from_pandas_edgelist(df_edges, source='county_fips', target='bcounty_fips', edge_attr='gc_dist_km')
+    rng = np.random.default_rng(seed)
+    pairs = rng.choice(index.nodes, size=(n_pairs, 2))
+
+    start = time.perf_counter()
+    expected = [nx.single_source_dijkstra(graph, o, t, weight='gc_dist_km')[0] for o, t in pairs]
+    networkx_time = (time.perf_counter() - start) / n_pairs
+
+    start = time.perf_counter()
+    found = [index.route(o, t)[0] for o, t in pairs]
+    index_time = (time.perf_counter() - start) / n_pairs
+
+    return {'networkx_seconds': networkx_time, 'index_seconds': index_time,
+            'max_difference_km': float(np.max(np.abs(np.array(expected) - np.array(found))))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or benchmark the county distance index')
+    parser.add_argument('command', choices=['build', 'benchmark'])
+    parser.add_argument('--landmarks', type=int, default=16, help='number of landmarks (default is 16)')
+    parser.add_argument('--pairs', type=int, default=200, help='random pairs to benchmark (default is 200)')
+    parser.add_argument('--output', default=INDEX_FILE, help='path of the index file')
+    args = parser.parse_args()
+
+    edges = read_edges()
+    if args.command == 'build':
+        build_distance_index(RoutingEngine(edges), args.landmarks, args.output)
+        print('Wrote distance index to {}'.format(args.output))
+    else:
+        results = benchmark(load_distance_index(args.output, RoutingEngine(edges)), edges, args.pairs)
+        print('networkx dijkstra: {:.3f} ms/query'.format(results['networkx_seconds'] * 1e3))
+        print('landmark index:    {:.3f} ms/query'.format(results['index_seconds'] * 1e3))
+        print('largest distance difference: {:.6f} km'.format(results['max_difference_km']))
@@ -0,0 +1,435 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import pandas as pd
+import clustering
+import instrumentation
+from case_matrix import load_case_matrix
+
+
+# shape-based labels are written next to the PCA ones (same layout, see clustering.write_clusters)
+OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'Counties_clustered_dtw.csv')
+
+# width of the Sakoe-Chiba band on either side of the diagonal, as a fraction of the series length
+# (about four weeks of shift over the active case series; a wider band mostly loosens the lower bounds)
+WINDOW = 0.05
+
+MAX_ITER = 10
+
+# pairs per batch of distance evaluations (the DBA batches keep their whole cost matrix, so they are smaller)
+CHUNK_SIZE = 512
+DBA_CHUNK_SIZE = 128
+
+
+def band_width(length, window=WINDOW):
+    """Returns the Sakoe-Chiba band (cells on either side of the diagonal) of a series length"""
+
+    return max(int(round(window * length)), 1) if window < 1 else int(window)
+
+
+def _envelope(Y, band):
+    """Returns the running max and min of every series over the band"""
+
+    width = 2 * band + 1
+    upper = sliding_window_view(np.pad(Y, ((0, 0), (band, band)), constant_values=-np.inf), width, axis=1).max(axis=2)
+    lower = sliding_window_view(np.pad(Y, ((0, 0), (band, band)), constant_values=np.inf), width, axis=1).min(axis=2)
+    return upper, lower
+
+
+def _keogh_terms(X, upper, lower):
+    """Returns the LB_Keogh term of every day: how far X leaves the envelope"""
+
+    return np.maximum(X - upper, 0) ** 2 + np.maximum(lower - X, 0) ** 2
+
+
+def _dtw_rows(X, Y, band, keep_rows=False, threshold=None):
+    """Runs the DTW recurrence for the pairs (X[b], Y[b]) all at once
+
+    Row i of the cost matrix is stored over the band only: offset o holds
+    column j = i - band + o. Returns the squared DTW distance of every pair
+    and, if keep_rows, the (n_pairs, n, 2 * band + 1) accumulated costs
+    (float32, inf outside the series).
+
+    With a threshold, a pair is abandoned (its distance returned as inf) as
+    soon as the cheapest cell of a row plus the LB_Keogh terms of the rows
+    left shows that its distance will exceed the threshold.
+    """
+
+    n_pairs, n = X.shape
+    width = 2 * band + 1
+    padded = np.pad(Y, ((0, 0), (band, band)))
+    windows = sliding_window_view(padded, width, axis=1)
+    rows = np.full((n_pairs, n, width), np.inf, dtype=np.float32) if keep_rows else None
+
+    # the row before the first only reaches cell (0, 0); the extra last offset stays inf
+    previous = np.full((n_pairs, width + 1), np.inf)
+    previous[:, band] = 0
+    current = np.full((n_pairs, width + 1), np.inf)
+
+    distances = np.full(n_pairs, np.inf)
+    pairs = np.arange(n_pairs)
+    if threshold is not None:
+        # lower bound of the cost of rows i + 1 to n - 1
+        terms = _keogh_terms(X, *_envelope(Y, band))
+        remaining = np.cumsum(terms[:, ::-1], axis=1)[:, ::-1]
+        remaining = np.concatenate([remaining[:, 1:], np.zeros((n_pairs, 1))], axis=1)
+
+    for i in range(n):
+        # offsets of the row that fall inside the series
+        lo, hi = max(band - i, 0), min(width, band + n - i)
+        cost = (X[:, i, None] - windows[:, i, lo:hi]) ** 2
+
+        # diagonal (same offset) and vertical (next offset) moves from the row above
+        reached = cost + np.minimum(previous[:, lo:hi], previous[:, lo + 1:hi + 1])
+
+        # horizontal moves within the row, cur[o] = min(reached[o], cost[o] + cur[o - 1]),
+        # unrolled into a running minimum over the cumulated costs
+        cumulated = np.cumsum(cost, axis=1)
+        current[:, lo:hi] = cumulated + np.minimum.accumulate(reached - cumulated, axis=1)
+        current[:, hi:] = np.inf
+
+        if keep_rows:
+            rows[:, i, lo:hi] = current[:, lo:hi]
+        previous, current = current, previous
+
+        # every few rows the pairs that can't get under their threshold are dropped from the batch
+        if threshold is not None and i % 16 == 15 and i < n - 1:
+            alive = previous[:, lo:hi].min(axis=1) + remaining[:, i] <= threshold
+            if not alive.all():
+                pairs, X, padded, threshold, remaining = (pairs[alive], X[alive], padded[alive], threshold[alive],
+                                                          remaining[alive])
+                previous, current = previous[alive], current[alive]
+                windows = sliding_window_view(padded, width, axis=1)
+                if not len(pairs):
+                    break
+
+    distances[pairs] = previous[:, band]
+    return distances, rows
+
+
+def _dtw_chunk(X, Y, band, threshold=None):
+    return _dtw_rows(X, Y, band, threshold=threshold)[0]
+
+
+def _dba_chunk(centroids, members, labels, band, k):
+    # accumulates, per cluster and centroid position, the member values warped onto it
+    n_pairs, n = centroids.shape
+    _, rows = _dtw_rows(centroids, members, band, keep_rows=True)
+    pairs = np.arange(n_pairs)
+    sums = np.zeros((n_pairs, n))
+    counts = np.zeros((n_pairs, n))
+
+    i = np.full(n_pairs, n - 1)
+    o = np.full(n_pairs, band)
+    active = np.ones(n_pairs, dtype=bool)
+    while active.any():
+        b, bi, bo = pairs[active], i[active], o[active]
+        sums[b, bi] += members[b, bi - band + bo]
+        counts[b, bi] += 1
+
+        # step back along the warping path to the cheapest predecessor
+        first = bi == 0
+        diagonal = np.where(first, np.inf, rows[b, np.maximum(bi - 1, 0), bo])
+        vertical = np.where(first | (bo == 2 * band), np.inf, rows[b, np.maximum(bi - 1, 0), np.minimum(bo + 1, 2 * band)])
+        horizontal = np.where(bo == 0, np.inf, rows[b, bi, np.maximum(bo - 1, 0)])
+        step = np.argmin(np.stack([diagonal, vertical, horizontal]), axis=0)
+
+        i[b] = bi - (step < 2)
+        o[b] = bo + (step == 1) - (step == 2)
+        active[b] = ~(first & (bi - band + bo == 0))
+
+    cluster_sums = np.zeros((k, n))
+    cluster_counts = np.zeros((k, n))
+    np.add.at(cluster_sums, labels, sums)
+    np.add.at(cluster_counts, labels, counts)
+    return cluster_sums, cluster_counts
+
+
+def _chunks(n_pairs, size):
+    return [slice(start, start + size) for start in range(0, n_pairs, size)]
+
+
+def dtw_distances(X, Y, window=WINDOW, executor=None, chunk_size=CHUNK_SIZE, threshold=None):
+    """Returns the squared DTW distance of every pair of series (X[b], Y[b])
+
+    Parameters
+    ----------
+    X, Y: numpy array
+        (n_pairs, n_days) series
+    window: float, optional
+        Sakoe-Chiba band, as a fraction of the series length (or a number of days if 1 or more)
+    executor: Executor, optional
+        Pool the batches are spread over (default is None, this process)
+    chunk_size: int, optional
+        Pairs per batch
+    threshold: numpy array, optional
+        Distance of every pair above which its exact value isn't needed: the
+        computation is abandoned early and inf returned (default is None)
+
+    Returns
+    -------
+    distances: numpy array
+        (n_pairs,) squared DTW distances
+    """
+
+    band = band_width(X.shape[1], window)
+    chunks = _chunks(len(X), chunk_size)
+    thresholds = [None if threshold is None else threshold[chunk] for chunk in chunks]
+    if executor is None:
+        results = map(_dtw_chunk, [X[chunk] for chunk in chunks], [Y[chunk] for chunk in chunks],
+                      [band] * len(chunks), thresholds)
+    else:
+        results = executor.map(_dtw_chunk, [X[chunk] for chunk in chunks], [Y[chunk] for chunk in chunks],
+                               [band] * len(chunks), thresholds)
+    return np.concatenate(list(results)) if chunks else np.zeros(0)
+
+
+def lower_bounds(series, centroids, window=WINDOW):
+    """Returns LB_Kim and LB_Keogh of the squared DTW distance of every series to every centroid
+
+    LB_Kim only compares the first and last days, which every warping path
+    matches; LB_Keogh sums how far a series leaves the centroid's envelope
+    (its running min and max over the band).
+
+    Returns
+    -------
+    lb_kim, lb_keogh: numpy array
+        (n_series, n_centroids) lower bounds
+    """
+
+    band = band_width(series.shape[1], window)
+    lb_kim = ((series[:, None, 0] - centroids[None, :, 0]) ** 2 +
+              (series[:, None, -1] - centroids[None, :, -1]) ** 2)
+
+    upper, lower = _envelope(centroids, band)
+    lb_keogh = np.stack([_keogh_terms(series, upper[c], lower[c]).sum(axis=1) for c in range(len(centroids))],
+                        axis=1)
+    return lb_kim, lb_keogh
+
+
+def assign(series, centroids, window=WINDOW, executor=None, labels=None):
+    """Returns the nearest centroid (by DTW) of every series, computing exact
+    distances only where the lower bounds can't rule a centroid out
+
+    Every series tries its centroids in order of lower bound; once the bound
+    of the next one is above the best distance found, none of the remaining
+    centroids can be nearer. Starting from the current labels (which rarely
+    change between iterations) makes the best distance tight from the start.
+
+    Returns
+    -------
+    labels: numpy array
+        Index of the nearest centroid of every series
+    distances: numpy array
+        Squared DTW distance to it
+    stats: dict
+        Numbers of candidate pairs, pairs ruled out by each bound, distances
+        computed and distances abandoned early
+    """
+
+    n_series, k = len(series), len(centroids)
+    lb_kim, lb_keogh = lower_bounds(series, centroids, window)
+    bound = np.maximum(lb_kim, lb_keogh)
+    order = np.argsort(bound, axis=1)
+
+    if labels is None:
+        best = np.full(n_series, np.inf)
+        labels = np.full(n_series, -1)
+        computed = abandoned = 0
+    else:
+        best = dtw_distances(series, centroids[labels], window, executor)
+        labels = labels.copy()
+        computed, abandoned = n_series, 0
+
+    for rank in range(k):
+        candidates = order[:, rank]
+        open_rows = bound[np.arange(n_series), candidates] < best
+        if not open_rows.any():
+            break
+        # the current label's distance is already known, but the centroids after it still need checking
+        todo = np.flatnonzero(open_rows & (candidates != labels))
+        if not len(todo):
+            continue
+        distances = dtw_distances(series[todo], centroids[candidates[todo]], window, executor,
+                                  threshold=best[todo])
+        better = distances < best[todo]
+        best[todo[better]] = distances[better]
+        labels[todo[better]] = candidates[todo[better]]
+        computed += len(todo)
+        abandoned += int(np.isinf(distances).sum())
+
+    # a pair is counted as pruned by the first (cheapest) bound that rules it out
+    pruned = bound >= best[:, None]
+    by_kim = int((lb_kim >= best[:, None]).sum())
+    stats = {'pairs': n_series * k, 'pruned_kim': by_kim, 'pruned_keogh': int(pruned.sum()) - by_kim,
+             'computed': computed, 'abandoned': abandoned}
+    return labels, best, stats
+
+
+def barycenters(series, centroids, labels, window=WINDOW, executor=None):
+    """Returns the centroids moved by one DBA (DTW barycenter averaging) step:
+    every centroid day becomes the mean of the member days warped onto it
+
+    Centroids of empty clusters are kept.
+    """
+
+    k, n = centroids.shape
+    band = band_width(n, window)
+    chunks = _chunks(len(series), DBA_CHUNK_SIZE)
+    args = ([centroids[labels[chunk]] for chunk in chunks], [series[chunk] for chunk in chunks],
+            [labels[chunk] for chunk in chunks], [band] * len(chunks), [k] * len(chunks))
+    results = list(map(_dba_chunk, *args) if executor is None else executor.map(_dba_chunk, *args))
+
+    sums = sum(result[0] for result in results)
+    counts = sum(result[1] for result in results)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+
+
+def initial_centroids(series, labels, k, seed=0):
+    """Returns the mean series of every cluster of labels (-1: no cluster); empty
+    clusters start from a random series"""
+
+    known = labels >= 0
+    counts = np.bincount(labels[known], minlength=k)
+    centroids = np.zeros((k, series.shape[1]))
+    np.add.at(centroids, labels[known], series[known])
+    centroids /= np.maximum(counts, 1)[:, None]
+
+    empty = np.flatnonzero(counts == 0)
+    if len(empty):
+        rng = np.random.default_rng(seed)
+        centroids[empty] = series[rng.choice(len(series), size=len(empty), replace=False)]
+    return centroids
+
+
+@instrumentation.timed()
+def dtw_kmeans(series, centroids, window=WINDOW, max_iter=MAX_ITER, executor=None):
+    """Clusters series with k-means under DTW, alternating the pruned
+    assignment and a DBA step of the centroids until no series moves
+
+    Parameters
+    ----------
+    series: numpy array
+        (n_series, n_days) series
+    centroids: numpy array
+        (k, n_days) initial centroids (see initial_centroids)
+    window: float, optional
+        Sakoe-Chiba band, as a fraction of the series length (default is 0.05)
+    max_iter: int, optional
+        Largest number of iterations
+    executor: Executor, optional
+        Pool the distance batches are spread over (default is None, this process)
+
+    Returns
+    -------
+    labels: numpy array
+        Cluster (0 to k-1) of every series
+    centroids: numpy array
+        (k, n_days) final centroids
+    stats: dict
+        Iterations, inertia (sum of squared DTW distances) and pair counts of the assignments
+    """
+
+    labels = None
+    stats = {'iterations': 0, 'pairs': 0, 'pruned_kim': 0, 'pruned_keogh': 0, 'computed': 0, 'abandoned': 0}
+    for _ in range(max_iter):
+        new_labels, distances, assigned = assign(series, centroids, window, executor, labels)
+        stats['iterations'] += 1
+        stats['inertia'] = float(distances.sum())
+        for key in ('pairs', 'pruned_kim', 'pruned_keogh', 'computed', 'abandoned'):
+            stats[key] += assigned[key]
+
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        centroids = barycenters(series, centroids, labels, window, executor)
+    return labels, centroids, stats
+
+
+@instrumentation.timed()
+def dtw_cluster_counties(matrix, previous=None, ks=clustering.K_RANGE, window=WINDOW, max_iter=MAX_ITER,
+                         max_workers=None, seed=0):
+    """Returns the DTW cluster labels of every county for every number of clusters
+
+    The county series are robust-scaled as in clustering.py. Every k starts
+    from the clusters of previous (or, without one, from the PCA clusters)
+    and its labels are renumbered to match them.
+
+    Parameters
+    ----------
+    matrix: CaseMatrix
+        Active cases of every county
+    previous: dataframe, optional
+        Labels to start from (as returned by clustering.read_clusters)
+    ks: iterable, optional
+        Numbers of clusters (default is 1 to 20)
+    window: float, optional
+        Sakoe-Chiba band, as a fraction of the series length (default is 0.05)
+    max_iter: int, optional
+        Largest number of k-means iterations per k
+    max_workers: int, optional
+        Number of processes the distance batches are spread over (default is
+        None, one per core; 1 computes them in this process)
+    seed: int, optional
+        Random seed
+
+    Returns
+    -------
+    df_clusters: dataframe
+        The county columns of matrix followed by one clusters_<k> column (labels 1 to k) per k
+    """
+
+    ks = list(ks)
+    series = clustering.robust_scale(matrix.values)
+    start = clustering.previous_labels(previous, matrix.fips, ks) if previous is not None else {}
+    missing = [k for k in ks if k not in start]
+    if missing:
+        start.update(clustering.cluster_sweep(clustering.embed(matrix.values, seed=seed), missing, seed=seed,
+                                              max_workers=max_workers)[0])
+
+    executor = None if max_workers == 1 else ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        columns = {}
+        for k in ks:
+            with instrumentation.span('dtw_clustering.k', k=k) as record:
+                labels, _, stats = dtw_kmeans(series, initial_centroids(series, start[k], k, seed), window, max_iter,
+                                              executor)
+                record.update(stats)
+            columns['clusters_{}'.format(k)] = clustering.match_labels(labels, start[k], k).astype(np.int32) + 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return pd.concat([matrix.counties, pd.DataFrame(columns)], axis=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cluster the counties by the shape of their active case '
+                                                 'time series (k-means under banded DTW)')
+    parser.add_argument('--output', default=OUTPUT_FILE,
+                        help='where the labels are written (default is Data/Counties_clustered_dtw.csv)')
+    parser.add_argument('--previous', default=None,
+                        help='labels to start from and keep the cluster numbers of (default is --output if it '
+                             'exists, else the PCA clusters of clustering.py)')
+    parser.add_argument('--k', type=int, nargs='+', default=list(clustering.K_RANGE),
+                        help='numbers of clusters (default is 1 to 20)')
+    parser.add_argument('--window', type=float, default=WINDOW,
+                        help='Sakoe-Chiba band as a fraction of the series length, or a number of days if 1 '
+                             'or more (default is 0.05)')
+    parser.add_argument('--max-iter', type=int, default=MAX_ITER, help='largest number of iterations per k')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default is one per core)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    instrumentation.configure_logging()
+    with instrumentation.span('dtw_clustering.run') as run:
+        cases = load_case_matrix(county_columns=clustering.COUNTY_COLUMNS)
+        earlier = clustering.read_clusters(args.previous or args.output)
+        run.update(last_date=cases.last_date, warm_start=earlier is not None)
+
+        clusters = dtw_cluster_counties(cases, earlier, args.k, args.window, args.max_iter, args.workers, args.seed)
+        clustering.write_clusters(clusters, args.output)
+    print('Wrote {} clusterings of {} counties up to {} to {}'.format(len(args.k), len(clusters), cases.last_date,
+                                                                      args.output))
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import numpy as np
+import data_sources
+
+
+# simplified county geometry used by the dashboard (built once from the plotly county GeoJSON)
+GEOMETRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'geojson-counties-simplified.json')
+
+# default simplification tolerance in degrees (~1 km, invisible at the dashboard's zoom levels)
+DEFAULT_TOLERANCE = 0.01
+
+
+def simplify_line(points, tolerance):
+    """Returns the points of a line kept by the Douglas-Peucker algorithm
+
+    Parameters
+    ----------
+    points: numpy array
+        A (n, 2) array of (longitude, latitude) points
+    tolerance: float
+        Largest distance (in degrees) a removed point may be from the simplified line
+
+    Returns
+    -------
+    points: numpy array
+        The simplified line (first and last points are always kept)
+    """
+
+    n = len(points)
+    if n < 3:
+        return points
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # iterative version of the recursion (counties can have thousands of points)
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last] - start
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return points[keep]
+
+
+def simplify_ring(ring, tolerance, decimals=4):
+    """Returns a simplified, closed polygon ring (at least 4 points) as nested lists"""
+
+    points = np.asarray(ring, dtype=np.float64)
+    simplified = simplify_line(points, tolerance)
+
+    # a ring needs at least 3 distinct corners to stay a polygon
+    if len(simplified) < 4:
+        simplified = points[np.linspace(0, len(points) - 1, min(len(points), 4)).astype(int)]
+
+    return np.round(simplified, decimals).tolist()
+
+
+def simplify_geojson(geojson, tolerance=DEFAULT_TOLERANCE):
+    """Returns a copy of a county FeatureCollection with simplified (Multi)Polygons"""
+
+    features = []
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            coordinates = [simplify_ring(ring, tolerance) for ring in geometry['coordinates']]
+        else:
+            coordinates = [[simplify_ring(ring, tolerance) for ring in polygon]
+                           for polygon in geometry['coordinates']]
+
+        # the dashboard only matches features by id, so properties are dropped
+        features.append({'type': 'Feature', 'id': feature['id'], 'properties': {},
+                         'geometry': {'type': geometry['type'], 'coordinates': coordinates}})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def build_county_geometry(tolerance=DEFAULT_TOLERANCE, path=GEOMETRY_FILE):
+    """Downloads the plotly county GeoJSON, simplifies it once and saves it
+
+    Parameters
+    ----------
+    tolerance: float, optional
+        Douglas-Peucker tolerance in degrees (default is 0.01)
+    path: str, optional
+        Where the simplified GeoJSON is written (default is
+        Data/geojson-counties-simplified.json)
+
+    Returns
+    -------
+    geojson: dict
+        The simplified county geometry
+    """
+
+    geojson = simplify_geojson(data_sources.read_json('counties_geojson'), tolerance)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(geojson, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+    return geojson
+
+
+def load_county_geometry(path=GEOMETRY_FILE):
+    """Returns the simplified county geometry, building it first if it doesn't exist yet"""
+
+    if not os.path.exists(path):
+        return build_county_geometry(path=path)
+
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the simplified county geometry used by the dashboard')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='simplification tolerance in degrees (default is 0.01)')
+    parser.add_argument('--output', default=GEOMETRY_FILE, help='path of the simplified GeoJSON')
+    args = parser.parse_args()
+
+    counties = build_county_geometry(args.tolerance, args.output)
+    print('Wrote {} counties to {} ({:.1f} MB)'.format(len(counties['features']), args.output,
+                                                       os.path.getsize(args.output) / 1e6))
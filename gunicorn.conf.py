@@ -0,0 +1,52 @@
+import os
+import threading
+
+# gunicorn settings for serving the dashboard with several workers (run `gunicorn` from this directory)
+wsgi_app = 'DashboardApp:server'
+bind = os.environ.get('MDA_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('MDA_WORKERS', 4))
+
+# the app is imported once in the master and the workers are forked from it
+preload_app = True
+
+# the read-only datasets are published here once and memory-mapped by every
+# worker, so adding workers adds almost no memory for data
+os.environ.setdefault('MDA_SHARED_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                     'Data', 'cache', 'shared'))
+
+# the per-date serving artifacts are precomputed here from the published datasets
+# (main.py may run on another host, and its artifacts never leave that host)
+os.environ.setdefault('MDA_ARTIFACT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       'Data', 'cache', 'artifacts'))
+
+
+def on_starting(server):
+    import geometry
+    import serving_artifacts
+    import shared_data
+
+    # the simplified county geometry is a build output: made once here, before any worker serves it
+    if not os.path.exists(geometry.GEOMETRY_FILE):
+        geometry.build_county_geometry()
+        server.log.info('Built the county geometry %s', geometry.GEOMETRY_FILE)
+
+    index = shared_data.build_shared_data(os.environ['MDA_SHARED_DIR'])
+    server.log.info('Published shared datasets up to %s', index['last_date'])
+
+    # only the days whose cases changed since the last start are computed
+    shared = shared_data.SharedData(os.environ['MDA_SHARED_DIR'])
+    artifacts = serving_artifacts.precompute(shared.case_matrix(), shared.routing_engine(),
+                                             os.environ['MDA_ARTIFACT_DIR'])
+    server.log.info('Precomputed serving artifacts of %d days', len(artifacts['dates']))
+
+
+def on_reload(server):
+    # `kill -HUP <master>` republishes the latest data; the new workers map the new files
+    on_starting(server)
+
+
+def post_fork(server, worker):
+    # every worker fills its callback cache for the page's defaults in the background
+    import DashboardApp
+
+    threading.Thread(target=DashboardApp.warm_up_cache, daemon=True).start()
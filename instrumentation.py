@@ -0,0 +1,229 @@
+import bisect
+import contextlib
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# record the peak traced memory of every root span (tracemalloc slows allocations, so it is opt-in)
+TRACE_MEMORY = os.environ.get('MDA_TRACE_MEMORY', '').lower() in ('1', 'true', 'yes')
+
+# where the structured run logs go when logging is configured (None: stderr)
+LOG_FILE = os.environ.get('MDA_LOG_FILE')
+
+# one JSON record per root span (a main.py run, a callback, a dataset load) is logged here
+logger = logging.getLogger('mda')
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Histogram:
+    """Cumulative latency histogram over fixed buckets (Prometheus style)"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def observe(name, seconds):
+    """Adds a duration to the histogram of name"""
+
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(seconds)
+
+
+def increment(name, amount=1, **labels):
+    """Adds to a counter (e.g. increment('data_sources.fetch', source='jhu', outcome='cached'))"""
+
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """Times a section of code and records it in the histogram of name
+
+    Spans nest per thread: a span opened inside another is logged as one of
+    its children, and the outermost (root) span writes one structured JSON
+    record with the whole tree to the 'mda' logger. The yielded dict can be
+    given more fields (e.g. row counts) to log with the span.
+
+    Parameters
+    ----------
+    name: str
+        Name of the span (also the histogram it is recorded in)
+    **fields
+        Extra fields logged with the span
+    """
+
+    stack = _stack()
+    record = dict(span=name, **fields)
+    if not stack and TRACE_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        stack.pop()
+        observe(name, record['seconds'])
+
+        if stack:
+            stack[-1].setdefault('children', []).append(record)
+        else:
+            if TRACE_MEMORY:
+                record['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(json.dumps(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), **record), default=str))
+
+
+def timed(name=None):
+    """Decorator running every call of a function in a span (named
+    module.function by default)"""
+
+    def decorator(function):
+        span_name = name or '{}.{}'.format(function.__module__, function.__qualname__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def in_current_span(function):
+    """Wraps function so that, when it runs in another thread (e.g. a thread
+    pool), its spans are logged as children of the caller's current span"""
+
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    if parent is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        inner = _stack()
+        inner.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            inner.pop()
+
+    return wrapper
+
+
+def configure_logging(path=LOG_FILE, level=logging.INFO):
+    """Writes the structured span records (one JSON object per line) to path,
+    or to stderr if path is None"""
+
+    handler = logging.StreamHandler(sys.stderr) if path is None else logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def snapshot():
+    """Returns a copy of all histograms and counters recorded so far"""
+
+    with _lock:
+        histograms = {name: {'buckets': list(h.buckets), 'counts': list(h.counts), 'count': h.count, 'sum': h.sum}
+                      for name, h in _histograms.items()}
+        counters = dict(_counters)
+    return histograms, counters
+
+
+def reset():
+    """Removes all recorded histograms and counters"""
+
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _metric_name(name):
+    return 'mda_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def render_metrics(gauges=()):
+    """Returns all histograms and counters (and the given gauges) in the
+    Prometheus text exposition format
+
+    Parameters
+    ----------
+    gauges: list, optional
+        Extra (name, labels dict, value) values to expose, e.g. cache hit rates
+    """
+
+    histograms, counters = snapshot()
+    lines = ['# HELP mda_span_seconds Duration of instrumented code sections',
+             '# TYPE mda_span_seconds histogram']
+    for name, h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(h['buckets'] + ['+Inf'], h['counts']):
+            cumulative += count
+            lines.append('mda_span_seconds_bucket{}'.format(_labels([('span', name), ('le', bound)])) +
+                         ' {}'.format(cumulative))
+        lines.append('mda_span_seconds_sum{} {:.6f}'.format(_labels([('span', name)]), h['sum']))
+        lines.append('mda_span_seconds_count{} {}'.format(_labels([('span', name)]), h['count']))
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        metric = _metric_name(name) + '_total'
+        if metric not in typed:
+            lines.append('# TYPE {} counter'.format(metric))
+            typed.add(metric)
+        lines.append('{}{} {}'.format(metric, _labels(labels), value))
+
+    for name, labels, value in gauges:
+        metric = _metric_name(name)
+        if metric not in typed:
+            lines.append('# TYPE {} gauge'.format(metric))
+            typed.add(metric)
+        lines.append('{}{} {}'.format(metric, _labels(sorted(labels.items())), value))
+
+    return '\n'.join(lines) + '\n'
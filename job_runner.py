@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import instrumentation
+
+
+# processes running heavy callbacks in each web worker (0: run them in the request thread)
+DEFAULT_WORKERS = int(os.environ.get('MDA_JOB_WORKERS', min(4, os.cpu_count() or 1)))
+
+# how often a waiting request checks whether it was superseded (and, for results
+# computed by another worker, whether they are ready)
+POLL_INTERVAL = 0.05
+
+# a job claimed by another worker for longer than this is assumed lost and computed here
+CLAIM_TIMEOUT = 120
+
+_missing = object()
+
+
+class Superseded(Exception):
+    """Raised to a request whose client sent a newer request before its result was ready"""
+
+
+class _Job:
+    """One computation in flight and the number of requests waiting for it"""
+
+    def __init__(self, future, on_done=None, inline=False):
+        self.future = future
+        self.on_done = on_done
+        self.inline = inline
+        self.waiters = 0
+
+
+class JobRunner:
+    """Runs heavy callbacks in a local process pool, storing their results in a
+    callback cache (in memory and, if it has a directory, on disk)
+
+    Identical requests share one computation: within a worker through the job
+    table, across workers through claim files next to the cached results.
+    Every client (a browser tab) only waits for its latest request: an older
+    one still waiting is answered with Superseded, and its job is cancelled if
+    nobody else waits for it and the pool hasn't picked it up yet.
+
+    Parameters
+    ----------
+    cache: CallbackCache
+        Where results are looked up first and stored once computed
+    max_workers: int, optional
+        Number of processes (default is MDA_JOB_WORKERS, or up to 4; 0 runs
+        jobs in the calling thread)
+    poll_interval: float, optional
+        Seconds between checks of a waiting request (default is 0.05)
+    claim_timeout: float, optional
+        Seconds after which another worker's claim is ignored (default is 120)
+    initializer: callable, optional
+        Called once in every process of the pool when it starts (default is None)
+    """
+
+    def __init__(self, cache, max_workers=DEFAULT_WORKERS, poll_interval=POLL_INTERVAL, claim_timeout=CLAIM_TIMEOUT,
+                 initializer=None):
+        self.cache = cache
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self._jobs = {}
+        self._latest = {}
+        # reentrant: cancelling a job runs its callbacks, which update the job table, right away
+        self._lock = threading.RLock()
+        self._pid = None
+        self._pool = None
+        self._claim_waiters = None
+
+    def _executors(self):
+        # created on first use in every process (gunicorn forks the workers after importing the app)
+        if self._pid != os.getpid():
+            self._pool = (ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+                          if self.max_workers else None)
+            self._claim_waiters = ThreadPoolExecutor(max_workers=4, thread_name_prefix='job-claims')
+            self._pid = os.getpid()
+        return self._pool, self._claim_waiters
+
+    def _start(self, key, function, args):
+        """Returns a new job computing function(*args) (the caller holds the lock)"""
+
+        pool, claim_waiters = self._executors()
+        if not self.cache.claim(key, self.claim_timeout):
+            # another worker computes it: wait for its result on disk instead
+            instrumentation.increment('job_runner.jobs', outcome='other_worker')
+            return _Job(claim_waiters.submit(self._await_claim, key, function, args),
+                        on_done=lambda done: self._forget(key, done))
+
+        instrumentation.increment('job_runner.jobs', outcome='started')
+        if pool is None:
+            return _Job(Future(), inline=True)
+        return _Job(pool.submit(function, *args), on_done=lambda done: self._store(key, done))
+
+    def _store(self, key, future):
+        # the result is cached before the job is forgotten, so a new request finds one or the other
+        try:
+            if not future.cancelled() and future.exception() is None:
+                self.cache.put(key, future.result())
+        finally:
+            self.cache.release(key)
+            self._forget(key, future)
+
+    def _forget(self, key, future):
+        with self._lock:
+            if key in self._jobs and self._jobs[key].future is future:
+                del self._jobs[key]
+
+    def _await_claim(self, key, function, args):
+        """Returns the result of a job claimed by another worker once it is stored
+        (or computes it here if that worker gave up)"""
+
+        while True:
+            while self.cache.is_claimed(key):
+                time.sleep(self.poll_interval)
+
+            value = self.cache.get(key, _missing)
+            if value is not _missing:
+                return value
+            if self.cache.claim(key, self.claim_timeout):
+                break
+
+        try:
+            pool = self._executors()[0]
+            value = function(*args) if pool is None else pool.submit(function, *args).result()
+            self.cache.put(key, value)
+            return value
+        finally:
+            self.cache.release(key)
+
+    def run(self, key, function, args, client=None):
+        """Returns the result of function(*args), from the cache, from an identical
+        job in flight or from a new job
+
+        Parameters
+        ----------
+        key: tuple
+            Identifies the result (e.g. the memoize key of the callback)
+        function: callable
+            Module-level function computing the result (it is sent to another process)
+        args: tuple
+            Arguments of function
+        client: hashable, optional
+            Sender of the request; a newer request of the same client
+            supersedes this one (default is None, never superseded)
+
+        Raises
+        ------
+        Superseded
+            If the client sent a newer request before the result was ready
+        """
+
+        value = self.cache.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        with self._lock:
+            if client is not None:
+                self._latest[client] = key
+            job = self._jobs.get(key)
+            started = job is None
+            if started:
+                job = self._jobs[key] = self._start(key, function, args)
+                if job.on_done is not None:
+                    job.future.add_done_callback(job.on_done)
+            else:
+                instrumentation.increment('job_runner.jobs', outcome='coalesced')
+            job.waiters += 1
+
+        try:
+            if started and job.inline:
+                self._run_here(key, job.future, function, args)
+            return self._wait(key, job, client)
+        finally:
+            with self._lock:
+                job.waiters -= 1
+                if not job.waiters and job.future.cancel():
+                    instrumentation.increment('job_runner.jobs', outcome='cancelled')
+                if client is not None and self._latest.get(client) == key:
+                    del self._latest[client]
+
+    def _run_here(self, key, future, function, args):
+        # without processes the first request computes the job and the identical ones wait for it
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(function(*args))
+        except Exception as error:
+            future.set_exception(error)
+        self._store(key, future)
+
+    def _wait(self, key, job, client):
+        while True:
+            try:
+                return job.future.result(timeout=self.poll_interval)
+            except FutureTimeoutError:
+                pass
+            except CancelledError:
+                raise Superseded(key)
+
+            if client is not None and self._latest.get(client) != key:
+                instrumentation.increment('job_runner.jobs', outcome='superseded')
+                raise Superseded(key)
+
+    def stats(self):
+        """Returns the number of jobs in flight and of requests waiting for them"""
+
+        with self._lock:
+            return {'jobs': len(self._jobs), 'waiters': sum(job.waiters for job in self._jobs.values())}
@@ -1,40 +1,250 @@
-from covid_data import get_covid_cases
+import argparse
+import base64
+import os
+import case_store
+import clustering
+import data_quality
+import data_sources
+import instrumentation
+import partitions
+import serving_artifacts
+from case_matrix import CaseMatrix
+from distance_index import read_edges
+from routing import RoutingEngine
+from covid_data import COUNTY_DTYPES, get_covid_cases, lookback_date, read_county_info
+import numpy as np
 import pandas as pd
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 from github import Github
 from github import InputGitTreeElement
 
-if __name__ == '__main__':
-    # get general county information
-    county_info = pd.read_csv(
-        'https://raw.githubusercontent.com/AnjaDeric/MDA-TeamCroatia/main/Data/county_info.csv')
-    county_info['fips'] = county_info['fips'].apply('{:0>5}'.format)
+OUTPUT_FILE = 'active_cases.csv'
 
-    # format yesterday's date
-    today = str(date.today()-timedelta(days=1))
-    today = str(int(today.split('-')[1])) + '/' + str(int(today.split('-')[2])) + '/' + \
-            today.split('-')[0][2:]
+# flagged ranges of the source data found in every run (see data_quality.py)
+QUALITY_REPORT = 'data_quality_report.csv'
 
-    # get cases up until yesterday (do not scale by population)
-    cases = get_covid_cases(start_date='1/1/21', end_date=today, scale=False)
 
-    # update column names to match old format
-    cases.columns = ['fips'] + ['d' + '{:0>2}'.format(d.split('/')[0]) +
-                                '{:0>2}'.format(d.split('/')[1]) +
-                                '20' + d.split('/')[2] for d in cases.columns[1:]]
+def to_column_name(date_str):
+    """Returns the output column name ('dMMDDYYYY') of a 'm/d/yy' date"""
+
+    return 'd' + '{:0>2}'.format(date_str.split('/')[0]) + '{:0>2}'.format(date_str.split('/')[1]) + \
+           '20' + date_str.split('/')[2]
+
+
+def date_columns(cases):
+    """Returns the names of the date ('dMMDDYYYY') columns of the output table"""
+
+    return [col for col in cases.columns if col.startswith('d') and len(col) == 9 and col[1:].isdigit()]
+
+
+def last_materialized_date(cases):
+    """Returns the last date with a column in the output file (or None if
+    the file has no date columns yet)
 
-    # merge county information with case counts and save to csv
-    cases = pd.merge(county_info, cases, on="fips", how="left")
+    Parameters
+    ----------
+    cases: dataframe
+        The current contents of the output file
+
+    Returns
+    -------
+    last_date: date
+        The latest date that already has a column in the output
+    """
+
+    dates = [datetime.strptime(col, 'd%m%d%Y').date() for col in date_columns(cases)]
+    if not dates:
+        return None
+    return max(dates)
+
+
+@instrumentation.timed('main.compute_cases')
+def compute_cases(start_date, end_date, county_info):
+    """Returns the unscaled active cases (int32) between two 'm/d/yy' dates with
+    the output column names, with county FIPS matching the mapbox geometry"""
+
+    cases = get_covid_cases(start_date=start_date, end_date=end_date, scale=False, county_info=county_info)
+
+    # update column names to match old format
+    cases.columns = ['fips'] + [to_column_name(d) for d in cases.columns[1:]]
 
     # change FIPS of one DS county to match format for mapbox (used later for plotting)
-    cases.loc[cases.fips == '46102', 'fips'] = '46113'
+    cases.loc[cases.fips == 46102, 'fips'] = 46113
+
+    return cases
+
+
+@instrumentation.timed('main.read_existing')
+def read_existing(output_file=OUTPUT_FILE, partition_dir=partitions.PARTITION_DIR):
+    """Returns the current active case table (or None if there is none yet),
+    read from the monthly partitions if they exist and from the CSV otherwise"""
+
+    if partitions.read_manifest(partition_dir) is not None:
+        return partitions.join_table(*partitions.read_partitions(locate=partitions.local_files(partition_dir)))
+    if os.path.exists(output_file):
+        return pd.read_csv(output_file, dtype=COUNTY_DTYPES)
+    return None
+
+
+def recompute_date(last_date, report_file=QUALITY_REPORT):
+    """Returns the first materialized date whose repaired counts may have
+    changed since the previous run (or None if there is none)
+
+    get_cumulative repairs every run of flagged days as a whole, shifted to
+    meet the good days on both sides of it, so new data changes the repair of
+    materialized days when it flags them for the first time (a downward
+    correction flags the overcounted days before it) or ends a run that reached
+    the last materialized date. The runs up to that date are compared with the
+    ones of the previous run's data-quality report (everything flagged counts
+    as new if there is no report).
+
+    Parameters
+    ----------
+    last_date: date
+        The last materialized date
+    report_file: str, optional
+        The data-quality report written by the previous run (default is
+        'data_quality_report.csv')
+
+    Returns
+    -------
+    first_date: date
+        The first date to recompute
+    """
+
+    store = case_store.open_case_store('confirmed')
+    scan = data_quality.scan_store(store)
+    lookback = lookback_date('1/1/21', 10)
+    runs = data_quality.merge_ranges(scan.report(lookback, case_store.format_date(last_date)))
+    if os.path.exists(report_file):
+        previous = pd.read_csv(report_file, parse_dates=['first_date', 'last_date'])
+        previous = previous[previous['first_date'] <= pd.Timestamp(last_date)]
+        previous['last_date'] = previous['last_date'].clip(upper=pd.Timestamp(last_date))
+        previous = data_quality.merge_ranges(previous)
+        changed = pd.merge(runs, previous, how='outer', indicator=True)
+        changed = changed[changed['_merge'] != 'both']
+    else:
+        changed = runs
+
+    # runs through the last materialized date that now end before the end of the store
+    ended = data_quality.merge_ranges(scan.report(lookback))
+    ended = ended[(ended['first_date'] <= pd.Timestamp(last_date)) & (ended['last_date'] >= pd.Timestamp(last_date))
+                  & (ended['last_date'] < pd.Timestamp(store.last_day))]
+
+    first_dates = pd.concat([changed['first_date'], ended['first_date']])
+    if len(first_dates) == 0:
+        return None
+    return first_dates.min().date()
+
+
+@instrumentation.timed('main.update_cases')
+def update_cases(end_date, county_info, full=False, output_file=OUTPUT_FILE, partition_dir=partitions.PARTITION_DIR,
+                 report_file=QUALITY_REPORT):
+    """Brings the output file up to end_date and returns the updated table
+    (or None if the output file is already up to date)
 
-    cases.to_csv('active_cases.csv', index=False)
-    cases_csv = cases.to_csv(sep=',', index=False)
+    In incremental mode only the days after the last materialized date are
+    computed (plus the lookback get_covid_cases needs) and appended to the
+    existing output; running it twice for the same day changes nothing. When
+    there are new days, the materialized days whose repair the new data
+    changed are recomputed with them (see recompute_date).
 
-    # files and names to upload to GitHub
-    file = cases_csv
-    file_name = 'active_cases_test.csv'
+    Parameters
+    ----------
+    end_date: date
+        The last date that should be in the output
+    county_info: dataframe
+        A dataframe containing all included counties and their information
+    full: bool, optional
+        Recompute every date from 1/1/21 instead of appending (default is False)
+    output_file: str, optional
+        Path of the active case CSV (default is 'active_cases.csv')
+    partition_dir: str, optional
+        Directory of the monthly partitions (default is 'active_cases')
+    report_file: str, optional
+        The data-quality report of the previous run (default is 'data_quality_report.csv')
+
+    Returns
+    -------
+    cases: dataframe
+        The updated active case table
+    """
+
+    start_date = date(2021, 1, 1)
+    existing = None
+    if not full:
+        existing = read_existing(output_file, partition_dir)
+    if existing is not None:
+        last_date = last_materialized_date(existing)
+        if last_date is not None:
+            start_date = last_date + timedelta(days=1)
+            if start_date <= end_date:
+                recompute = recompute_date(last_date, report_file)
+                if recompute is not None:
+                    start_date = max(min(start_date, recompute), date(2021, 1, 1))
+
+    if start_date > end_date:
+        return None
+
+    # get cases for the missing days only (do not scale by population)
+    new_cases = compute_cases(case_store.format_date(start_date), case_store.format_date(end_date), county_info)
+
+    if existing is None:
+        # merge county information with case counts
+        county_info = county_info.copy()
+        county_info.loc[county_info.fips == 46102, 'fips'] = 46113
+        return merge_cases(county_info, new_cases)
+
+    # drop any columns that are being recomputed (keeps reruns idempotent) and append the new days
+    existing = existing.drop(columns=[col for col in new_cases.columns[1:] if col in existing.columns])
+    return merge_cases(existing, new_cases)
+
+
+@instrumentation.timed('main.write_outputs')
+def write_outputs(cases, output_file=OUTPUT_FILE, partition_dir=partitions.PARTITION_DIR):
+    """Writes the active case table as monthly partitions (only the months whose
+    contents changed) and as the CSV export, and returns the changed partition files"""
+
+    changed = partitions.write_partitions(*partitions.split_table(cases), directory=partition_dir)
+    partitions.to_output_csv(cases, output_file)
+    return changed
+
+
+@instrumentation.timed('main.merge_cases')
+def merge_cases(counties, new_cases):
+    """Returns the county table with the new case columns added, with all
+    counts as int32 (nullable Int32 if a county has no case data)"""
+
+    cases = pd.merge(counties, new_cases, on='fips', how='left')
+    date_cols = date_columns(cases)
+    cases[date_cols] = cases[date_cols].astype('Int32' if cases[date_cols].isna().any().any() else np.int32)
+    return cases
+
+
+@instrumentation.timed('main.quality_report')
+def quality_report(end_date, report_file=QUALITY_REPORT):
+    """Writes the anomalies the data-quality scan found in the Johns Hopkins
+    cases the output is computed from (1/1/21 with its lookback up to end_date)
+    and returns the number of flagged ranges of every kind"""
+
+    end_date = case_store.format_date(end_date)
+    scan = data_quality.scan_store(case_store.open_case_store('confirmed', end_date))
+    report = scan.report(lookback_date('1/1/21', 10), end_date)
+    report.to_csv(report_file, index=False)
+
+    return {kind: int(count) for kind, count in report['kind'].value_counts().items()}
+
+
+@instrumentation.timed('main.push_to_github')
+def push_to_github(files):
+    """Commits files to the project GitHub repository
+
+    Parameters
+    ----------
+    files: dict
+        The content (str, or bytes for binary files such as the partitions) of
+        every file to commit, by its path in the repository
+    """
 
     # GitHub commit message
     commit_message = 'daily active case update'
@@ -48,8 +258,14 @@ if __name__ == '__main__':
 
     # create list of all elements to commit
     element_list = list()
-    element = InputGitTreeElement(file_name, '100644', 'blob', file)
-    element_list.append(element)
+    for file_name, file in files.items():
+        if isinstance(file, bytes):
+            # binary files are uploaded as base64 blobs first
+            blob = repo.create_git_blob(base64.b64encode(file).decode(), 'base64')
+            element = InputGitTreeElement(file_name, '100644', 'blob', sha=blob.sha)
+        else:
+            element = InputGitTreeElement(file_name, '100644', 'blob', file)
+        element_list.append(element)
     tree = repo.create_git_tree(element_list, base_tree)
 
     # commit file to GitHub
@@ -57,7 +273,99 @@ if __name__ == '__main__':
     commit = repo.create_git_commit(commit_message, tree, [parent])
     master_ref.edit(commit.sha)
 
-    # print success message
-    print('Update complete')
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the active case table and push it to GitHub')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute all dates from 1/1/21 instead of appending the new days')
+    parser.add_argument('--end-date', default=None,
+                        help='last date to materialize, as YYYY-MM-DD (default is yesterday)')
+    parser.add_argument('--output', default=OUTPUT_FILE, help='path of the active case CSV export')
+    parser.add_argument('--partitions', default=partitions.PARTITION_DIR,
+                        help='directory of the monthly compressed partitions (the primary output)')
+    parser.add_argument('--local-data', default=None,
+                        help='directory holding local copies of the source files (e.g. '
+                             'time_series_covid19_confirmed_US.csv, us-counties-2021.csv), '
+                             'used instead of downloading them')
+    parser.add_argument('--offline', action='store_true',
+                        help='never download, only use --local-data and previously cached files')
+    parser.add_argument('--quality-report', default=QUALITY_REPORT,
+                        help='CSV the flagged ranges of the source data are written to (default is '
+                             'data_quality_report.csv)')
+    parser.add_argument('--no-push', action='store_true', help='only write the local output files')
+    parser.add_argument('--push-csv', action='store_true',
+                        help='also push the CSV export (only the changed partitions are pushed by default)')
+    parser.add_argument('--log-file', default=instrumentation.LOG_FILE,
+                        help='file the structured (JSON) run log is appended to (default is MDA_LOG_FILE or stderr)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also log the peak traced memory of the run (slower)')
+    parser.add_argument('--artifacts', default=serving_artifacts.ARTIFACT_DIR,
+                        help='directory of the per-date serving artifacts precomputed after the update '
+                             '(default is MDA_ARTIFACT_DIR or Data/cache/artifacts)')
+    parser.add_argument('--no-precompute', action='store_true',
+                        help='skip precomputing the serving artifacts of the dashboard')
+    parser.add_argument('--recluster', action='store_true',
+                        help='also recluster the counties on the updated cases (warm-started from '
+                             'Data/Counties_clustered.csv, so the cluster numbers stay stable) and push the labels')
+    args = parser.parse_args()
+
+    instrumentation.configure_logging(args.log_file)
+    if args.trace_memory:
+        instrumentation.TRACE_MEMORY = True
+
+    if args.local_data is not None:
+        data_sources.LOCAL_DIR = args.local_data
+    if args.offline:
+        data_sources.OFFLINE = True
+
+    # the whole run is one span, logged with the time of every stage in it
+    with instrumentation.span('main.run', full=args.full) as run:
+        # get general county information
+        county_info = read_county_info()
+
+        # materialize up until yesterday by default
+        end_date = date.today() - timedelta(days=1)
+        if args.end_date is not None:
+            end_date = date.fromisoformat(args.end_date)
+        run['end_date'] = end_date.isoformat()
+
+        cases = update_cases(end_date, county_info, full=args.full, output_file=args.output,
+                             partition_dir=args.partitions, report_file=args.quality_report)
+
+        # the data-quality report is written on every run, also when nothing new is computed
+        run['quality'] = quality_report(end_date, args.quality_report)
+        print('Data quality: ' + (', '.join('{} {} ranges'.format(count, kind)
+                                             for kind, count in run['quality'].items()) or 'no anomalies'))
+        if cases is None:
+            print('Already up to date')
+        else:
+            # only the partitions whose contents changed (normally the current month) are rewritten
+            changed = write_outputs(cases, args.output, args.partitions)
+            run['changed_files'] = changed
+
+            # the dashboard's per-date colors and trees (only days whose data changed are computed)
+            if not args.no_precompute:
+                counties, dates, values = partitions.split_table(cases)
+                matrix = CaseMatrix(counties[['fips', 'county', 'population']], dates, values)
+                index = serving_artifacts.precompute(matrix, RoutingEngine(read_edges()), args.artifacts)
+                run['artifact_days'] = len(index['dates'])
+
+            if args.recluster:
+                clusters = clustering.cluster_counties(CaseMatrix(*partitions.split_table(cases)),
+                                                       clustering.read_clusters())
+                clustering.write_clusters(clusters)
+
+            if not args.no_push:
+                files = dict()
+                for file_name in changed:
+                    with open(os.path.join(args.partitions, file_name), 'rb') as f:
+                        files[partitions.PARTITION_DIR + '/' + file_name] = f.read()
+                if args.push_csv:
+                    files['active_cases_test.csv'] = partitions.to_output_csv(cases)
+                if args.recluster:
+                    with open(clustering.OUTPUT_FILE) as f:
+                        files['Data/Counties_clustered.csv'] = f.read()
+                push_to_github(files)
 
+            # print success message
+            print('Update complete')
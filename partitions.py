@@ -0,0 +1,239 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+import data_sources
+import instrumentation
+from covid_data import COUNTY_DTYPES
+
+
+# the active case table is published as one compressed .npz file per month, plus
+# the county columns and a manifest (all with unique names, see data_sources.LOCAL_DIR)
+PARTITION_DIR = 'active_cases'
+MANIFEST_FILE = 'active_cases-manifest.json'
+COUNTIES_FILE = 'active_cases-counties.csv'
+
+# seconds the published manifest is trusted before asking the server again
+MANIFEST_TTL = 3600
+
+
+def partition_file(month):
+    """Returns the file name of a month's partition ('YYYY-MM')"""
+
+    return 'active_cases-{}.npz'.format(month)
+
+
+def _digest(*arrays):
+    """Returns a SHA-1 of array contents (used to tell which partitions changed)"""
+
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+    return sha1.hexdigest()
+
+
+def _month_digest(fips, values, first_day):
+    return _digest(fips, values, np.array(first_day))
+
+
+def compact_counts(values):
+    """Returns counts as int32, or float32 if some are missing (NaN)"""
+
+    values = np.asarray(values, dtype=np.float32)
+    if np.isnan(values).any():
+        return values
+    return values.astype(np.int32)
+
+
+def split_table(cases):
+    """Splits an active case table (county columns + one 'dMMDDYYYY' column per
+    day) into its county columns, dates and a fips x day count matrix"""
+
+    date_cols = [col for col in cases.columns if col.startswith('d') and len(col) == 9 and col[1:].isdigit()]
+    counties = cases[[col for col in cases.columns if col not in date_cols]].reset_index(drop=True)
+    dates = pd.to_datetime(pd.Index(date_cols), format='d%m%d%Y')
+    return counties, dates, compact_counts(cases[date_cols].to_numpy(dtype=np.float32))
+
+
+def join_table(counties, dates, values):
+    """Returns the active case table (the layout of active_cases.csv) of
+    county columns, dates and a fips x day count matrix"""
+
+    counts = pd.DataFrame(values, columns=dates.strftime('d%m%d%Y'))
+    if np.issubdtype(values.dtype, np.floating):
+        counts = counts.astype('Int32')
+    return pd.concat([counties.reset_index(drop=True), counts], axis=1)
+
+
+def to_output_csv(cases, path=None):
+    """Writes (or returns as text, if path is None) the active case table with
+    5-digit FIPS codes, the CSV format published for compatibility"""
+
+    cases = cases.copy()
+    cases['fips'] = cases['fips'].map('{:0>5}'.format)
+    return cases.to_csv(path, sep=',', index=False)
+
+
+def read_manifest(directory=PARTITION_DIR):
+    """Returns the manifest of a local partition directory (None if there is none)"""
+
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+@instrumentation.timed()
+def write_partitions(counties, dates, values, directory=PARTITION_DIR):
+    """Writes the active case table as monthly partitions, rewriting only the
+    files whose contents changed
+
+    Parameters
+    ----------
+    counties: dataframe
+        The county columns (one row per county, fips as uint32)
+    dates: DatetimeIndex
+        The day of every column of values
+    values: numpy array
+        (n_counties, n_days) active cases
+    directory: str, optional
+        Where the partitions are written (default is 'active_cases')
+
+    Returns
+    -------
+    changed: list
+        The names of all files that were (re)written, manifest included
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    previous = read_manifest(directory) or {'months': {}}
+    changed = []
+
+    def write(file_name, data):
+        path = os.path.join(directory, file_name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        changed.append(file_name)
+
+    counties_csv = counties.to_csv(index=False).encode()
+    manifest = {'last_day': dates[-1].strftime('%Y-%m-%d'), 'counties': hashlib.sha1(counties_csv).hexdigest(),
+                'months': {}}
+    if manifest['counties'] != previous.get('counties'):
+        write(COUNTIES_FILE, counties_csv)
+
+    fips = counties['fips'].to_numpy(dtype=np.uint32)
+    months = dates.strftime('%Y-%m')
+    for month in pd.unique(months):
+        columns = np.flatnonzero(months == month)
+        first_day = dates[columns[0]].strftime('%Y-%m-%d')
+        month_values = compact_counts(values[:, columns])
+
+        entry = {'file': partition_file(month), 'first_day': first_day, 'n_days': len(columns),
+                 'sha1': _month_digest(fips, month_values, first_day)}
+        manifest['months'][month] = entry
+
+        # a finished month never changes again, so daily updates only rewrite the current one
+        if previous['months'].get(month, {}).get('sha1') != entry['sha1']:
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, fips=fips, values=month_values)
+            write(entry['file'], buffer.getvalue())
+
+    if changed or previous != manifest:
+        write(MANIFEST_FILE, json.dumps(manifest, indent=1).encode())
+
+    return changed
+
+
+def local_files(directory=PARTITION_DIR):
+    """Returns a locator of partition files in a local directory"""
+
+    return lambda file_name, refresh=False: os.path.join(directory, file_name)
+
+
+def published_files(file_name, refresh=False):
+    """Returns the path of a published partition file (through the data_sources
+    cache; refresh downloads it again)"""
+
+    if file_name == MANIFEST_FILE:
+        return data_sources.fetch('active_cases_partition', ttl=0 if refresh else MANIFEST_TTL, file_name=file_name)
+    return data_sources.fetch('active_cases_partition', ttl=0 if refresh else None, file_name=file_name)
+
+
+@instrumentation.timed()
+def read_partitions(first_month=None, last_month=None, county_columns=None, locate=published_files):
+    """Returns the active cases of a range of months, reading only those partitions
+
+    Parameters
+    ----------
+    first_month, last_month: str, optional
+        First and last month ('YYYY-MM') to read (default is None, no limit)
+    county_columns: list, optional
+        County columns to read (default is None, in which case all are read)
+    locate: callable, optional
+        Returns the path of a partition file name (default is published_files,
+        the files published on GitHub; see local_files for a local directory)
+
+    Returns
+    -------
+    counties: dataframe
+        The county columns (one row per matrix row)
+    dates: DatetimeIndex
+        The day of every matrix column
+    values: numpy array
+        (n_counties, n_days) active cases (int32, or float32 if some are missing)
+    """
+
+    with open(locate(MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    counties = pd.read_csv(locate(COUNTIES_FILE), usecols=county_columns,
+                           dtype={col: dtype for col, dtype in COUNTY_DTYPES.items()
+                                  if county_columns is None or col in county_columns})
+    fips = counties['fips'].to_numpy(dtype=np.uint32) if 'fips' in counties else None
+
+    blocks, dates = [], []
+    for month in sorted(manifest['months']):
+        if (first_month is not None and month < first_month) or (last_month is not None and month > last_month):
+            continue
+        entry = manifest['months'][month]
+
+        # a cached copy that doesn't match the manifest is downloaded again (once)
+        for refresh in (False, True):
+            with np.load(locate(entry['file'], refresh)) as data:
+                month_fips, month_values = data['fips'], data['values']
+            if _month_digest(month_fips, month_values, entry['first_day']) == entry['sha1']:
+                break
+        else:
+            raise ValueError('partition {} does not match its manifest'.format(entry['file']))
+
+        if fips is not None and not np.array_equal(month_fips, fips):
+            raise ValueError('partition {} has different counties'.format(entry['file']))
+
+        blocks.append(month_values)
+        dates.append(pd.date_range(entry['first_day'], periods=entry['n_days']))
+
+    values = np.concatenate(blocks, axis=1) if blocks else np.zeros((len(counties), 0), dtype=np.int32)
+    dates = dates[0].append(dates[1:]) if dates else pd.DatetimeIndex([])
+    return counties, dates, values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert between active_cases.csv and its monthly partitions')
+    parser.add_argument('command', choices=['split', 'join'],
+                        help='split: write partitions from the CSV, join: write the CSV from the partitions')
+    parser.add_argument('--csv', default='active_cases.csv', help='path of the active case CSV')
+    parser.add_argument('--partitions', default=PARTITION_DIR, help='directory of the partitions')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        table = pd.read_csv(args.csv, dtype=COUNTY_DTYPES)
+        written = write_partitions(*split_table(table), directory=args.partitions)
+        print('Wrote {} files to {}'.format(len(written), args.partitions))
+    else:
+        to_output_csv(join_table(*read_partitions(locate=local_files(args.partitions))), args.csv)
+        print('Wrote {}'.format(args.csv))
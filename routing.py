@@ -0,0 +1,409 @@
+import heapq
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+import instrumentation
+
+
+# travel time of arcs with only a road distance (km/h), and driving time per day of a trip
+DRIVING_SPEED_KMH = 80
+DRIVING_MINUTES_PER_DAY = 8 * 60
+
+# days of case data read for a time-dependent search (later arrivals use the last of them)
+TRIP_DAYS = 14
+
+
+class RoutingEngine:
+    """County adjacency graph stored once as a compressed sparse row (CSR)
+    structure, used for both the shortest (distance) and safest (cases) paths
+
+    Every adjacency is stored as two directed arcs. An arc's case weight is
+    the value of the county it leads into, so the weight of a path is the
+    sum over all counties on it except the origin. Arcs also carry a travel
+    time (minutes), taken from the duration column, or else from the road
+    distance at DRIVING_SPEED_KMH.
+    """
+
+    # the arrays an engine is made of (see arrays and from_arrays)
+    ARRAYS = ('nodes', 'arc_src', 'indices', 'indptr', 'distance', 'minutes', 'arc_keys')
+
+    @instrumentation.timed('routing.build_graph')
+    def __init__(self, df_edges, source='county_fips', target='bcounty_fips', distance='gc_dist_km',
+                 duration='duration_min', road_distance='d_dist_km'):
+        u = df_edges[source].to_numpy()
+        v = df_edges[target].to_numpy()
+
+        # nodes are the FIPS codes (as in df_edges), numbered in sorted order
+        self.nodes = np.unique(np.concatenate([u, v]))
+        node_index = pd.Index(self.nodes)
+
+        # both directions of every adjacency, sorted by origin node
+        src = np.concatenate([node_index.get_indexer(u), node_index.get_indexer(v)])
+        dst = np.concatenate([node_index.get_indexer(v), node_index.get_indexer(u)])
+        dist = np.tile(df_edges[distance].to_numpy(dtype=np.float64), 2)
+        if duration in df_edges:
+            minutes = df_edges[duration].to_numpy(dtype=np.float64)
+        else:
+            km = df_edges[road_distance if road_distance in df_edges else distance].to_numpy(dtype=np.float64)
+            minutes = km / DRIVING_SPEED_KMH * 60
+        minutes = np.tile(minutes, 2)
+        order = np.lexsort((dst, src))
+
+        n = len(self.nodes)
+        self.arc_src = src[order]
+        self.indices = dst[order].astype(np.int32)
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(self.arc_src, minlength=n))]).astype(np.int32)
+        self.distance = dist[order]
+        self.minutes = minutes[order]
+
+        # arcs are sorted by (origin, destination), so these keys are sorted too
+        self.arc_keys = self.arc_src.astype(np.int64) * n + self.indices
+        self._setup()
+
+    def _setup(self):
+        """Derives the lookups that are not stored in the engine's arrays"""
+
+        self.n = len(self.nodes)
+        self.node_index = pd.Index(self.nodes)
+        self.distance_graph = self.graph(self.distance)
+
+    def arrays(self):
+        """Returns the arrays the engine is made of, by name"""
+
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Returns an engine over existing arrays (as returned by arrays()) without
+        copying them, e.g. memory-mapped files shared by several processes"""
+
+        engine = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(engine, name, arrays[name])
+        engine._setup()
+        return engine
+
+    def graph(self, arc_weights):
+        """Returns a sparse graph over the stored structure with the given arc weights"""
+
+        # built from (data, indices, indptr) so zero weights stay explicit edges
+        return csr_matrix((arc_weights, self.indices, self.indptr), shape=(self.n, self.n))
+
+    def node_values(self, fips, values):
+        """Returns a vector with one value per node (NaN for nodes missing from fips)
+
+        Parameters
+        ----------
+        fips: array-like
+            FIPS codes of the given values (same format as the edge list)
+        values: array-like
+            One value per FIPS code (e.g. the active cases of one day)
+
+        Returns
+        -------
+        node_values: numpy array
+            The values in node order
+        """
+
+        node_values = np.full(self.n, np.nan)
+        rows = self.node_index.get_indexer(fips)
+        found = rows >= 0
+        node_values[rows[found]] = np.asarray(values, dtype=np.float64)[found]
+        return node_values
+
+    def case_weights(self, node_cases):
+        """Returns the arc weights of the safest-path graph for a node case vector
+
+        Arcs touching a county without case data are removed (infinite weight),
+        like the rows an inner merge with the day's cases would drop.
+        """
+
+        weights = node_cases[self.indices]
+        weights[np.isnan(weights) | np.isnan(node_cases[self.arc_src])] = np.inf
+        return weights
+
+    def node_id(self, fips):
+        """Returns the node number of a FIPS code"""
+
+        return self.node_index.get_loc(fips)
+
+    @instrumentation.timed('routing.dijkstra')
+    def tree(self, origin, arc_weights=None):
+        """Returns the single-source shortest path tree of an origin node
+
+        Parameters
+        ----------
+        origin: int or array-like
+            Node number(s) of the origin(s)
+        arc_weights: numpy array, optional
+            Arc weights (default is None, in which case the distances are used)
+
+        Returns
+        -------
+        costs: numpy array
+            Cost from the origin to every node (inf if unreachable)
+        predecessors: numpy array
+            Previous node on the best path to every node (-9999 if none)
+        """
+
+        graph = self.distance_graph if arc_weights is None else self.graph(arc_weights)
+        return dijkstra(graph, directed=True, indices=origin, return_predecessors=True)
+
+    @staticmethod
+    def unwind(predecessors, origin, target):
+        """Returns the node numbers on the path from origin to target (empty if unreachable)"""
+
+        if origin != target and predecessors[target] < 0:
+            return []
+        path = [target]
+        while path[-1] != origin:
+            path.append(predecessors[path[-1]])
+        return path[::-1]
+
+    def route(self, origin_fips, target_fips, arc_weights=None):
+        """Returns the best path between two counties
+
+        Parameters
+        ----------
+        origin_fips, target_fips:
+            FIPS codes of the first and last county
+        arc_weights: numpy array, optional
+            Arc weights (default is None, in which case the distances are used)
+
+        Returns
+        -------
+        cost: float
+            Total weight of the path (inf if there is no path)
+        path: list
+            FIPS codes of all counties on the path, in order
+        """
+
+        costs, predecessors = self.tree(self.node_id(origin_fips), arc_weights)
+        return self.route_in_tree(costs, predecessors, origin_fips, target_fips)
+
+    def route_in_tree(self, costs, predecessors, origin_fips, target_fips):
+        """Returns the best path between two counties (cost, FIPS codes) read
+        off the tree of the origin (as returned by tree(), e.g. precomputed)"""
+
+        origin, target = self.node_id(origin_fips), self.node_id(target_fips)
+        # (older scipy versions also record predecessors over infinite-weight arcs)
+        if not np.isfinite(costs[target]):
+            return costs[target], []
+        path = self.unwind(predecessors, origin, target)
+        return costs[target], self.nodes[path].tolist()
+
+    def arc_positions(self, src, dst):
+        """Returns the arc positions of (arrays of) origin/destination node pairs"""
+
+        return np.searchsorted(self.arc_keys, np.asarray(src, dtype=np.int64) * self.n + dst)
+
+    def tree_totals(self, predecessors, arc_weights):
+        """Returns, for every node of one or more shortest path trees, the sum
+        of arc_weights along its tree path and the number of arcs on it
+
+        Uses pointer jumping: every step adds the total of a node's current
+        ancestor and jumps to that ancestor's ancestor, so a tree of depth d
+        is summed in log2(d) vectorized steps instead of walking every path.
+
+        Parameters
+        ----------
+        predecessors: numpy array
+            (n_trees, n_nodes) predecessor arrays as returned by tree()
+        arc_weights: numpy array
+            The arc weights to sum (need not be the ones the trees were built with)
+
+        Returns
+        -------
+        totals: numpy array
+            (n_trees, n_nodes) summed weights (0 for roots and unreachable nodes)
+        arcs: numpy array
+            (n_trees, n_nodes) number of arcs on each tree path
+        """
+
+        predecessors = np.atleast_2d(predecessors).astype(np.int64)
+        rows = np.arange(predecessors.shape[0])[:, np.newaxis]
+        ancestor = np.where(predecessors >= 0, predecessors, -1)
+        has_ancestor = ancestor >= 0
+
+        arcs_to_node = self.arc_positions(np.where(has_ancestor, ancestor, 0), np.arange(self.n))
+        totals = np.where(has_ancestor, arc_weights[np.minimum(arcs_to_node, len(arc_weights) - 1)], 0.0)
+        arcs = has_ancestor.astype(np.int64)
+
+        while has_ancestor.any():
+            jump = np.where(has_ancestor, ancestor, 0)
+            totals = totals + np.where(has_ancestor, totals[rows, jump], 0.0)
+            arcs = arcs + np.where(has_ancestor, arcs[rows, jump], 0)
+            ancestor = np.where(has_ancestor, ancestor[rows, jump], -1)
+            has_ancestor = ancestor >= 0
+
+        return totals, arcs
+
+    @instrumentation.timed('routing.batch_routes')
+    def batch_routes(self, pairs, node_cases):
+        """Returns the safest and shortest path metrics of many origin-destination
+        pairs, running one single-source search per distinct origin
+
+        Parameters
+        ----------
+        pairs: list
+            (origin FIPS, destination FIPS) pairs
+        node_cases: numpy array
+            Cases per node (see node_values)
+
+        Returns
+        -------
+        routes: dataframe
+            One row per pair with the distance (km), total cases and number of
+            counties of the safest and of the shortest path (NaN if unreachable)
+        """
+
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        origin_ids = self.node_index.get_indexer(pairs[:, 0])
+        target_ids = self.node_index.get_indexer(pairs[:, 1])
+        unknown = np.concatenate([pairs[origin_ids < 0, 0], pairs[target_ids < 0, 1]])
+        if len(unknown):
+            raise ValueError('unknown FIPS codes: {}'.format(sorted(set(unknown.tolist()))))
+
+        # one tree per distinct origin serves every pair starting there
+        origins, tree_rows = np.unique(origin_ids, return_inverse=True)
+        case_weights = self.case_weights(node_cases)
+
+        safe_cost, safe_pred = self.tree(origins, case_weights)
+        short_cost, short_pred = self.tree(origins)
+        safe_km, safe_arcs = self.tree_totals(safe_pred, self.distance)
+        short_cases, short_arcs = self.tree_totals(short_pred, case_weights)
+
+        def metric(values, cost):
+            picked = values[tree_rows, target_ids].astype(np.float64)
+            picked[~np.isfinite(cost[tree_rows, target_ids])] = np.nan
+            return picked
+
+        return pd.DataFrame({'from': pairs[:, 0], 'to': pairs[:, 1],
+                             'safest_km': metric(safe_km, safe_cost),
+                             'safest_cases': metric(safe_cost, safe_cost),
+                             'safest_counties': metric(safe_arcs + 1, safe_cost),
+                             'shortest_km': metric(short_cost, short_cost),
+                             'shortest_cases': metric(short_cases, short_cost),
+                             'shortest_counties': metric(short_arcs + 1, short_cost)})
+
+    def path_weight(self, path_fips, arc_weights=None):
+        """Returns the total weight of a path given by FIPS codes"""
+
+        path = self.node_index.get_indexer(path_fips)
+        weights = self.distance if arc_weights is None else arc_weights
+        return weights[self.arc_positions(path[:-1], path[1:])].sum()
+
+    def trip_cases(self, fips, cases, first_day, n_days=TRIP_DAYS):
+        """Returns the cases of every node on every day of a trip, read from a fips x day array
+
+        Parameters
+        ----------
+        fips: array-like
+            FIPS code of every row of cases
+        cases: numpy array
+            (n_rows, n_days) cases (e.g. the values of a CaseMatrix)
+        first_day: int
+            Column of the departure day
+        n_days: int, optional
+            Number of trip days (default is 14); days past the last column of cases get its cases
+
+        Returns
+        -------
+        trip_cases: numpy array
+            (n_nodes, n_days) cases in node order (NaN for nodes missing from fips)
+        """
+
+        columns = np.minimum(np.arange(first_day, first_day + n_days), cases.shape[1] - 1)
+        rows = pd.Index(fips).get_indexer(self.nodes)
+        trip_cases = np.full((self.n, n_days), np.nan)
+        trip_cases[rows >= 0] = cases[rows[rows >= 0]][:, columns]
+        return trip_cases
+
+    def arrival_days(self, path_fips, minutes_per_day=DRIVING_MINUTES_PER_DAY):
+        """Returns the trip day (0 for the departure day) every county of a path is reached on"""
+
+        path = self.node_index.get_indexer(path_fips)
+        minutes = np.concatenate([[0], np.cumsum(self.minutes[self.arc_positions(path[:-1], path[1:])])])
+        return (minutes // minutes_per_day).astype(np.int64)
+
+    def trip_path_weight(self, path_fips, trip_cases, minutes_per_day=DRIVING_MINUTES_PER_DAY):
+        """Returns the total cases of a path when every county weighs its cases on its arrival day"""
+
+        path = self.node_index.get_indexer(path_fips)
+        days = np.minimum(self.arrival_days(path_fips, minutes_per_day), trip_cases.shape[1] - 1)
+        return trip_cases[path[1:], days[1:]].sum()
+
+    @instrumentation.timed('routing.time_dependent_route')
+    def time_dependent_route(self, origin_fips, target_fips, trip_cases, minutes_per_day=DRIVING_MINUTES_PER_DAY):
+        """Returns the safest path between two counties when every county weighs
+        its cases on the day the traveller gets there
+
+        The search runs over (county, trip day) states in order of cases, so
+        a county reached on two different days keeps both, and arc weights are
+        looked up in trip_cases instead of building one graph per day.
+        Arrival days follow the travel time of the arcs, at minutes_per_day
+        of driving per day; a state is reached at the earliest time among its
+        safest paths.
+
+        Parameters
+        ----------
+        origin_fips, target_fips:
+            FIPS codes of the first and last county
+        trip_cases: numpy array
+            (n_nodes, n_days) cases of every node on every trip day (see
+            trip_cases); arrivals after the last day use its cases
+        minutes_per_day: float, optional
+            Driving time per day (default is 8 hours)
+
+        Returns
+        -------
+        cost: float
+            Total cases on the path, each on its arrival day (inf if there is no path)
+        path: list
+            FIPS codes of all counties on the path, in order
+        days: list
+            Trip day every county of the path is reached on (at most the last day of trip_cases)
+        """
+
+        origin, target = self.node_id(origin_fips), self.node_id(target_fips)
+        last_day = trip_cases.shape[1] - 1
+        weights = trip_cases.tolist()
+        heads, starts, minutes = self.indices.tolist(), self.indptr.tolist(), self.minutes.tolist()
+
+        # counties without case data are left out, as in case_weights
+        if np.isnan(trip_cases[origin, 0]):
+            return np.inf, [], []
+
+        best = {(origin, 0): (0.0, 0.0)}
+        previous = {(origin, 0): None}
+        heap = [(0.0, 0.0, origin, 0)]
+        settled = set()
+        while heap:
+            cost, time, node, day = heapq.heappop(heap)
+            if (node, day) in settled:
+                continue
+            settled.add((node, day))
+            if node == target:
+                break
+
+            for arc in range(starts[node], starts[node + 1]):
+                head = heads[arc]
+                arrival = time + minutes[arc]
+                state = (head, min(int(arrival // minutes_per_day), last_day))
+                weight = weights[head][state[1]]
+                if weight != weight or state in settled:
+                    continue
+                label = (cost + weight, arrival)
+                if label < best.get(state, (np.inf, np.inf)):
+                    best[state] = label
+                    previous[state] = (node, day)
+                    heapq.heappush(heap, label + state)
+        else:
+            return np.inf, [], []
+
+        states = [(node, day)]
+        while previous[states[-1]] is not None:
+            states.append(previous[states[-1]])
+        states.reverse()
+        return cost, self.nodes[[node for node, _ in states]].tolist(), [day for _, day in states]
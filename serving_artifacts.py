@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import instrumentation
+from case_matrix import load_case_matrix
+from distance_index import read_edges
+from routing import RoutingEngine
+
+
+# directory the per-date serving artifacts are written to and memory-mapped from
+ARTIFACT_DIR = os.environ.get('MDA_ARTIFACT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               'Data', 'cache', 'artifacts'))
+
+INDEX_FILE = 'index.json'
+
+# origins whose safest-path trees are precomputed: MDA_HOT_ORIGINS (comma-separated
+# FIPS) if set, otherwise the dashboard's default origin and the most populous counties
+HOT_ORIGINS = [int(code) for code in os.environ.get('MDA_HOT_ORIGINS', '').split(',') if code.strip()]
+DEFAULT_ORIGINS = [49003, 47185]
+N_POPULOUS_ORIGINS = 25
+
+# trees and arc weights are kept for the latest TREE_DAYS days (older days only get colors)
+TREE_DAYS = int(os.environ.get('MDA_TREE_DAYS', 14))
+
+# the routing engine of each precompute process (see _init_worker)
+_engine = None
+
+
+def is_published(directory):
+    """Returns True if serving artifacts have been written to directory"""
+
+    return os.path.exists(os.path.join(directory, INDEX_FILE))
+
+
+def day_colors(values, population):
+    """Returns the choropleth color of every county (active cases per thousand
+    residents) for one or more days, in matrix row order"""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1000 * (np.asarray(values, dtype=np.float64).T / population).T
+
+
+def day_key(values, population):
+    """Returns the key of one day's inputs (its cases and the populations), so
+    artifacts are only recomputed for days whose data changed"""
+
+    digest = hashlib.sha1(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(population, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def graph_key(engine, origins):
+    """Returns the key of the routing graph and the hot origins the trees depend on"""
+
+    digest = hashlib.sha1(np.asarray(origins, dtype=np.int64).tobytes())
+    for name, array in sorted(engine.arrays().items()):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def hot_origins(matrix, engine, n_populous=N_POPULOUS_ORIGINS):
+    """Returns the FIPS of the origins to precompute trees for (graph nodes only)"""
+
+    if HOT_ORIGINS:
+        origins = list(HOT_ORIGINS)
+    else:
+        population = matrix.counties['population'].to_numpy(dtype=np.float64)
+        populous = matrix.fips[np.argsort(-np.nan_to_num(population, nan=-1), kind='stable')]
+        origins = DEFAULT_ORIGINS + populous[:n_populous].tolist()
+
+    known = engine.node_index.get_indexer(origins) >= 0
+    return list(dict.fromkeys(int(code) for code, found in zip(origins, known) if found))
+
+
+def _init_worker(engine):
+    global _engine
+    _engine = engine
+
+
+def _day_trees(node_cases, origin_ids):
+    """Returns the arc weights of one day and the safest-path trees of the
+    origins (run in a precompute process, one day per call)"""
+
+    weights = _engine.case_weights(node_cases)
+    costs, predecessors = _engine.tree(origin_ids, weights)
+    return weights.astype(np.float32), costs, predecessors.astype(np.int32)
+
+
+@instrumentation.timed()
+def precompute(matrix, engine, directory=ARTIFACT_DIR, origins=None, tree_days=TREE_DAYS, max_workers=None):
+    """Writes the serving artifacts of every day of the case matrix: the
+    choropleth colors and color range of every day and, for the latest
+    tree_days days, the case arc weights and the safest-path trees of the hot origins
+
+    Days whose inputs didn't change since the last run keep their files, so
+    a nightly run only computes the new day (and the trees of the days that
+    entered the tree window). The trees of different days are computed in
+    parallel processes. As in shared_data.publish, new files get new names,
+    the index is replaced last and the previous run's files are kept until
+    the next run, so processes mapping or loading them are not affected.
+
+    Parameters
+    ----------
+    matrix: CaseMatrix
+        The active cases (in the row order the dashboard loads them)
+    engine: RoutingEngine
+        The county graph
+    directory: str, optional
+        Where the artifacts are written (default is MDA_ARTIFACT_DIR or Data/cache/artifacts)
+    origins: list, optional
+        FIPS of the origins to precompute trees for (default is None, see hot_origins)
+    tree_days: int, optional
+        Number of latest days with trees (default is MDA_TREE_DAYS or 14)
+    max_workers: int, optional
+        Number of processes (default is None, one per core; 1 computes in this process)
+
+    Returns
+    -------
+    index: dict
+        The written index
+    """
+
+    if origins is None:
+        origins = hot_origins(matrix, engine)
+    origin_ids = engine.node_index.get_indexer(origins)
+    population = matrix.counties['population'].to_numpy(dtype=np.float64)
+    trees_key = graph_key(engine, origins)
+    dates = matrix.date_labels.tolist()
+    tree_dates = set(dates[max(len(dates) - tree_days, 0):])
+
+    previous = {}
+    if is_published(directory):
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            previous = json.load(f)
+    reusable = previous.get('fips') == matrix.fips.tolist() and previous.get('nodes') == engine.nodes.tolist()
+    same_trees = reusable and previous.get('graph') == trees_key
+
+    build = '{}-{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), os.urandom(3).hex())
+    index = {'build': build, 'last_date': matrix.last_date, 'fips': matrix.fips.tolist(),
+             'nodes': engine.nodes.tolist(), 'origins': origins, 'graph': trees_key, 'dates': {}}
+    os.makedirs(directory, exist_ok=True)
+
+    def save(kind, date_label, array):
+        file_name = '{}-{}-{}.npy'.format(kind, date_label, build)
+        np.save(os.path.join(directory, file_name), np.ascontiguousarray(array))
+        return file_name
+
+    # colors: every changed day at once (a division per cell)
+    keys = [day_key(matrix.values[:, column], population) for column in range(len(dates))]
+    recolor = []
+    for column, date_label in enumerate(dates):
+        entry = previous.get('dates', {}).get(date_label) if reusable else None
+        if entry is not None and entry['key'] == keys[column]:
+            index['dates'][date_label] = {'key': entry['key'], 'range': entry['range'],
+                                          'files': {'colors': entry['files']['colors']}}
+            if date_label in tree_dates and same_trees and 'tree_costs' in entry['files']:
+                index['dates'][date_label]['files'].update(
+                    {kind: entry['files'][kind] for kind in ('weights', 'tree_costs', 'tree_predecessors')})
+        else:
+            recolor.append(column)
+
+    if recolor:
+        colors = day_colors(matrix.values[:, recolor], population)
+        for i, column in enumerate(recolor):
+            finite = colors[np.isfinite(colors[:, i]), i]
+            color_range = [float(finite.min()), float(finite.max())] if len(finite) else [0.0, 0.0]
+            index['dates'][dates[column]] = {'key': keys[column], 'range': color_range,
+                                             'files': {'colors': save('colors', dates[column],
+                                                                      colors[:, i].astype(np.float32))}}
+
+    # trees: one day per task, in parallel processes
+    retree = [date_label for date_label in dates
+              if date_label in tree_dates and 'tree_costs' not in index['dates'][date_label]['files']]
+    node_cases = [engine.node_values(matrix.fips, matrix.day(date_label)) for date_label in retree]
+    if max_workers == 1 or len(retree) <= 1:
+        _init_worker(engine)
+        trees = [_day_trees(cases, origin_ids) for cases in node_cases]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(engine,)) as executor:
+            trees = list(executor.map(_day_trees, node_cases, [origin_ids] * len(retree)))
+    for date_label, (weights, costs, predecessors) in zip(retree, trees):
+        index['dates'][date_label]['files'].update({'weights': save('weights', date_label, weights),
+                                                    'tree_costs': save('tree_costs', date_label, costs),
+                                                    'tree_predecessors': save('tree_predecessors', date_label,
+                                                                              predecessors)})
+
+    index_path = os.path.join(directory, INDEX_FILE)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+    kept = {file_name for written in (index, previous) for entry in written.get('dates', {}).values()
+            for file_name in entry['files'].values()}
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.npy') and entry.name not in kept:
+            os.remove(entry.path)
+
+    return index
+
+
+def build_artifacts(directory=ARTIFACT_DIR, max_workers=None):
+    """Loads the dashboard datasets from their sources and precomputes their artifacts (see precompute)"""
+
+    return precompute(load_case_matrix(), RoutingEngine(read_edges()), directory, max_workers=max_workers)
+
+
+class ServingArtifacts:
+    """Precomputed per-date artifacts, memory-mapped read-only
+
+    Only the days whose inputs still match the given case matrix (and, for
+    trees, the given routing graph) are served, so stale artifacts are never
+    used; lookups of other days return None.
+
+    Parameters
+    ----------
+    directory: str
+        Directory the artifacts were written to
+    matrix: CaseMatrix
+        The active cases the dashboard serves
+    engine: RoutingEngine
+        The county graph the dashboard routes on
+    """
+
+    def __init__(self, directory, matrix, engine):
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.dates = {}
+        self.origins = {}
+
+        if self.index['fips'] != matrix.fips.tolist():
+            return
+        population = matrix.counties['population'].to_numpy(dtype=np.float64)
+        same_graph = (self.index['nodes'] == engine.nodes.tolist()
+                      and self.index['graph'] == graph_key(engine, self.index['origins']))
+        self.origins = {code: row for row, code in enumerate(self.index['origins'])} if same_graph else {}
+
+        for date_label, entry in self.index['dates'].items():
+            if not matrix.has_day(date_label) or entry['key'] != day_key(matrix.day(date_label), population):
+                continue
+            files = entry['files'] if same_graph else {'colors': entry['files']['colors']}
+            self.dates[date_label] = dict(range=entry['range'], **{
+                kind: np.load(os.path.join(directory, file_name), mmap_mode='r') for kind, file_name in files.items()})
+
+    def _day(self, date_value):
+        return self.dates.get(str(date_value)[:10])
+
+    def colors(self, date_value):
+        """Returns the colors of every county (in matrix row order) and the
+        color range of a day (None if not precomputed)"""
+
+        day = self._day(date_value)
+        return None if day is None else (day['colors'], day['range'])
+
+    def weights(self, date_value):
+        """Returns the case arc weights of a day (None if not precomputed)"""
+
+        day = self._day(date_value)
+        return None if day is None else day.get('weights')
+
+    def tree(self, date_value, origin_fips):
+        """Returns the safest-path tree (costs, predecessors) of an origin on a
+        day (None if not precomputed)"""
+
+        day = self._day(date_value)
+        if day is None or 'tree_costs' not in day or origin_fips not in self.origins:
+            return None
+        row = self.origins[origin_fips]
+        return day['tree_costs'][row], day['tree_predecessors'][row]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the per-date serving artifacts of the dashboard')
+    parser.add_argument('--directory', default=ARTIFACT_DIR,
+                        help='where the artifacts are written (default is MDA_ARTIFACT_DIR or Data/cache/artifacts)')
+    parser.add_argument('--workers', type=int, default=None, help='processes computing trees (default is one per core)')
+    args = parser.parse_args()
+
+    written = build_artifacts(args.directory, args.workers)
+    print('Precomputed {} days up to {} in {}'.format(len(written['dates']), written['last_date'], args.directory))
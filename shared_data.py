@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from case_matrix import CaseMatrix, load_case_matrix
+from distance_index import read_edges
+from routing import RoutingEngine
+
+
+# directory the read-only dashboard datasets are published to (None: every process loads its own)
+SHARED_DIR = os.environ.get('MDA_SHARED_DIR')
+
+# default location when publishing from the command line or gunicorn.conf.py
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data', 'cache', 'shared')
+
+INDEX_FILE = 'index.json'
+
+# arrays of a publication; an index missing one of them was written by an older
+# version (e.g. before the engine had travel times) and must be republished
+ARRAY_NAMES = ['fips', 'county', 'population', 'dates', 'cases'] + ['engine_' + name for name in RoutingEngine.ARRAYS]
+
+# times a reader re-reads the index when the files it lists were removed meanwhile
+LOAD_ATTEMPTS = 3
+
+
+def read_index(directory):
+    """Returns the index of the datasets published to directory (None if there is none)"""
+
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def is_published(directory):
+    """Returns True if every current dataset has been published to directory"""
+
+    index = read_index(directory)
+    return index is not None and all(name in index['files'] for name in ARRAY_NAMES)
+
+
+def publish(matrix, engine, directory=DEFAULT_DIRECTORY):
+    """Writes the case matrix and the routing graph as plain .npy files that
+    any number of processes can memory-map
+
+    Every publication gets new file names and the index is replaced last, so
+    processes that still map the previous files are not affected. The files of
+    the previous publication are kept until the next one, for processes that
+    read the old index just before it was replaced; older files are removed
+    (their pages stay valid until the last process unmaps them).
+
+    Parameters
+    ----------
+    matrix: CaseMatrix
+        The active cases (the fips, county and population columns are kept)
+    engine: RoutingEngine
+        The county graph
+    directory: str, optional
+        Where the files are written (default is Data/cache/shared)
+
+    Returns
+    -------
+    index: dict
+        The published index (build id, latest date and file of every array)
+    """
+
+    arrays = {'fips': matrix.fips.astype(np.uint32),
+              'county': matrix.counties['county'].to_numpy(dtype=str),
+              'population': matrix.counties['population'].to_numpy(),
+              'dates': matrix.dates.to_numpy().astype('datetime64[D]'),
+              'cases': matrix.values}
+    arrays.update({'engine_' + name: array for name, array in engine.arrays().items()})
+
+    previous = read_index(directory) or {'files': {}}
+    # unique even within a second, so a publication never overwrites the files it keeps
+    build = '{}-{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), os.urandom(3).hex())
+    index = {'build': build, 'last_date': matrix.last_date, 'files': {}}
+
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        index['files'][name] = '{}-{}.npy'.format(name, build)
+        np.save(os.path.join(directory, index['files'][name]), np.ascontiguousarray(array))
+
+    index_path = os.path.join(directory, INDEX_FILE)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + '.tmp', index_path)
+
+    kept = set(index['files'].values()) | set(previous['files'].values())
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.npy') and entry.name not in kept:
+            os.remove(entry.path)
+
+    return index
+
+
+def build_shared_data(directory=DEFAULT_DIRECTORY):
+    """Loads the dashboard datasets from their sources and publishes them (see publish)"""
+
+    return publish(load_case_matrix(), RoutingEngine(read_edges()), directory)
+
+
+class SharedData:
+    """Published datasets, memory-mapped read-only
+
+    The arrays live in the page cache once, however many processes map
+    them; only the small lookups (county table, indexes) are per process.
+
+    Parameters
+    ----------
+    directory: str
+        Directory the datasets were published to
+    """
+
+    def __init__(self, directory):
+        for attempt in range(LOAD_ATTEMPTS):
+            self.index = read_index(directory)
+            try:
+                self.arrays = {name: np.load(os.path.join(directory, file_name), mmap_mode='r')
+                               for name, file_name in self.index['files'].items()}
+                break
+            except FileNotFoundError:
+                # published twice since the index was read: read the new one
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+
+    def case_matrix(self):
+        """Returns the case matrix over the shared fips x day array"""
+
+        counties = pd.DataFrame({'fips': self.arrays['fips'], 'county': self.arrays['county'].astype(object),
+                                 'population': self.arrays['population']})
+        return CaseMatrix(counties, pd.DatetimeIndex(self.arrays['dates']), self.arrays['cases'])
+
+    def routing_engine(self):
+        """Returns the routing engine over the shared graph arrays"""
+
+        return RoutingEngine.from_arrays({name[len('engine_'):]: array for name, array in self.arrays.items()
+                                          if name.startswith('engine_')})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish the dashboard datasets for memory-mapping by all workers')
+    parser.add_argument('--directory', default=SHARED_DIR or DEFAULT_DIRECTORY,
+                        help='where the datasets are written (default is MDA_SHARED_DIR or Data/cache/shared)')
+    args = parser.parse_args()
+
+    published = build_shared_data(args.directory)
+    print('Published {} arrays up to {} to {}'.format(len(published['files']), published['last_date'], args.directory))
@@ -0,0 +1,153 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import data_sources
+import instrumentation
+
+
+# inputs of the models in SymptomResultPrediction.ipynb and their levels, in code order
+# (a missing test indication means the test had another reason, as in the notebook)
+LEVELS = {'cough': (0, 1),
+          'fever': (0, 1),
+          'sore_throat': (0, 1),
+          'shortness_of_breath': (0, 1),
+          'head_ache': (0, 1),
+          'age_60_and_above': ('No', 'Yes'),
+          'gender': ('female', 'male'),
+          'test_indication': ('', 'abroad', 'contact')}
+
+FEATURES = tuple(LEVELS)
+
+# scores of every combination listed in all_predictions.csv
+MODELS = ('predictions_lr', 'predictions_gbc', 'predictions_rf')
+
+# every input gets the bits its levels need: bit-packed combinations are 9 bits (512 table rows)
+BITS = {feature: max(len(levels) - 1, 1).bit_length() for feature, levels in LEVELS.items()}
+SHIFTS = dict(zip(FEATURES, np.cumsum([0] + [BITS[feature] for feature in FEATURES[:-1]]).tolist()))
+N_CODES = 1 << sum(BITS.values())
+
+# level -> code of every input (symptoms may also be booleans)
+_CODES = {feature: {level: code for code, level in enumerate(levels)} for feature, levels in LEVELS.items()}
+_CODES['test_indication'][None] = 0
+
+
+def _feature_codes(feature, values):
+    """Returns the code of every value of one input (-1 for values that aren't a level)"""
+
+    if feature == 'test_indication':
+        values = pd.Series(values, dtype=object).fillna('')
+
+    # a dict lookup per value (symptoms given as True or 1.0 hash like 1)
+    codes = _CODES[feature]
+    return np.fromiter((codes.get(value, -1) for value in values), dtype=np.int16, count=len(values))
+
+
+def encode(records):
+    """Returns the bit-packed combination of every record
+
+    Parameters
+    ----------
+    records: dataframe
+        One column per input (see LEVELS)
+
+    Returns
+    -------
+    codes: numpy array
+        Row of every record in the score table
+    """
+
+    missing = [feature for feature in FEATURES if feature not in records and feature != 'test_indication']
+    if missing:
+        raise ValueError('missing input {}'.format(', '.join(missing)))
+
+    codes = np.zeros(len(records), dtype=np.int32)
+    for feature in FEATURES:
+        values = records[feature] if feature in records else [None] * len(records)
+        feature_codes = _feature_codes(feature, values)
+        invalid = np.flatnonzero(feature_codes < 0)
+        if len(invalid):
+            raise ValueError('record {}: {} must be one of {}'.format(int(invalid[0]), feature,
+                                                                       ', '.join(map(repr, LEVELS[feature]))))
+        codes |= feature_codes.astype(np.int32) << SHIFTS[feature]
+    return codes
+
+
+class SymptomScores:
+    """Scores of the three symptom models for every combination of inputs,
+    held in a table indexed by the bit-packed combination
+
+    A query is one array index, so neither pycaret nor the prediction
+    table is needed at serving time.
+
+    Parameters
+    ----------
+    scores: numpy array
+        (N_CODES, 3) float32 scores of the models in MODELS (NaN for codes no combination packs to)
+    """
+
+    def __init__(self, scores):
+        self.scores = scores
+
+    @classmethod
+    def from_predictions(cls, df_predictions):
+        """Builds the table from the rows of all_predictions.csv"""
+
+        scores = np.full((N_CODES, len(MODELS)), np.nan, dtype=np.float32)
+        scores[encode(df_predictions)] = df_predictions.loc[:, list(MODELS)].to_numpy(dtype=np.float32)
+        return cls(scores)
+
+    def score(self, **inputs):
+        """Returns the (lr, gbc, rf) scores of one combination of inputs"""
+
+        try:
+            code = sum(_CODES[feature][inputs.get(feature)] << SHIFTS[feature] for feature in FEATURES)
+        except KeyError as error:
+            raise ValueError('not a level of an input: {!r}'.format(error.args[0]))
+        return tuple(self.scores[code].tolist())
+
+    def batch_scores(self, records):
+        """Returns the scores of many records at once
+
+        Parameters
+        ----------
+        records: dataframe or list
+            One column (or key) per input
+
+        Returns
+        -------
+        scores: numpy array
+            (n_records, 3) scores of the models in MODELS, in record order
+        """
+
+        if not isinstance(records, pd.DataFrame):
+            records = pd.DataFrame.from_records(records, columns=list(FEATURES))
+        return self.scores[encode(records)]
+
+
+@instrumentation.timed()
+def load_symptom_scores():
+    """Returns the score table of the combinations in Data/all_predictions.csv"""
+
+    df_predictions = data_sources.read_csv('all_predictions', index_col=0, keep_default_na=False,
+                                           dtype={feature: str for feature in FEATURES[5:]})
+    return SymptomScores.from_predictions(df_predictions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time batch scoring of random symptom records')
+    parser.add_argument('--records', type=int, default=10000, help='records per batch (default is 10000)')
+    parser.add_argument('--repeat', type=int, default=20, help='number of batches (default is 20)')
+    args = parser.parse_args()
+
+    table = load_symptom_scores()
+    rng = np.random.default_rng(0)
+    sample = pd.DataFrame({feature: rng.choice(np.array(levels, dtype=object), args.records)
+                           for feature, levels in LEVELS.items()})
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        table.batch_scores(sample)
+    seconds = (time.perf_counter() - start) / args.repeat
+    print('{} records in {:.2f} ms ({:.3f} us per record)'.format(args.records, 1000 * seconds,
+                                                                  1e6 * seconds / args.records))
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import main
+import partitions
+from case_matrix import CaseMatrix, build_case_matrix
+from covid_data import COUNTY_DTYPES, read_county_info
+
+
+def test_matrix_layout_matches_the_wide_table(tmp_path, local_sources):
+    output_file, partition_dir = str(tmp_path / 'active_cases.csv'), str(tmp_path / 'active_cases')
+    cases = main.update_cases(pd.Timestamp('2021-01-31').date(), read_county_info(), output_file=output_file,
+                              partition_dir=partition_dir, report_file=str(tmp_path / 'report.csv'))
+    main.write_outputs(cases, output_file, partition_dir)
+
+    wide = pd.read_csv(output_file, dtype=COUNTY_DTYPES)
+    matrix = build_case_matrix(wide)
+    date_columns = wide.columns[6:]
+
+    # one row per county in table order, one column per day column
+    np.testing.assert_array_equal(matrix.fips, wide['fips'].to_numpy())
+    assert matrix.fips_labels.tolist() == ['{:0>5}'.format(code) for code in wide['fips'].tolist()]
+    assert matrix.values.shape == (len(wide), len(date_columns))
+    assert matrix.date_labels.tolist() == [pd.Timestamp(col[5:] + col[1:5]).strftime('%Y-%m-%d')
+                                           for col in date_columns]
+    assert matrix.last_date == '2021-01-31' and not matrix.has_day('2020-12-31')
+
+    for col in date_columns[[0, 9, -1]]:
+        day = '{}-{}-{}'.format(col[5:9], col[1:3], col[3:5])
+        np.testing.assert_array_equal(matrix.day(day), wide[col].to_numpy(dtype=np.float64))
+    for row in (0, len(wide) // 2, len(wide) - 1):
+        np.testing.assert_array_equal(matrix.series(wide['fips'].iloc[row]),
+                                      wide.loc[row, date_columns].to_numpy(dtype=np.float64))
+
+    # the monthly partitions give the same matrix as the CSV export
+    partitioned = CaseMatrix(*partitions.read_partitions(first_month='2021-01', county_columns=['fips', 'county'],
+                                                         locate=partitions.local_files(partition_dir)))
+    np.testing.assert_array_equal(partitioned.fips, matrix.fips)
+    assert partitioned.date_labels.tolist() == matrix.date_labels.tolist()
+    np.testing.assert_array_equal(partitioned.values, matrix.values)
@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import case_store
+from conftest import FIXTURE_DIR
+
+JHU_FILE = 'time_series_covid19_confirmed_US.csv'
+
+
+def read_jhu():
+    """Returns the county rows of the fixture's Johns Hopkins file (the store drops rows without FIPS)"""
+
+    jhu = pd.read_csv(os.path.join(FIXTURE_DIR, JHU_FILE))
+    return jhu[jhu['FIPS'].notna()].astype({'FIPS': np.int64}).reset_index(drop=True)
+
+
+def matrix_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.int32'))
+
+
+def test_slice_matches_the_source(local_sources):
+    store = case_store.open_case_store('confirmed')
+    jhu = read_jhu()
+
+    covid_data = store.slice('1/5/21', '1/9/21', jhu['FIPS'].to_numpy()[::-1])
+    expected = jhu.iloc[::-1][['FIPS', '1/5/21', '1/6/21', '1/7/21', '1/8/21', '1/9/21']].to_numpy()
+    np.testing.assert_array_equal(covid_data.to_numpy(), expected)
+
+
+def test_rebuilds_keep_matrix_and_index_consistent(tmp_path, local_sources):
+    store_dir = case_store.STORE_DIR
+    jhu = read_jhu()
+    sources = []
+    for n_days in (20, 40, 62):
+        source = str(tmp_path / '{}-days.csv'.format(n_days))
+        jhu.iloc[:, :11 + n_days].to_csv(source, index=False)
+        sources.append(source)
+
+    first = case_store.open_case_store('confirmed', source=sources[0])
+    for source in sources[1:]:
+        store = case_store.open_case_store('confirmed', source=source)
+
+    # every build has its own matrix; the previous one is kept, older ones are removed
+    with open(os.path.join(store_dir, 'confirmed.json')) as f:
+        index = json.load(f)
+    assert store.n_days == 62 and store.matrix.shape == (len(jhu), 62)
+    assert index['matrix'] in matrix_files(store_dir) and len(matrix_files(store_dir)) == 2
+
+    # a store opened before the rebuilds still reads its own build
+    assert first.n_days == 20
+    np.testing.assert_array_equal(first.matrix, jhu.iloc[:, 11:31].to_numpy())
+
+
+def test_stores_without_a_matrix_file_name_are_rebuilt(local_sources):
+    store = case_store.open_case_store('confirmed')
+    store_dir = case_store.STORE_DIR
+
+    # the layout before build-specific files: confirmed.int32 and an index without 'matrix'
+    index_path = os.path.join(store_dir, 'confirmed.json')
+    with open(index_path) as f:
+        index = json.load(f)
+    shutil.copy(os.path.join(store_dir, index.pop('matrix')), os.path.join(store_dir, 'confirmed.int32'))
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    rebuilt = case_store.open_case_store('confirmed')
+    assert rebuilt.built >= store.built and 'confirmed.int32' not in matrix_files(store_dir)
+    np.testing.assert_array_equal(rebuilt.matrix, store.matrix)
@@ -0,0 +1,90 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import covid_data
+from conftest import FIXTURE_DIR
+
+
+def cumulative_cases():
+    """Returns the fixture's Johns Hopkins counties in the layout of get_cumulative
+    ('fips' + one 'm/d/yy' column per day), with a downward revision in Autauga"""
+
+    jhu = pd.read_csv(os.path.join(FIXTURE_DIR, 'time_series_covid19_confirmed_US.csv'))
+    jhu = jhu[jhu['FIPS'].notna()].reset_index(drop=True)
+    cases = jhu.iloc[:, 11:].astype(np.int32)
+    cases.insert(0, 'fips', jhu['FIPS'].astype(np.uint32))
+    cases.loc[cases['fips'] == 1001, '1/5/21'] -= 500
+    return cases
+
+
+# the pandas transforms the vectorized ones replaced (rolling runs on the transpose,
+# since pandas 3 dropped rolling(axis=1))
+
+def reference_daily_diff(cases):
+    daily = cases.iloc[:, 1:].astype(np.float64).diff(axis=1)
+    daily = daily.mask(daily < 0, 0).iloc[:, 1:]
+    return pd.concat([cases[['fips']], daily], axis=1)
+
+
+def reference_active_cases(daily, active_days=10):
+    active = daily.iloc[:, 1:].astype(np.float64).T.rolling(active_days).sum().T
+    return pd.concat([daily[['fips']], active.iloc[:, active_days - 1:]], axis=1)
+
+
+def reference_scale_by_pop(cases, county_info):
+    scaled = pd.merge(county_info[['fips', 'population']], cases.astype({'fips': np.int64}), on='fips', how='right')
+    values = scaled.iloc[:, 2:].astype(np.float64).div(scaled['population'], axis=0) * 100000
+    return pd.concat([scaled[['fips']], values], axis=1)
+
+
+def assert_same_table(found, expected, rtol=0):
+    assert found.columns.tolist() == expected.columns.tolist()
+    np.testing.assert_array_equal(found['fips'].to_numpy(), expected['fips'].to_numpy())
+    np.testing.assert_allclose(found.iloc[:, 1:].to_numpy(dtype=np.float64),
+                               expected.iloc[:, 1:].to_numpy(dtype=np.float64), rtol=rtol)
+
+
+def test_transforms_match_the_pandas_baseline():
+    cases = cumulative_cases()
+    county_info = pd.read_csv(os.path.join(FIXTURE_DIR, 'county_info.csv'))
+
+    daily = covid_data.get_daily_diff(cases)
+    assert_same_table(daily, reference_daily_diff(cases))
+    assert (daily.iloc[:, 1:].to_numpy() >= 0).all()
+
+    for active_days in (10, 3):
+        assert_same_table(covid_data.get_active_cases(daily, active_days),
+                          reference_active_cases(daily, active_days))
+
+    active = covid_data.get_active_cases(daily)
+    # float32 results: agree to float32 precision
+    assert_same_table(covid_data.scale_by_pop(active, county_info), reference_scale_by_pop(active, county_info),
+                      rtol=1e-6)
+
+
+def test_times_year_is_parsed_once_per_source_version(tmp_path, local_sources):
+    directory = str(tmp_path / 'sources')
+    shutil.copytree(FIXTURE_DIR, directory)
+    local_sources(directory)
+    source = os.path.join(directory, 'us-counties-2021.csv')
+    nytimes = pd.read_csv(source, parse_dates=['date'])
+
+    def cache_files():
+        return sorted(os.listdir(covid_data.NYT_CACHE_DIR))
+
+    for counties in ([49003], [6037, 49003], [1001, 4013, 99999]):
+        found = covid_data.read_times_year('2021', np.array(counties))
+        # (grouped by county, in file order within a county)
+        expected = nytimes[nytimes['fips'].isin(counties)].sort_values('fips', kind='stable')
+        np.testing.assert_array_equal(found['fips'], expected['fips'])
+        np.testing.assert_array_equal(found['date'], expected['date'])
+        np.testing.assert_array_equal(found[['cases', 'deaths']], expected[['cases', 'deaths']])
+        # every county selection reads the same parsed file (records and index)
+        assert len(cache_files()) == 2
+    first = cache_files()
+
+    # a new download of the year replaces the parsed file
+    os.utime(source, (os.path.getmtime(source) + 60,) * 2)
+    covid_data.read_times_year('2021', np.array([49003]))
+    assert len(cache_files()) == 2 and not set(cache_files()) & set(first)
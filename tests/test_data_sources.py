@@ -0,0 +1,66 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import data_sources
+
+CONTENT = b'fips,cases\n1001,5\n'
+
+
+class SlowServer(BaseHTTPRequestHandler):
+    """Serves CONTENT, then (once the server's stall is set) stops answering
+    before the headers or in the middle of the body"""
+
+    def do_GET(self):
+        if self.server.stall == 'headers':
+            time.sleep(2)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.end_headers()
+        if self.server.stall == 'body':
+            self.wfile.write(CONTENT[:5])
+            self.wfile.flush()
+            time.sleep(2)
+            return
+        self.wfile.write(CONTENT)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slow_source(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowServer)
+    server.stall, server.daemon_threads = None, True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = 'http://127.0.0.1:{}/slow.csv'.format(server.server_address[1])
+    monkeypatch.setitem(data_sources.SOURCES, 'slow', (url, 0))
+    monkeypatch.setattr(data_sources, 'CACHE_DIR', str(tmp_path / 'http'))
+    monkeypatch.setattr(data_sources, 'OFFLINE', False)
+    monkeypatch.setattr(data_sources, 'LOCAL_DIR', None)
+    monkeypatch.setattr(data_sources, 'TIMEOUT', 0.3)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('stall', ['headers', 'body'])
+def test_timeouts_serve_the_cached_copy(slow_source, stall):
+    path = data_sources.fetch('slow')
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+    slow_source.stall = stall
+    start = time.perf_counter()
+    assert data_sources._fetch_url(data_sources.source_url('slow'), 0) == (path, 'stale')
+    assert time.perf_counter() - start < 1.5
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_timeouts_without_a_cached_copy_raise(slow_source):
+    slow_source.stall = 'headers'
+    with pytest.raises(OSError):
+        data_sources.fetch('slow')
@@ -0,0 +1,35 @@
+import networkx as nx
+import numpy as np
+import distance_index
+from routing import RoutingEngine
+
+
+def test_index_is_rebuilt_when_the_graph_changes(tmp_path, local_sources):
+    path = str(tmp_path / 'distance_index.npz')
+    edges = distance_index.read_edges()
+    index = distance_index.load_distance_index(path, RoutingEngine(edges))
+    assert distance_index.load_distance_index(path, RoutingEngine(edges)).graph == index.graph
+
+    # a new adjacency list (here: one county dropped) invalidates the index
+    edges = edges[(edges['county_fips'] != 1073) & (edges['bcounty_fips'] != 1073)]
+    rebuilt = distance_index.load_distance_index(path, RoutingEngine(edges))
+    assert rebuilt.graph != index.graph and 1073 not in rebuilt.node_ids
+
+    graph = nx.from_pandas_edgelist(edges, source='county_fips', target='bcounty_fips', edge_attr='gc_dist_km')
+    for origin, target in [(1001, 1003), (1117, 1097), (1089, 1061)]:
+        expected = nx.single_source_dijkstra(graph, origin, target, weight='gc_dist_km')[0]
+        np.testing.assert_allclose(rebuilt.route(origin, target)[0], expected)
+
+
+def test_index_files_without_a_graph_key_are_rebuilt(tmp_path, local_sources):
+    path = str(tmp_path / 'distance_index.npz')
+    engine = RoutingEngine(distance_index.read_edges())
+    distance_index.build_distance_index(engine, n_landmarks=4, path=path)
+
+    # the layout before graph keys
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files if name != 'graph'}
+    np.savez(path, **arrays)
+    assert distance_index.DistanceIndex(path).graph is None
+
+    assert distance_index.load_distance_index(path, engine).graph == distance_index.engine_key(engine)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import dtw_clustering
+
+
+def random_walks(n_series, n_days, seed):
+    """Returns cumulative random walks shaped like scaled case series"""
+
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(size=(n_series, n_days)), axis=1)
+
+
+def naive_dtw(x, y, band):
+    """Returns the squared DTW distance of two series within a Sakoe-Chiba band, cell by cell"""
+
+    n = len(x)
+    cost = np.full((n + 1, n + 1), np.inf)
+    cost[0, 0] = 0
+    for i in range(1, n + 1):
+        for j in range(max(1, i - band), min(n, i + band) + 1):
+            cost[i, j] = (x[i - 1] - y[j - 1]) ** 2 + min(cost[i - 1, j - 1], cost[i - 1, j], cost[i, j - 1])
+    return cost[n, n]
+
+
+def all_distances(series, centroids):
+    """Returns the exact DTW distance of every series to every centroid"""
+
+    k = len(centroids)
+    return dtw_clustering.dtw_distances(np.repeat(series, k, axis=0), np.tile(centroids, (len(series), 1))
+                                        ).reshape(len(series), k)
+
+
+def test_dtw_distances_match_naive_dtw():
+    X, Y = random_walks(6, 40, 0), random_walks(6, 40, 1)
+    band = dtw_clustering.band_width(40)
+
+    expected = [naive_dtw(x, y, band) for x, y in zip(X, Y)]
+    np.testing.assert_allclose(dtw_clustering.dtw_distances(X, Y), expected)
+
+
+def test_lower_bounds_never_exceed_dtw():
+    series, centroids = random_walks(30, 60, 2), random_walks(5, 60, 3)
+
+    exact = all_distances(series, centroids)
+    lb_kim, lb_keogh = dtw_clustering.lower_bounds(series, centroids)
+    assert (lb_kim <= exact + 1e-9).all()
+    assert (lb_keogh <= exact + 1e-9).all()
+
+
+@pytest.mark.parametrize('warm_start', [None, 'random', 'lowest_bound'])
+def test_assign_finds_the_nearest_centroid(warm_start):
+    series, centroids = random_walks(80, 60, 4), random_walks(6, 60, 5)
+    exact = all_distances(series, centroids)
+
+    # k-means passes the labels of the previous iteration; once it settles they are
+    # mostly the centroid with the lowest bound, which isn't always the nearest
+    labels = None
+    if warm_start == 'random':
+        labels = np.random.default_rng(6).integers(0, len(centroids), len(series))
+    elif warm_start == 'lowest_bound':
+        labels = np.argmin(np.maximum(*dtw_clustering.lower_bounds(series, centroids)), axis=1)
+        assert (labels != exact.argmin(axis=1)).any()
+    assigned, distances, stats = dtw_clustering.assign(series, centroids, labels=labels)
+
+    np.testing.assert_allclose(distances, exact.min(axis=1))
+    np.testing.assert_array_equal(assigned, exact.argmin(axis=1))
+    assert stats['computed'] < stats['pairs'] + (0 if labels is None else len(series))
@@ -0,0 +1,108 @@
+import os
+import shutil
+from datetime import date
+import pandas as pd
+import pandas.testing as pdt
+import main
+from conftest import FIXTURE_DIR
+from covid_data import read_county_info
+
+
+def run(tmp_path, name, end_date, full=False):
+    """Runs one update like main.py (without pushing) into tmp_path/name and
+    returns the written table (None if the run changed nothing)"""
+
+    output_file = str(tmp_path / name / 'active_cases.csv')
+    partition_dir = str(tmp_path / name / 'active_cases')
+    report_file = str(tmp_path / name / 'data_quality_report.csv')
+    os.makedirs(tmp_path / name, exist_ok=True)
+
+    cases = main.update_cases(end_date, read_county_info(), full=full, output_file=output_file,
+                              partition_dir=partition_dir, report_file=report_file)
+    main.quality_report(end_date, report_file)
+    if cases is not None:
+        main.write_outputs(cases, output_file, partition_dir)
+    return cases
+
+
+def corrected_sources(directory, last_date):
+    """Writes a copy of the fixture up to last_date in which Johns Hopkins counts
+    1,000 more cases in Los Angeles County than the NY Times, and 28,000 too many
+    (a week of cases, too few for a spike) from 1/9/21 until the data of 1/13/21
+    corrects it, and returns the directory"""
+
+    shutil.copytree(FIXTURE_DIR, directory)
+    jhu_file = os.path.join(directory, 'time_series_covid19_confirmed_US.csv')
+    jhu = pd.read_csv(jhu_file)
+    days = [col for col in jhu.columns[11:] if pd.Timestamp(col) <= pd.Timestamp(last_date)]
+    jhu = jhu[list(jhu.columns[:11]) + days]
+
+    los_angeles = jhu['FIPS'] == 6037
+    jhu.loc[los_angeles, days] += 1000
+    jhu.loc[los_angeles, [col for col in days if pd.Timestamp('2021-01-09') <= pd.Timestamp(col)
+                          <= pd.Timestamp('2021-01-12')]] += 28000
+    jhu.to_csv(jhu_file, index=False)
+    return directory
+
+
+def outputs(tmp_path, name):
+    """Returns the contents of every output file of a run directory"""
+
+    files = {}
+    for root, _, names in os.walk(tmp_path / name):
+        for file_name in names:
+            with open(os.path.join(root, file_name), 'rb') as f:
+                files[os.path.relpath(os.path.join(root, file_name), tmp_path / name)] = f.read()
+    return files
+
+
+def test_incremental_equals_full(tmp_path, local_sources):
+    for end_date in (date(2021, 1, 10), date(2021, 1, 11), date(2021, 1, 25), date(2021, 1, 31)):
+        run(tmp_path, 'incremental', end_date)
+    full = run(tmp_path, 'full', date(2021, 1, 31), full=True)
+
+    incremental = main.read_existing(str(tmp_path / 'incremental' / 'active_cases.csv'),
+                                      str(tmp_path / 'incremental' / 'active_cases'))
+    assert main.last_materialized_date(incremental) == date(2021, 1, 31)
+    pdt.assert_frame_equal(incremental, main.read_existing(str(tmp_path / 'full' / 'active_cases.csv'),
+                                                           str(tmp_path / 'full' / 'active_cases')))
+    assert outputs(tmp_path, 'incremental') == outputs(tmp_path, 'full')
+
+    # the county reported as 0 by Johns Hopkins gets the NY Times counts
+    assert (full.loc[full['fips'] == 49003, main.date_columns(full)].to_numpy() > 0).all()
+
+
+def test_rerun_changes_nothing(tmp_path, local_sources):
+    run(tmp_path, 'daily', date(2021, 1, 20))
+    before = outputs(tmp_path, 'daily')
+
+    assert run(tmp_path, 'daily', date(2021, 1, 20)) is None
+    assert outputs(tmp_path, 'daily') == before
+
+
+def test_only_new_days_are_computed(tmp_path, local_sources, monkeypatch):
+    run(tmp_path, 'daily', date(2021, 1, 20))
+
+    computed = []
+    compute_cases = main.compute_cases
+    monkeypatch.setattr(main, 'compute_cases', lambda start_date, end_date, county_info: computed.append(
+        (start_date, end_date)) or compute_cases(start_date, end_date, county_info))
+    run(tmp_path, 'daily', date(2021, 1, 22))
+
+    assert computed == [('1/21/21', '1/22/21')]
+
+
+def test_corrections_of_past_days_are_applied(tmp_path, local_sources):
+    local_sources(corrected_sources(tmp_path / 'until-12', date(2021, 1, 12)))
+    run(tmp_path, 'incremental', date(2021, 1, 12))
+
+    # the data of 1/13 shows 1/9 to 1/12 were overcounted, so they get repaired
+    local_sources(corrected_sources(tmp_path / 'until-20', date(2021, 1, 20)))
+    run(tmp_path, 'incremental', date(2021, 1, 20))
+    full = run(tmp_path, 'full', date(2021, 1, 20), full=True)
+    assert outputs(tmp_path, 'incremental') == outputs(tmp_path, 'full')
+
+    # the repair meets Johns Hopkins on both sides of the overcount, so the
+    # active cases are those of the uncorrected fixture (no step, no phantom cases)
+    local_sources()
+    pdt.assert_frame_equal(full, run(tmp_path, 'fixture', date(2021, 1, 20), full=True))
@@ -0,0 +1,145 @@
+import os
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+from routing import RoutingEngine
+from conftest import FIXTURE_DIR
+
+# counties of the fixture's adjacency list without case data (their arcs are removed)
+MISSING = (1005, 1121)
+
+
+def read_edges():
+    return pd.read_csv(os.path.join(FIXTURE_DIR, 'adj_dist_all_final.csv'))
+
+
+def node_cases(engine, seed=0):
+    """Returns random cases for every node (continuous, so best paths have no ties) with MISSING left out"""
+
+    fips = [code for code in engine.nodes.tolist() if code not in MISSING]
+    cases = np.random.default_rng(seed).uniform(0, 1000, len(fips))
+    return engine.node_values(fips, cases)
+
+
+def networkx_graphs(edges, cases):
+    """Returns the graphs the dashboard used to build per request: the safest-path
+    MultiDiGraph (an arc weighs the cases of the county it leads into, counties
+    without cases are dropped) and the distance graph"""
+
+    cases = dict(zip(cases['fips'], cases['cases']))
+    safest = nx.MultiDiGraph()
+    for u, v in zip(edges['county_fips'], edges['bcounty_fips']):
+        if u in cases and v in cases:
+            safest.add_edge(u, v, cases=cases[v], key='a')
+            safest.add_edge(v, u, cases=cases[u], key='a')
+    shortest = nx.from_pandas_edgelist(edges, source='county_fips', target='bcounty_fips', edge_attr='gc_dist_km')
+    return safest, shortest
+
+
+def as_table(engine, values):
+    found = ~np.isnan(values)
+    return pd.DataFrame({'fips': engine.nodes[found], 'cases': values[found]})
+
+
+def random_pairs(engine, n_pairs, seed=1):
+    return np.random.default_rng(seed).choice(engine.nodes, size=(n_pairs, 2)).tolist()
+
+
+@pytest.fixture
+def routing_case():
+    edges = read_edges()
+    engine = RoutingEngine(edges)
+    values = node_cases(engine)
+    safest, shortest = networkx_graphs(edges, as_table(engine, values))
+    return engine, values, safest, shortest
+
+
+def test_routes_match_networkx(routing_case):
+    engine, values, safest, shortest = routing_case
+    weights = engine.case_weights(values)
+
+    for origin, target in random_pairs(engine, 40) + [(1001, 1005), (1121, 1003)]:
+        if origin in safest and target in safest and origin != target:
+            expected = nx.single_source_dijkstra(safest, origin, target, weight='cases')
+            cost, path = engine.route(origin, target, weights)
+            np.testing.assert_allclose(cost, expected[0])
+            assert path == expected[1]
+            np.testing.assert_allclose(engine.path_weight(path, weights), cost)
+        elif origin != target:
+            # a county without case data is no part of any safest path
+            assert engine.route(origin, target, weights) == (np.inf, [])
+
+        distance, path = engine.route(origin, target)
+        expected = nx.single_source_dijkstra(shortest, origin, target, weight='gc_dist_km')
+        np.testing.assert_allclose(distance, expected[0])
+        assert path == expected[1]
+
+
+def test_batch_routes_match_networkx(routing_case):
+    engine, values, safest, shortest = routing_case
+    # repeated origins share a tree; pairs from and to MISSING counties have no safest path
+    pairs = random_pairs(engine, 30) + [[1001, 1097], [1001, 1089], [1001, 1001], [1005, 1003], [1003, 1121]]
+
+    routes = engine.batch_routes(pairs, values)
+    assert routes[['from', 'to']].values.tolist() == pairs
+    for (origin, target), route in zip(pairs, routes.itertuples()):
+        if origin in safest and target in safest:
+            cases, path = nx.single_source_dijkstra(safest, origin, target, weight='cases')
+            np.testing.assert_allclose([route.safest_cases, route.safest_km, route.safest_counties],
+                                       [cases, nx.path_weight(shortest, path, 'gc_dist_km'), len(path)])
+        else:
+            assert np.isnan([route.safest_cases, route.safest_km, route.safest_counties]).all()
+
+        km, path = nx.single_source_dijkstra(shortest, origin, target, weight='gc_dist_km')
+        expected_cases = nx.path_weight(safest, path, 'cases') if all(code in safest for code in path) else np.inf
+        np.testing.assert_allclose([route.shortest_km, route.shortest_cases, route.shortest_counties],
+                                   [km, expected_cases, len(path)])
+
+
+def trip_labels(engine, origin, trip_cases, minutes_per_day):
+    """Returns the best (cases, arrival time) label of every (county, trip day)
+    state, relaxing every arc of every state until nothing changes"""
+
+    last_day = trip_cases.shape[1] - 1
+    labels = {(origin, 0): (0.0, 0.0)}
+    changed = True
+    while changed:
+        changed = False
+        for (node, day), (cost, time) in list(labels.items()):
+            for arc in range(engine.indptr[node], engine.indptr[node + 1]):
+                head, arrival = engine.indices[arc], time + engine.minutes[arc]
+                state = (head, min(int(arrival // minutes_per_day), last_day))
+                if np.isnan(trip_cases[state]):
+                    continue
+                label = (cost + trip_cases[state], arrival)
+                if label < labels.get(state, (np.inf, np.inf)):
+                    labels[state] = label
+                    changed = True
+    return labels
+
+
+def test_time_dependent_routes_match_exhaustive_relaxation():
+    engine = RoutingEngine(read_edges())
+    fips = [code for code in engine.nodes.tolist() if code not in MISSING]
+    cases = np.random.default_rng(2).uniform(0, 1000, (len(fips), 20))
+    # two hours of driving per day, so trips across the state take several days
+    trip_cases, minutes_per_day = engine.trip_cases(fips, cases, first_day=3, n_days=6), 120
+
+    for origin, target in random_pairs(engine, 12, seed=3) + [[1001, 1005], [1121, 1003]]:
+        cost, path, days = engine.time_dependent_route(origin, target, trip_cases, minutes_per_day)
+        labels = trip_labels(engine, engine.node_id(origin), trip_cases, minutes_per_day)
+        reached = [label for (node, _), label in labels.items() if node == engine.node_id(target)]
+        if origin in MISSING or not reached:
+            assert (cost, path, days) == (np.inf, [], [])
+            continue
+
+        np.testing.assert_allclose(cost, min(reached)[0])
+        assert path[0] == origin and path[-1] == target
+        assert days == np.minimum(engine.arrival_days(path, minutes_per_day), 5).tolist()
+        np.testing.assert_allclose(engine.trip_path_weight(path, trip_cases, minutes_per_day), cost)
+
+    # with a single day the search is the static safest path search
+    one_day = engine.trip_cases(fips, cases, first_day=3, n_days=1)
+    static = engine.route(1001, 1097, engine.case_weights(one_day[:, 0]))
+    assert engine.time_dependent_route(1001, 1097, one_day)[:2] == static
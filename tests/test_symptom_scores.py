@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import symptom_scores
+from conftest import FIXTURE_DIR
+
+
+def read_predictions():
+    """Returns the model predictions of every combination of inputs (all_predictions.csv)"""
+
+    return pd.read_csv(os.path.join(FIXTURE_DIR, 'all_predictions.csv'), index_col=0, keep_default_na=False)
+
+
+def test_table_reproduces_the_model_predictions(local_sources):
+    table = symptom_scores.load_symptom_scores()
+    predictions = read_predictions()
+    expected = predictions[list(symptom_scores.MODELS)].to_numpy(dtype=np.float32)
+
+    # every combination packs to its own row; the other rows are empty
+    codes = symptom_scores.encode(predictions)
+    assert len(set(codes.tolist())) == len(predictions)
+    assert np.isnan(np.delete(table.scores, codes, axis=0)).all()
+
+    for row, record in enumerate(predictions[list(symptom_scores.FEATURES)].to_dict('records')):
+        assert table.score(**record) == tuple(expected[row].tolist())
+
+    # batches in any order, with symptoms as booleans and no test indication given as None
+    records = predictions.sample(frac=1, random_state=0)
+    batch = records[list(symptom_scores.FEATURES)].astype({feature: bool for feature in symptom_scores.FEATURES[:5]})
+    batch['test_indication'] = batch['test_indication'].mask(batch['test_indication'] == '', None)
+    np.testing.assert_array_equal(table.batch_scores(batch),
+                                  records[list(symptom_scores.MODELS)].to_numpy(dtype=np.float32))
+
+
+def test_invalid_levels_are_rejected(local_sources):
+    table = symptom_scores.load_symptom_scores()
+    record = dict(read_predictions()[list(symptom_scores.FEATURES)].iloc[0])
+
+    with pytest.raises(ValueError, match='record 1: gender'):
+        table.batch_scores([record, dict(record, gender='other')])
+    with pytest.raises(ValueError):
+        table.score(**dict(record, cough=2))